@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+仿言分身的基准测试套件，不需要运行中的 AstrBot。
+
+astrbot.api 由 stubs.py 中的最小实现替代（Context、AstrMessageEvent、配置、html_render、大模型调用），
+插件本身的代码原样加载，测得的是插件一侧的开销。在插件目录下执行：
+    python -m benchmarks recorder   # 以合成消息流驱动 message_recorder
+    python -m benchmarks generate   # 在预先灌入 1 万 ~ 100 万条聊天记录的数据库上测试“生成”与“数据预览”
+    python -m benchmarks all
+结果写入 JSON 文件（默认 bench_output.json），便于不同版本之间对比。
+"""
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试入口，在插件目录下执行：
+    python -m benchmarks recorder [--users 50] [--messages 20000] [--rate 0] [--target-ratio 0.3]
+    python -m benchmarks generate [--rows 10000 100000 1000000] [--repeat 5]
+    python -m benchmarks all
+每次运行在独立的临时目录中进行（--work-dir 指定，--keep 保留），结果写入 --output 指定的 JSON 文件。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from . import stubs
+from .workload import TOPIC_KEYWORD, LoopMonitor, seed_user, summarize, synthetic_traffic
+
+BENCH_USER = "bench_user"
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=stubs.PLUGIN_ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _plugin_config(args, **extra) -> dict:
+    return {"storage_backend": args.backend, **extra}
+
+
+# --- 消息记录 ---
+async def bench_recorder(main_module, args) -> dict:
+    targets = [f"u{i:04d}" for i in range(args.users)]
+    others = [f"x{i:04d}" for i in range(args.others)]
+    plugin = stubs.make_plugin(main_module, **_plugin_config(args, target_users=targets))
+    traffic = list(synthetic_traffic(args.messages, targets, others, args.target_ratio, args.command_ratio, args.seed))
+    latencies = []
+
+    async def handle(sender_id: str, message: str):
+        started = time.perf_counter()
+        await plugin.message_recorder(stubs.Event(sender_id, message))
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    async with LoopMonitor() as monitor:
+        started = time.perf_counter()
+        if args.rate > 0:
+            # 开环：按固定速率投递，每条消息一个任务，与 AstrBot 分发事件的方式一致
+            tasks = []
+            for i, (sender_id, message) in enumerate(traffic):
+                delay = started + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(handle(sender_id, message)))
+            await asyncio.gather(*tasks)
+        else:
+            # 闭环：逐条处理，测量最大吞吐；每条之间让出一次事件循环，阻塞监测只反映处理函数本身
+            for sender_id, message in traffic:
+                await handle(sender_id, message)
+                await asyncio.sleep(0)
+        send_seconds = time.perf_counter() - started
+        await plugin.write_buffer.flush()
+        total_seconds = time.perf_counter() - started
+
+    metrics = plugin.metrics
+    result = {
+        "params": {
+            "users": args.users, "others": args.others, "messages": args.messages, "rate": args.rate,
+            "target_ratio": args.target_ratio, "command_ratio": args.command_ratio, "backend": args.backend,
+        },
+        "accepted": metrics.counter("recorder.accepted"),
+        "rejected": metrics.counter("recorder.rejected"),
+        "persisted": metrics.counter("recorder.inserted"),
+        "send_seconds": round(send_seconds, 3),
+        "drain_seconds": round(total_seconds - send_seconds, 3),
+        # 事件处理吞吐：每秒处理的消息数（含被过滤的）；落库吞吐：每秒写入数据库的条数（含清空缓冲）
+        "handler_throughput": round(args.messages / send_seconds, 1) if send_seconds else None,
+        "persist_throughput": round(metrics.counter("recorder.inserted") / total_seconds, 1) if total_seconds else None,
+        "handler_latency_ms": summarize(latencies),
+        "event_loop": monitor.report(),
+        "metrics": metrics.snapshot(),
+    }
+    await plugin.terminate()
+    return result
+
+
+# --- 生成与数据预览 ---
+async def _measure(name: str, phases: dict, repeat: int, run, before=None):
+    """执行 run() repeat 次并记录耗时；before() 在每次计时之前执行，不计入耗时"""
+    latencies, errors = [], []
+    async with LoopMonitor() as monitor:
+        for _ in range(repeat):
+            if before is not None:
+                await before()
+            started = time.perf_counter()
+            results = await run()
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += [text for kind, text in results if kind == "plain" and "失败" in text]
+    phases[name] = {"latency_ms": summarize(latencies), "event_loop": monitor.report()}
+    if errors:
+        phases[name]["errors"] = errors[:5]
+
+
+async def _collect(handler) -> list:
+    return [result async for result in handler]
+
+
+async def bench_generate_size(main_module, storage, args, rows: int) -> dict:
+    seed = await asyncio.to_thread(
+        seed_user, storage, Path("data/astrtbot_plugin_echo_avatar"), BENCH_USER, rows, args.backend, seed=args.seed
+    )
+    provider = stubs.Provider(args.llm_latency)
+    stubs.Star.render_delay = args.render_delay
+    plugin = stubs.make_plugin(main_module, provider, **_plugin_config(args, target_users=[BENCH_USER]))
+    phases = {}
+
+    # 首次打开：统计目录重建（扫描全部数据）与数据库连接
+    started = time.perf_counter()
+    await plugin.store.catalog_ready()
+    await plugin.store.user_exists(BENCH_USER)
+    phases["startup"] = {"latency_ms": summarize([(time.perf_counter() - started) * 1000])}
+
+    def generate(options: str = ""):
+        return lambda: _collect(plugin.generate_full_prompt(stubs.Event("admin", ""), BENCH_USER, options=options))
+
+    def preview():
+        return _collect(plugin.preview_data(stubs.Event("admin", ""), BENCH_USER))
+
+    async def add_messages():
+        now = time.time()
+        for i in range(args.incremental_messages):
+            await plugin.write_buffer.put(BENCH_USER, f"新消息 {i} {TOPIC_KEYWORD}", int(now))
+        await plugin.write_buffer.flush()
+
+    async def drop_preview():
+        await plugin.render_cache.invalidate(BENCH_USER)
+
+    await _measure("generate_full", phases, args.repeat, generate("--full"))
+    await _measure("generate_cached", phases, args.repeat, generate())
+    await _measure("generate_incremental", phases, args.repeat, generate(), before=add_messages)
+    await _measure("generate_topic", phases, args.repeat, generate(TOPIC_KEYWORD))
+    await _measure("preview_cold", phases, args.repeat, preview, before=drop_preview)
+    await _measure("preview_warm", phases, args.repeat, preview)
+    await _measure("search", phases, args.repeat,
+                   lambda: _collect(plugin.search_user_data(stubs.Event("admin", ""), BENCH_USER, keywords=f"{TOPIC_KEYWORD} 抽卡")))
+
+    result = {
+        "rows": rows,
+        "seed": seed,
+        "llm_calls": provider.calls,
+        "prompt_chars": summarize(provider.prompt_chars, digits=0),
+        "phases": phases,
+        "metrics": plugin.metrics.snapshot(),
+    }
+    await plugin.terminate()
+    return result
+
+
+async def bench_generate(main_module, storage, args, work_dir: Path) -> list:
+    results = []
+    for rows in args.rows:
+        # 每个数据规模使用独立的数据目录；插件的数据目录是相对当前工作目录的路径
+        size_dir = work_dir / f"{args.backend}_{rows}"
+        size_dir.mkdir(parents=True, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(size_dir)
+        try:
+            print(f"[generate] {rows} 条聊天记录...", flush=True)
+            results.append(await bench_generate_size(main_module, storage, args, rows))
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+# --- 入口 ---
+def _print_summary(report: dict):
+    recorder = report.get("recorder")
+    if recorder:
+        latency = recorder["handler_latency_ms"]
+        print(f"[recorder] {recorder['handler_throughput']} 条/秒，落库 {recorder['persist_throughput']} 条/秒，"
+              f"处理耗时 p50 {latency['p50']}ms / p99 {latency['p99']}ms，"
+              f"事件循环阻塞 {recorder['event_loop']['blocked_ms']}ms")
+    for size in report.get("generate", []):
+        parts = [f"{name} p50 {phase['latency_ms']['p50']}ms" for name, phase in size["phases"].items()]
+        print(f"[generate] {size['rows']} 条（灌库 {size['seed']['seconds']}s）: " + "，".join(parts))
+
+
+async def _run(args) -> dict:
+    stubs.install(logging.DEBUG if args.verbose else logging.WARNING)
+    main_module = stubs.load_plugin()
+    storage = sys.modules[f"{stubs.PLUGIN_PACKAGE}.storage"]
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "plugin_version": main_module.PLUGIN_METADATA["version"],
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "argv": sys.argv[1:],
+        },
+    }
+    work_dir = Path(args.work_dir).resolve() if args.work_dir else Path(tempfile.mkdtemp(prefix="echo_avatar_bench_"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        if args.command in ("recorder", "all"):
+            recorder_dir = work_dir / "recorder"
+            recorder_dir.mkdir(exist_ok=True)
+            os.chdir(recorder_dir)
+            try:
+                print("[recorder] 运行中...", flush=True)
+                report["recorder"] = await bench_recorder(main_module, args)
+            finally:
+                os.chdir(cwd)
+        if args.command in ("generate", "all"):
+            report["generate"] = await bench_generate(main_module, storage, args, work_dir)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def main(argv=None) -> int:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", default="bench_output.json", help="结果 JSON 文件（默认 bench_output.json）")
+    common.add_argument("--backend", choices=["per_user", "sharded"], default="per_user", help="存储布局")
+    common.add_argument("--seed", type=int, default=0, help="合成数据的随机种子")
+    common.add_argument("--work-dir", help="数据目录（默认新建临时目录）")
+    common.add_argument("--keep", action="store_true", help="保留数据目录")
+    common.add_argument("--verbose", action="store_true", help="输出插件的调试日志")
+
+    recorder = argparse.ArgumentParser(add_help=False)
+    recorder.add_argument("--users", type=int, default=50, help="监控用户数（默认 50）")
+    recorder.add_argument("--others", type=int, default=200, help="非监控用户数（默认 200）")
+    recorder.add_argument("--messages", type=int, default=20000, help="消息总数（默认 20000）")
+    recorder.add_argument("--rate", type=float, default=0, help="每秒投递的消息数，0 表示逐条尽快处理（默认 0）")
+    recorder.add_argument("--target-ratio", type=float, default=0.3, help="来自监控用户的消息比例（默认 0.3）")
+    recorder.add_argument("--command-ratio", type=float, default=0.05, help="机器人指令消息的比例（默认 0.05）")
+
+    generate = argparse.ArgumentParser(add_help=False)
+    generate.add_argument("--rows", type=int, nargs="+", default=[10000, 100000], help="灌入的聊天记录条数，可指定多个（默认 10000 100000）")
+    generate.add_argument("--repeat", type=int, default=5, help="每项测量的重复次数（默认 5）")
+    generate.add_argument("--incremental-messages", type=int, default=100, help="增量生成前新增的消息数（默认 100）")
+    generate.add_argument("--llm-latency", type=float, default=0, help="模拟的大模型响应时间，秒（默认 0）")
+    generate.add_argument("--render-delay", type=float, default=0, help="模拟的 html_render 耗时，秒（默认 0）")
+
+    parser = argparse.ArgumentParser(prog="benchmarks", description="仿言分身基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("recorder", parents=[common, recorder], help="以合成消息流驱动 message_recorder")
+    sub.add_parser("generate", parents=[common, generate], help="在预先灌入数据的数据库上测试生成与数据预览")
+    sub.add_parser("all", parents=[common, recorder, generate], help="运行全部基准测试")
+
+    args = parser.parse_args(argv)
+    report = asyncio.run(_run(args))
+    output = Path(args.output)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    _print_summary(report)
+    print(f"结果已写入 {output.resolve()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+astrbot.api 的最小替身，以及加载插件所需的辅助函数。
+
+只实现插件用到的接口：装饰器原样返回被装饰的函数，html_render 把模板与数据写成本地文件，
+大模型提供方按固定延迟返回固定内容。install() 必须在导入插件之前调用。
+"""
+
+import asyncio
+import enum
+import importlib
+import itertools
+import json
+import logging
+import sys
+import time
+import types
+from pathlib import Path
+
+PLUGIN_ROOT = Path(__file__).resolve().parent.parent
+# 插件以这个包名加载，与插件目录的实际名称无关
+PLUGIN_PACKAGE = "echo_avatar"
+
+
+class AstrBotConfig(dict):
+    """插件配置，AstrBot 中同样以 dict 的方式读取"""
+
+
+class AstrMessageEvent:
+    pass
+
+
+class _Filter:
+    class EventMessageType(enum.Enum):
+        ALL = "all"
+
+    class PermissionType(enum.Enum):
+        ADMIN = "admin"
+        MEMBER = "member"
+
+    class _CommandGroup:
+        def command(self, name, alias=None):
+            return lambda fn: fn
+
+    def event_message_type(self, message_type, priority: int = 0):
+        return lambda fn: fn
+
+    def permission_type(self, permission_type):
+        return lambda fn: fn
+
+    def command(self, name, alias=None):
+        return lambda fn: fn
+
+    def command_group(self, name, alias=None):
+        return lambda fn: self._CommandGroup()
+
+
+class Context:
+    """只提供 get_using_provider；provider 为 None 时模拟没有可用的大模型"""
+
+    def __init__(self, provider=None):
+        self.provider = provider
+
+    def get_using_provider(self, *args, **kwargs):
+        return self.provider
+
+
+class Star:
+    # html_render 生成的文件所在目录与渲染延迟，由基准测试设置
+    render_dir = Path("render_stub")
+    render_delay = 0.0
+    _render_ids = itertools.count()
+
+    def __init__(self, context: Context):
+        self.context = context
+
+    async def html_render(self, tmpl: str, data: dict, return_url: bool = True, options=None):
+        """把模板与数据写成一个文件并返回其路径，文件大小与渲染数据量成正比"""
+        if self.render_delay:
+            await asyncio.sleep(self.render_delay)
+        self.render_dir.mkdir(parents=True, exist_ok=True)
+        path = self.render_dir / f"{next(self._render_ids)}.png"
+        path.write_bytes((tmpl + json.dumps(data, ensure_ascii=False)).encode("utf-8"))
+        return path.resolve().as_uri() if return_url else str(path.resolve())
+
+
+def register(*args, **kwargs):
+    return lambda cls: cls
+
+
+class Message:
+    def __init__(self, timestamp: float):
+        self.timestamp = timestamp
+
+
+class Event(AstrMessageEvent):
+    """一条消息事件；结果以 (类型, 内容) 元组返回，便于统计"""
+
+    def __init__(self, sender_id: str, message: str, timestamp: float = None):
+        self.sender_id = sender_id
+        self.message_str = message
+        self.message_obj = Message(time.time() if timestamp is None else timestamp)
+        self.unified_msg_origin = f"bench:{sender_id}"
+
+    def get_sender_id(self) -> str:
+        return self.sender_id
+
+    def plain_result(self, text: str):
+        return ("plain", text)
+
+    def image_result(self, url: str):
+        return ("image", url)
+
+    def request_llm(self, prompt: str, **kwargs):
+        return ("llm", prompt)
+
+
+class Response:
+    def __init__(self, text: str):
+        self.completion_text = text
+
+
+class Provider:
+    """固定延迟的大模型提供方，记录调用次数与收到的 Prompt 长度"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.prompt_chars = []
+
+    async def text_chat(self, prompt: str = None, **kwargs):
+        self.calls += 1
+        self.prompt_chars.append(len(prompt or ""))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return Response(f"```yaml\n## Profile\n- version: bench {self.calls}\n```")
+
+
+def install(log_level: int = logging.WARNING):
+    """把替身模块注册为 astrbot、astrbot.api、astrbot.api.event、astrbot.api.star"""
+    logger = logging.getLogger("astrbot")
+    logger.setLevel(log_level)
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format="%(levelname)s %(message)s")
+
+    api = types.ModuleType("astrbot.api")
+    api.logger = logger
+    api.AstrBotConfig = AstrBotConfig
+    event = types.ModuleType("astrbot.api.event")
+    event.filter = _Filter()
+    event.AstrMessageEvent = AstrMessageEvent
+    star = types.ModuleType("astrbot.api.star")
+    star.Context = Context
+    star.Star = Star
+    star.register = register
+
+    root = types.ModuleType("astrbot")
+    root.api = api
+    api.event = event
+    api.star = star
+    sys.modules.update({"astrbot": root, "astrbot.api": api, "astrbot.api.event": event, "astrbot.api.star": star})
+
+
+def register_package():
+    """把插件目录注册为 PLUGIN_PACKAGE 包，之后即可导入 echo_avatar.storage 等模块"""
+    if PLUGIN_PACKAGE not in sys.modules:
+        package = types.ModuleType(PLUGIN_PACKAGE)
+        package.__path__ = [str(PLUGIN_ROOT)]
+        sys.modules[PLUGIN_PACKAGE] = package
+
+
+def load_plugin():
+    """以 PLUGIN_PACKAGE 为包名加载插件目录，返回 main 模块"""
+    register_package()
+    return importlib.import_module(f"{PLUGIN_PACKAGE}.main")
+
+
+def make_plugin(main_module, provider=None, **config):
+    """构造插件实例；数据目录为当前工作目录下的 data/astrtbot_plugin_echo_avatar"""
+    return main_module.EchoAvatarPlugin(Context(provider), AstrBotConfig(config))
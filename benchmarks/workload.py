@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试的负载生成与测量工具：合成聊天消息、离线灌入数据库、事件循环阻塞监测与分位数统计。
+所有随机内容都由固定种子生成，同样的参数得到同样的数据。
+"""
+
+import asyncio
+import random
+import time
+from pathlib import Path
+
+# 消息的组成片段：中文短句、英文单词、emoji、颜文字与标点，覆盖风格统计与过滤规则的各条路径
+_PHRASES = (
+    "今天", "好耶", "原神", "抽卡", "歪了", "吃饭了吗", "哈哈哈哈", "真的假的", "笑死", "有一说一",
+    "我觉得", "这个", "不太行", "明天再说", "加班", "摸鱼", "睡了", "早上好", "晚安", "绝了",
+    "好家伙", "离谱", "求助", "学习", "考试", "周末", "出去玩", "下雨了", "猫猫", "可爱",
+)
+_WORDS = ("ok", "lol", "nice", "bug", "python", "game", "gg", "wow", "yes", "no")
+_DECORATIONS = ("~", "！", "？", "。", "...", "😂", "🤔", "👍", "(´・ω・`)", "qwq", "233", "")
+# 会被指令过滤规则拦下的消息
+_COMMANDS = ("/help", "/echo_avatar 状态", "#签到", "!roll", "菜单")
+
+TOPIC_KEYWORD = "原神"
+
+
+def synthetic_message(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 8)):
+        parts.append(rng.choice(_WORDS) if rng.random() < 0.15 else rng.choice(_PHRASES))
+    separator = " " if rng.random() < 0.3 else ""
+    return separator.join(parts) + rng.choice(_DECORATIONS)
+
+
+def synthetic_traffic(count: int, targets: list, others: list, target_ratio: float,
+                      command_ratio: float = 0.05, seed: int = 0):
+    """产出 count 条 (sender_id, message)：target_ratio 比例来自监控用户，其中 command_ratio 比例是机器人指令"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        from_target = rng.random() < target_ratio or not others
+        sender = rng.choice(targets if from_target else others)
+        message = rng.choice(_COMMANDS) if rng.random() < command_ratio else synthetic_message(rng)
+        yield sender, message
+
+
+def seed_user(storage, data_root: Path, user_id: str, rows: int, backend: str = "per_user",
+              notes: int = 20, batch_size: int = 20000, seed: int = 0) -> dict:
+    """
+    直接通过存储层的同步函数为 user_id 灌入 rows 条聊天记录（时间均匀分布在过去一年内）
+    以及若干批注与记忆，与插件写入的数据完全相同（含风格统计与全文索引）。返回耗时与文件大小。
+    """
+    rng = random.Random(seed)
+    layout = storage.make_layout(data_root, backend=backend, shard_count=16)
+    db_path = layout.db_path(user_id)
+    started = time.perf_counter()
+    conn = storage.open_user_db(db_path, layout.scoped)
+    scope = storage.UserScope(user_id, layout.scoped)
+    try:
+        end = int(time.time())
+        step = 365 * 86400 / max(rows, 1)
+        for offset in range(0, rows, batch_size):
+            batch = [
+                (synthetic_message(rng), int(end - (rows - i) * step))
+                for i in range(offset, min(offset + batch_size, rows))
+            ]
+            storage._insert_chats(conn, scope, batch)
+        storage._set_profile(conn, scope, "nickname", f"bench_{user_id}")
+        for i in range(notes):
+            storage._insert_note(conn, scope, "admin_annotations", f"批注 {i}: {synthetic_message(rng)}", "bench", end)
+            storage._insert_note(conn, scope, "third_party_memories", f"记忆 {i}: {synthetic_message(rng)}", "bench", end)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return {
+        "rows": rows,
+        "seconds": round(time.perf_counter() - started, 3),
+        "db_bytes": sum(p.stat().st_size for p in (db_path, Path(f"{db_path}-wal")) if p.exists()),
+    }
+
+
+def summarize(values: list, digits: int = 3) -> dict:
+    """样本的数量、均值与分位数（按排序后的下标取值）"""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], digits)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), digits),
+        "min": round(ordered[0], digits),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], digits),
+    }
+
+
+class LoopMonitor:
+    """
+    事件循环阻塞监测：每隔 interval 秒醒来一次，实际醒来时间比预期晚的部分即为循环被阻塞的时间。
+    用法: async with LoopMonitor() as monitor: ...；结束后 monitor.report() 给出延迟分布（毫秒）。
+    """
+
+    def __init__(self, interval: float = 0.005, threshold_ms: float = 1.0):
+        self.interval = interval
+        self.threshold_ms = threshold_ms
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(time.perf_counter() - expected, 0) * 1000)
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        await asyncio.sleep(0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def report(self) -> dict:
+        blocked = [lag for lag in self.lags if lag >= self.threshold_ms]
+        return {
+            "lag_ms": summarize(self.lags),
+            # 超过阈值的延迟之和，近似于事件循环无法处理其他任务的总时间
+            "blocked_ms": round(sum(blocked), 3),
+            "blocked_events": len(blocked),
+        }
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+仿言分身的统计目录。
+
+为每个用户维护消息数（含已归档数）、首末消息时间、批注/记忆数量和存储占用，常驻内存并持久化到 catalog.db。
+统计在写入与删除时增量更新，数据预览与“统计”指令直接读取，不再执行 COUNT(*) 或遍历数据目录。
+"""
+
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, astuple, fields
+from pathlib import Path
+
+from .storage import LOG_TAG, configure_connection, logger, migrate
+
+
+@dataclass
+class UserStats:
+    message_count: int = 0
+    first_ts: int = None
+    last_ts: int = None
+    annotation_count: int = 0
+    memory_count: int = 0
+    # message_count 中已被归档的条数
+    archived_count: int = 0
+    # 每次写入（含修改资料、归档）都会递增，用于判断用户数据是否变化；仅在同一目录纪元 (epoch) 内可比
+    write_version: int = 0
+    # per_user 布局下为数据库文件（含 WAL）大小；sharded 布局下为聊天文本的字节数估算
+    disk_bytes: int = 0
+
+
+_STAT_COLUMNS = [f.name for f in fields(UserStats)]
+
+
+def _catalog_v1(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            first_ts INTEGER,
+            last_ts INTEGER,
+            annotation_count INTEGER NOT NULL DEFAULT 0,
+            memory_count INTEGER NOT NULL DEFAULT 0,
+            archived_count INTEGER NOT NULL DEFAULT 0,
+            write_version INTEGER NOT NULL DEFAULT 0,
+            disk_bytes INTEGER NOT NULL DEFAULT 0
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""")
+
+
+CATALOG_MIGRATIONS = [
+    (1, _catalog_v1),
+]
+
+
+class StatsCatalog:
+    """
+    用户统计目录。
+    读写都在事件循环中直接操作内存字典（O(1)）；变更过的用户会在短暂合并后由专用线程批量写回 catalog.db。
+    catalog.db 不存在、记录的存储布局与当前不一致、或上次没有正常关闭时，需要由调用方扫描数据库重建（见 EchoStore.catalog_ready）。
+    写回有延迟，进程异常退出会丢失最后一段时间的更新；因此载入时清除 catalog_meta 中的正常关闭标记，
+    close() 写回全部变更后再设置它，标记缺失即说明磁盘上的统计可能已经过时。
+    每次重建都会生成新的纪元 (epoch)，重建后归零的 write_version 不会与重建前的值混淆。
+    """
+
+    SAVE_DELAY = 1.0
+
+    def __init__(self, db_path: Path, layout_name: str, size_of=None):
+        """size_of(user_id) 返回用户数据占用的磁盘字节数；为 None 时按写入的文本量累计"""
+        self.db_path = db_path
+        self.layout_name = layout_name
+        self.size_of = size_of
+        self.loaded = False
+        self.epoch = None
+        self._stats = {}
+        self._dirty = set()
+        self._removed = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="echo_avatar_catalog")
+        self._conn = None
+        self._save_task = None
+        self._save_now = asyncio.Event()
+        self._save_failed = False
+
+    # --- 持久化（仅在目录线程中执行） ---
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path)
+            configure_connection(self._conn)
+            migrate(self._conn, CATALOG_MIGRATIONS)
+        return self._conn
+
+    def _load_sync(self):
+        conn = self._db()
+        row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'layout'").fetchone()
+        if row is None or row[0] != self.layout_name:
+            return None
+        if conn.execute("SELECT 1 FROM catalog_meta WHERE key = 'clean_shutdown'").fetchone() is None:
+            logger.warning(f"{LOG_TAG} 统计目录上次没有正常关闭，可能缺少最后写入的统计。")
+            return None
+        with conn:
+            conn.execute("DELETE FROM catalog_meta WHERE key = 'clean_shutdown'")
+        row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'epoch'").fetchone()
+        if row is None:
+            epoch = self._new_epoch()
+            with conn:
+                conn.execute("INSERT INTO catalog_meta (key, value) VALUES ('epoch', ?)", (epoch,))
+        else:
+            epoch = row[0]
+        columns = ", ".join(_STAT_COLUMNS)
+        return epoch, {
+            user_id: UserStats(*values)
+            for user_id, *values in conn.execute(f"SELECT user_id, {columns} FROM user_stats")
+        }
+
+    @staticmethod
+    def _new_epoch() -> str:
+        return str(time.time_ns())
+
+    def _save_sync(self, rows: list, removed: list, replace_all: bool):
+        conn = self._db()
+        if self.size_of is not None:
+            for i, (user_id, stats) in enumerate(rows):
+                try:
+                    rows[i] = (user_id, UserStats(*astuple(stats)[:-1], self.size_of(user_id)))
+                except OSError:
+                    pass
+        columns = ", ".join(_STAT_COLUMNS)
+        marks = ", ".join("?" * (len(_STAT_COLUMNS) + 1))
+        with conn:
+            if replace_all:
+                conn.execute("DELETE FROM user_stats")
+                conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('layout', ?)", (self.layout_name,))
+                conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('epoch', ?)", (self.epoch,))
+            conn.executemany("DELETE FROM user_stats WHERE user_id = ?", [(user_id,) for user_id in removed])
+            conn.executemany(
+                f"INSERT OR REPLACE INTO user_stats (user_id, {columns}) VALUES ({marks})",
+                [(user_id, *astuple(stats)) for user_id, stats in rows],
+            )
+        return rows
+
+    def _mark_clean_sync(self):
+        with self._db() as conn:
+            conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('clean_shutdown', ?)", (str(int(time.time())),))
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def load(self) -> bool:
+        """从 catalog.db 载入统计，返回是否载入成功（False 表示需要重建）"""
+        loaded = await self._run(self._load_sync)
+        self.loaded = True
+        if loaded is None:
+            return False
+        self.epoch, self._stats = loaded
+        return True
+
+    async def replace_all(self, stats: dict):
+        """用完整扫描得到的统计替换全部内容（重建），stats 为 {user_id: {字段: 值}}"""
+        self._stats = {user_id: UserStats(**values) for user_id, values in stats.items()}
+        self.epoch = self._new_epoch()
+        self._dirty.clear()
+        self._removed.clear()
+        self.loaded = True
+        await self._write(list(self._stats.items()), [], replace_all=True)
+
+    async def _write(self, rows: list, removed: list, replace_all: bool = False):
+        try:
+            saved = await self._run(self._save_sync, rows, removed, replace_all)
+        except Exception as e:
+            # 这批变更已经丢失，关闭时不能再标记为正常关闭
+            self._save_failed = True
+            logger.error(f"{LOG_TAG} 保存统计目录失败: {e}")
+            return
+        # 回填线程中测得的磁盘占用（期间被删除或更新过的用户以内存为准）
+        for user_id, stats in saved:
+            current = self._stats.get(user_id)
+            if current is not None:
+                current.disk_bytes = stats.disk_bytes
+
+    async def save(self):
+        """立即把变更过的用户写回 catalog.db"""
+        if not self._dirty and not self._removed:
+            return
+        rows = [(user_id, UserStats(*astuple(self._stats[user_id]))) for user_id in self._dirty if user_id in self._stats]
+        removed = list(self._removed)
+        self._dirty.clear()
+        self._removed.clear()
+        await self._write(rows, removed)
+
+    def _schedule_save(self):
+        if self._save_task is None or self._save_task.done():
+            self._save_now.clear()
+            self._save_task = asyncio.create_task(self._delayed_save())
+
+    async def _delayed_save(self):
+        try:
+            await asyncio.wait_for(self._save_now.wait(), timeout=self.SAVE_DELAY)
+        except asyncio.TimeoutError:
+            pass
+        await self.save()
+
+    async def close(self):
+        # 不能取消延迟写回：它可能已经取出了变更过的用户。改为让它立即写回，并等待其完成
+        if self._save_task is not None:
+            self._save_now.set()
+            await self._save_task
+            self._save_task = None
+        await self.save()
+        if self.loaded and not self._save_failed:
+            try:
+                await self._run(self._mark_clean_sync)
+            except Exception as e:
+                logger.error(f"{LOG_TAG} 保存统计目录失败: {e}")
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=True)
+
+    # --- 查询与增量更新（在事件循环中调用） ---
+    def get(self, user_id: str):
+        return self._stats.get(user_id)
+
+    def all(self) -> dict:
+        return self._stats
+
+    def user_count(self) -> int:
+        return len(self._stats)
+
+    def _entry(self, user_id: str) -> UserStats:
+        stats = self._stats.get(user_id)
+        if stats is None:
+            stats = self._stats[user_id] = UserStats()
+        stats.write_version += 1
+        self._removed.discard(user_id)
+        self._dirty.add(user_id)
+        self._schedule_save()
+        return stats
+
+    def record_chats(self, user_id: str, rows: list):
+        """记录新写入的聊天记录，rows 为 [(message, timestamp), ...]"""
+        if not rows:
+            return
+        stats = self._entry(user_id)
+        timestamps = [timestamp for _, timestamp in rows]
+        stats.message_count += len(rows)
+        stats.first_ts = min(timestamps) if stats.first_ts is None else min(stats.first_ts, *timestamps)
+        stats.last_ts = max(timestamps) if stats.last_ts is None else max(stats.last_ts, *timestamps)
+        if self.size_of is None:
+            stats.disk_bytes += sum(len(message.encode("utf-8")) for message, _ in rows)
+
+    def record_annotation(self, user_id: str):
+        self._entry(user_id).annotation_count += 1
+
+    def record_memory(self, user_id: str):
+        self._entry(user_id).memory_count += 1
+
+    def record_archived(self, user_id: str, count: int, size_delta: int = 0):
+        """记录归档了 count 条聊天记录，size_delta 为压缩带来的字节数变化（按文本量累计时使用）"""
+        stats = self._entry(user_id)
+        stats.archived_count += count
+        if self.size_of is None:
+            stats.disk_bytes = max(stats.disk_bytes + size_delta, 0)
+
+    def record_resized(self, user_id: str):
+        """记录用户的数据库文件大小发生了变化（如回收空间），下次写回时重新测量；不视为数据写入，不递增 write_version"""
+        if user_id in self._stats and self.size_of is not None:
+            self._dirty.add(user_id)
+            self._schedule_save()
+
+    def touch(self, user_id: str):
+        """记录一次不影响计数的写入（如修改资料），确保用户出现在目录中"""
+        self._entry(user_id)
+
+    def remove(self, user_id: str):
+        self._stats.pop(user_id, None)
+        self._dirty.discard(user_id)
+        self._removed.add(user_id)
+        self._schedule_save()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+仿言分身的离线维护工具，需在插件停用（或 AstrBot 停止）时运行。
+
+在 AstrBot 根目录下执行：
+    python -m data.plugins.astrtbot_plugin_echo_avatar.cli <子命令> [参数]
+
+子命令：
+    shard   在 per_user（每用户一个文件）与 sharded（分片）两种存储布局之间转换已有数据
+    import  从 JSONL / TSV 文件批量导入聊天记录，中断后再次执行会从上次的位置继续
+    export  把一个用户的全部数据导出为 JSONL 文件
+"""
+
+import argparse
+import sqlite3
+import sys
+from pathlib import Path
+
+from .filters import CommandFilter
+from .storage import ShardedLayout, convert_to_per_user, convert_to_sharded, remove_db_file
+from .transfer import DEFAULT_BATCH_SIZE, IMPORT_FORMATS, detect_format, export_offline, export_path, import_offline
+
+DEFAULT_DATA_ROOT = "data/astrtbot_plugin_echo_avatar"
+
+
+def _reset_persona_checkpoints(data_root: Path):
+    """迁移后聊天记录的 id 会重新分配，清除人格缓存中的增量检查点，下次生成时完整重建"""
+    db_path = data_root / "persona_cache.db"
+    if not db_path.exists():
+        return
+    conn = sqlite3.connect(db_path)
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(persona_cache)")}
+        if "last_chat_id" in columns:
+            with conn:
+                conn.execute("UPDATE persona_cache SET last_chat_id = NULL")
+    finally:
+        conn.close()
+
+
+def _detect_backend(data_root: Path, backend: str) -> str:
+    """auto 时按数据目录判断当前使用的存储布局"""
+    if backend != "auto":
+        return backend
+    return "sharded" if (data_root / "shards" / ShardedLayout.META_FILE).exists() else "per_user"
+
+
+def _cmd_shard(args) -> int:
+    data_root = Path(args.data_root)
+    if args.to == "sharded":
+        count = convert_to_sharded(data_root, shard_count=args.shards, batch_size=args.batch_size,
+                                   remove_source=args.remove_source)
+    else:
+        count = convert_to_per_user(data_root, batch_size=args.batch_size, remove_source=args.remove_source)
+    # 统计目录与数据布局绑定，删除后插件下次启动时会自动扫描重建
+    remove_db_file(data_root / "catalog.db")
+    _reset_persona_checkpoints(data_root)
+    print(f"完成：共迁移 {count} 个用户。请在插件配置中将 storage_backend 设置为 {args.to} 后再启用插件。")
+    return 0
+
+
+def _cmd_import(args) -> int:
+    data_root = Path(args.data_root)
+    source = Path(args.file)
+    if not source.is_file():
+        print(f"找不到文件: {source}")
+        return 1
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()] if args.targets else None
+    command_filter = CommandFilter(targets, filter_commands=not args.no_filter_commands)
+    backend = _detect_backend(data_root, args.backend)
+    result = import_offline(data_root, backend, source, args.format or detect_format(source), command_filter,
+                            batch_size=args.batch_size, restart=args.restart)
+    # 导入绕过了插件的统计目录，删除后插件下次启动时会自动扫描重建
+    remove_db_file(data_root / "catalog.db")
+    print(f"完成：导入 {result['imported']} 条消息，过滤 {result['filtered']} 条，无法解析 {result['invalid']} 行。")
+    return 0
+
+
+def _cmd_export(args) -> int:
+    data_root = Path(args.data_root)
+    target = Path(args.output) if args.output else export_path(data_root, args.user_id)
+    count = export_offline(data_root, _detect_backend(data_root, args.backend), args.user_id, target)
+    if not count:
+        print(f"未找到用户 {args.user_id} 的数据。")
+        return 1
+    print(f"完成：已导出 {count} 条记录到 {target}")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="echo_avatar", description="仿言分身离线维护工具")
+    parser.add_argument("--data-root", default=DEFAULT_DATA_ROOT, help=f"插件数据目录（默认 {DEFAULT_DATA_ROOT}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    shard = sub.add_parser("shard", help="在 per_user 与 sharded 存储布局之间转换数据")
+    shard.add_argument("--to", choices=["sharded", "per_user"], required=True, help="目标布局")
+    shard.add_argument("--shards", type=int, default=16, help="分片数量，仅在首次转换为 sharded 时生效（默认 16）")
+    shard.add_argument("--batch-size", type=int, default=5000, help="每批复制的行数（默认 5000）")
+    shard.add_argument("--remove-source", action="store_true", help="迁移成功后删除源数据文件")
+    shard.set_defaults(func=_cmd_shard)
+
+    backends = ["auto", "per_user", "sharded"]
+    imp = sub.add_parser("import", help="从 JSONL / TSV 文件批量导入聊天记录")
+    imp.add_argument("file", help="导入文件路径")
+    imp.add_argument("--format", choices=IMPORT_FORMATS, help="文件格式（默认按扩展名判断，.jsonl / .json 为 jsonl，其余为 tsv）")
+    imp.add_argument("--targets", help="只导入这些用户，逗号分隔（默认导入文件中的全部用户）")
+    imp.add_argument("--no-filter-commands", action="store_true", help="不过滤机器人指令消息")
+    imp.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help=f"每批写入的消息数（默认 {DEFAULT_BATCH_SIZE}）")
+    imp.add_argument("--restart", action="store_true", help="忽略上次的导入进度，从头开始")
+    imp.add_argument("--backend", choices=backends, default="auto", help="存储布局（默认按数据目录自动判断）")
+    imp.set_defaults(func=_cmd_import)
+
+    exp = sub.add_parser("export", help="把一个用户的全部数据导出为 JSONL 文件")
+    exp.add_argument("user_id", help="用户 ID")
+    exp.add_argument("--output", help="输出文件路径（默认 <数据目录>/exports/<用户ID>_<时间>.jsonl）")
+    exp.add_argument("--backend", choices=backends, default="auto", help="存储布局（默认按数据目录自动判断）")
+    exp.set_defaults(func=_cmd_export)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
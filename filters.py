@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+消息记录器的过滤规则。
+
+过滤规则在插件加载时编译为不可变的 CommandFilter，消息热路径上只做查表与一次前缀/正则匹配。
+AstrBot 在插件配置保存后会重新加载插件，届时会按新配置重新编译。
+"""
+
+import re
+
+# 常见的机器人指令前缀；以这些字符开头的消息视为指令而非自然语言
+DEFAULT_COMMAND_PREFIXES = ('/', '!', '#', '.', '~', '?', '！', '。', '？')
+
+# 短消息的首个词中包含这些关键词时视为指令
+DEFAULT_COMMAND_KEYWORDS = (
+    'help', 'start', 'stop', 'status', 'info', 'config',
+    '设置', '配置', '状态', '帮助', '开始', '停止'
+)
+
+# 本插件自身的指令名（不带前缀时也过滤）
+PLUGIN_COMMAND_NAME = 'echo_avatar'
+
+# 只对不超过该长度的消息做关键词判断，长消息几乎不可能是指令
+KEYWORD_CHECK_MAX_LENGTH = 50
+
+
+class CommandFilter:
+    """
+    编译后的消息过滤器。
+    - targets: 监控用户 ID 的 frozenset，非监控用户在任何字符串处理之前以 O(1) 被拒绝；为 None 时不限制用户（离线导入使用）；
+    - prefixes: 指令前缀元组，交给 str.startswith 一次匹配；
+    - keyword_pattern: 所有指令关键词合并成的单个正则，对首个词只扫描一遍。
+    """
+
+    __slots__ = ("targets", "filter_commands", "prefixes", "keyword_pattern")
+
+    def __init__(self, target_users, filter_commands: bool = True, extra_prefixes=(), extra_keywords=()):
+        self.targets = None if target_users is None else frozenset(str(user_id) for user_id in target_users)
+        self.filter_commands = bool(filter_commands)
+        self.prefixes = tuple(dict.fromkeys(
+            [*DEFAULT_COMMAND_PREFIXES, *(str(p) for p in extra_prefixes if str(p))]
+        ))
+        keywords = {str(k).lower() for k in (*DEFAULT_COMMAND_KEYWORDS, *extra_keywords) if str(k).strip()}
+        # 长关键词优先，保证正则的匹配结果与逐个 in 判断一致
+        self.keyword_pattern = re.compile(
+            "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+        ) if keywords else None
+
+    @classmethod
+    def from_config(cls, config, any_user: bool = False) -> "CommandFilter":
+        """按插件配置编译过滤器；any_user 为 True 时不限制用户，只应用指令过滤规则"""
+        return cls(
+            target_users=None if any_user else config.get("target_users", []),
+            filter_commands=config.get("filter_commands", True),
+            extra_prefixes=config.get("custom_command_prefixes", []),
+            extra_keywords=config.get("custom_command_keywords", []),
+        )
+
+    def is_command(self, text: str) -> bool:
+        """判断一条已去除首尾空白的非空消息是否为指令"""
+        if text.startswith(self.prefixes):
+            return True
+        if text[:len(PLUGIN_COMMAND_NAME)].lower() == PLUGIN_COMMAND_NAME:
+            return True
+        if self.keyword_pattern is not None and len(text) <= KEYWORD_CHECK_MAX_LENGTH:
+            first_word = text.split(None, 1)[0].lower()
+            if self.keyword_pattern.search(first_word):
+                return True
+        return False
+
+    def match(self, sender_id: str, message: str):
+        """
+        判断消息是否需要记录。需要记录时返回去除首尾空白后的文本，否则返回 None。
+        """
+        if self.targets is not None and sender_id not in self.targets:
+            return None
+        text = message.strip()
+        if not text:
+            return None
+        if self.filter_commands and self.is_command(text):
+            return None
+        return text
@@ -2,8 +2,8 @@
 
 import asyncio
 import os
-import sqlite3
 import random
+import time
 from pathlib import Path
 from datetime import datetime
 
@@ -14,6 +14,18 @@ from astrbot.api.event import (
 )
 from astrbot.api.star import Context, Star, register
 
+from .catalog import StatsCatalog
+from .filters import CommandFilter
+from .metrics import Metrics
+from .persona import (
+    DELTA_PROMPT_TEMPLATE, PROMPT_TEMPLATE, GenerationResult, PersonaCache, PersonaJob,
+    build_delta_prompt, build_full_prompt, compute_fingerprint, template_hash,
+)
+from .render_cache import RenderCache
+from .sampling import PromptBudget
+from .storage import EchoStore, ChatWriteBuffer, MaintenanceScheduler, MetricsDumper, RetentionPolicy, make_layout
+from .transfer import IMPORT_FORMATS, detect_format, export_path, import_file, write_records
+
 # 插件元数据
 PLUGIN_METADATA = {
     "name": "仿言分身 (Echo Avatar)",
@@ -25,7 +37,26 @@ PLUGIN_METADATA = {
 
 # --- 数据目录与路径定义 ---
 DATA_ROOT = Path("data/astrtbot_plugin_echo_avatar")
-USER_DATA_DIR = DATA_ROOT / "user_data"
+
+# 人格 Prompt 模板的摘要，模板变化后缓存的生成结果自动失效
+PERSONA_TEMPLATE_HASH = template_hash(PROMPT_TEMPLATE, DELTA_PROMPT_TEMPLATE)
+
+# “统计”指令最多列出的用户数
+STATS_LIST_LIMIT = 50
+# “搜索”指令每类内容最多列出的条数
+SEARCH_RESULT_LIMIT = 10
+# “性能”指令列出的数据库操作数与存储占用最大的用户数
+METRICS_TOP_OPERATIONS = 8
+METRICS_TOP_USERS = 10
+
+def _fmt_size(num_bytes: int) -> str:
+    """把字节数格式化为便于阅读的大小"""
+    size = float(num_bytes or 0)
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
 
 # --- HTML 模板定义 ---
 PREVIEW_HTML_TEMPLATE = """
@@ -110,60 +141,8 @@ PREVIEW_HTML_TEMPLATE = """
 </html>
 """
 
-# --- 数据库辅助函数 ---
-def init_user_db(db_path: Path):
-    """
-    初始化或迁移用户的数据库。
-    使用 "CREATE TABLE IF NOT EXISTS" 来安全地创建缺失的表，而不会影响现有数据。
-    这是实现向后兼容的关键。
-    """
-    try:
-        db_path.parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # 聊天记录表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp INTEGER NOT NULL
-            )""")
-        
-        # 用户资料表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS profile (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )""")
-
-        # 管理员批注表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS admin_annotations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                text TEXT NOT NULL,
-                added_by TEXT NOT NULL,
-                timestamp INTEGER NOT NULL
-            )""")
-        
-        # 第三方记忆表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS third_party_memories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                text TEXT NOT NULL,
-                added_by TEXT NOT NULL,
-                timestamp INTEGER NOT NULL
-            )""")
-            
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"[{PLUGIN_METADATA['name']}] 初始化/迁移数据库 {db_path} 失败: {e}")
-
-def get_user_db_path(user_id: str) -> Path:
-    """获取指定用户的数据库文件路径"""
-    return USER_DATA_DIR / f"{user_id}.db"
+# 预览模板的摘要，模板变化后缓存的预览图片自动失效
+PREVIEW_TEMPLATE_HASH = template_hash(PREVIEW_HTML_TEMPLATE)
 
 # --- 插件主类 ---
 @register(
@@ -178,60 +157,79 @@ class EchoAvatarPlugin(Star):
         super().__init__(context)
         self.config = config
         self.target_users = self.config.get("target_users", [])
-        USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
+        # 过滤规则只在加载时编译一次；AstrBot 保存插件配置后会重新加载插件
+        self.command_filter = CommandFilter.from_config(self.config)
+        layout = make_layout(
+            DATA_ROOT,
+            backend=self.config.get("storage_backend", "per_user"),
+            shard_count=self.config.get("shard_count", 16),
+        )
+        self.metrics = Metrics()
+        self.store = EchoStore(
+            layout,
+            workers=self.config.get("storage_workers", 2),
+            max_open=self.config.get("max_open_connections", 64),
+            idle_timeout=self.config.get("connection_idle_timeout", 300),
+            catalog=StatsCatalog(DATA_ROOT / "catalog.db", layout.name, size_of=layout.disk_usage),
+            metrics=self.metrics,
+        )
+        self.persona_cache = PersonaCache(
+            DATA_ROOT / "persona_cache.db",
+            ttl_days=self.config.get("persona_cache_ttl_days", 30),
+            max_entries=self.config.get("persona_cache_max_entries", 500),
+        )
+        self.prompt_budget = PromptBudget.from_config(self.config)
+        self.incremental_generation = bool(self.config.get("incremental_generation", True))
+        self.incremental_max_messages = max(int(self.config.get("incremental_max_messages", 200)), 1)
+        self.batch_concurrency = max(int(self.config.get("batch_concurrency", 3)), 1)
+        self.generation_timeout = max(float(self.config.get("generation_timeout", 180)), 0)
+        self.write_buffer = ChatWriteBuffer(
+            self.store,
+            max_size=self.config.get("write_queue_size", 2000),
+            flush_interval=self.config.get("flush_interval", 2.0),
+            batch_size=self.config.get("flush_batch_size", 200),
+        )
+        self.render_cache = RenderCache(
+            DATA_ROOT / "render_cache",
+            max_bytes=int(self.config.get("render_cache_max_mb", 64)) * 1024 * 1024,
+        )
+        self.maintenance = MaintenanceScheduler(
+            self.store,
+            RetentionPolicy.from_config(self.config),
+            interval=self.config.get("maintenance_interval", 21600),
+            idle_seconds=self.config.get("maintenance_idle_seconds", 300),
+        )
+        self.metrics_dumper = MetricsDumper(
+            self.metrics,
+            DATA_ROOT / "metrics.json",
+            interval=self.config.get("metrics_dump_interval", 0),
+        )
         logger.info(f"[{PLUGIN_METADATA['name']}] 插件已加载。当前监控用户: {self.target_users}")
 
+    def _start_background_tasks(self):
+        """启动后台维护与指标写出任务（幂等）。构造插件时事件循环可能尚未运行，因此由各处理器在收到第一条消息或指令时启动"""
+        self.maintenance.start()
+        self.metrics_dumper.start()
+
     @filter.event_message_type(filter.EventMessageType.ALL, priority=100)
     async def message_recorder(self, event: AstrMessageEvent):
-        sender_id = event.get_sender_id()
-        self.target_users = self.config.get("target_users", [])
-        filter_commands = self.config.get("filter_commands", True)
+        self._start_background_tasks()
+        started = time.perf_counter()
+        message_text = self.command_filter.match(event.get_sender_id(), event.message_str)
+        if message_text is None:
+            self.metrics.incr("recorder.rejected")
+            self.metrics.observe("recorder.reject", (time.perf_counter() - started) * 1000)
+            return
 
-        if sender_id in self.target_users:
-            message_text = event.message_str.strip()
-            if not message_text: 
-                return
-                
-            if filter_commands:
-                if message_text.startswith('/'):
-                    return
-                    
-                if message_text.lower().startswith('echo_avatar'):
-                    return
-                    
-                command_prefixes = ['!', '#', '.', '~', '?', '！', '。', '？']
-                if any(message_text.startswith(prefix) for prefix in command_prefixes):
-                    return
-                    
-                command_keywords = [
-                    'help', 'start', 'stop', 'status', 'info', 'config', 
-                    '设置', '配置', '状态', '帮助', '开始', '停止'
-                ]
-                if len(message_text) <= 50:
-                    first_word = message_text.split()[0].lower() if message_text.split() else ''
-                    if any(keyword in first_word for keyword in command_keywords):
-                        return
-
-            db_path = get_user_db_path(sender_id)
-            init_user_db(db_path)
+        sender_id = event.get_sender_id()
+        await self.write_buffer.put(sender_id, message_text, int(event.message_obj.timestamp))
+        self.metrics.incr("recorder.accepted")
+        self.metrics.observe("recorder.accept", (time.perf_counter() - started) * 1000)
 
-            try:
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO chat_history (user_id, message, timestamp) VALUES (?, ?, ?)",
-                    (sender_id, message_text, int(event.message_obj.timestamp)),
-                )
-                conn.commit()
-                conn.close()
-                
-                if filter_commands:
-                    logger.debug(f"[{PLUGIN_METADATA['name']}] 已记录用户 {sender_id} 的自然语言消息: {message_text[:50]}...")
-                else:
-                    logger.debug(f"[{PLUGIN_METADATA['name']}] 已记录用户 {sender_id} 的所有消息: {message_text[:50]}...")
-                
-            except Exception as e:
-                logger.error(f"[{PLUGIN_METADATA['name']}] 记录消息到 {db_path} 失败: {e}")
+        if self.command_filter.filter_commands:
+            logger.debug(f"[{PLUGIN_METADATA['name']}] 已记录用户 {sender_id} 的自然语言消息: {message_text[:50]}...")
+        else:
+            logger.debug(f"[{PLUGIN_METADATA['name']}] 已记录用户 {sender_id} 的所有消息: {message_text[:50]}...")
 
     @filter.command_group("echo_avatar", alias={"仿言分身"})
     def echo_avatar_group(self):
@@ -243,7 +241,9 @@ class EchoAvatarPlugin(Star):
     @echo_avatar_group.command("状态")
     async def get_status(self, event: AstrMessageEvent):
         """查询当前插件的监控状态"""
+        self._start_background_tasks()
         self.target_users = self.config.get("target_users", [])
+        self.command_filter = CommandFilter.from_config(self.config)
         user_list_str = "\n- ".join(self.target_users) if self.target_users else "无"
         yield event.plain_result(f"[{PLUGIN_METADATA['name']}]\n当前正在监控以下用户：\n- {user_list_str}")
 
@@ -251,17 +251,13 @@ class EchoAvatarPlugin(Star):
     @echo_avatar_group.command("完善资料")
     async def update_profile(self, event: AstrMessageEvent, user_id: str, key: str, *, value: str):
         """完善指定ID的资料。用法: /echo_avatar 完善资料 <ID> 昵称 <昵称内容>"""
+        self._start_background_tasks()
         if key.lower() != '昵称':
-            yield event.plain_result
-        
-        db_path = get_user_db_path(user_id)
-        init_user_db(db_path)
+            yield event.plain_result("目前仅支持完善“昵称”。用法: /echo_avatar 完善资料 <ID> 昵称 <昵称内容>")
+            return
+
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO profile (key, value) VALUES (?, ?)", ('nickname', value))
-            conn.commit()
-            conn.close()
+            await self.store.set_profile(user_id, 'nickname', value)
             yield event.plain_result(f"已将用户 {user_id} 的昵称更新为: {value}")
         except Exception as e:
             logger.error(f"[{PLUGIN_METADATA['name']}] 更新资料失败: {e}")
@@ -271,15 +267,9 @@ class EchoAvatarPlugin(Star):
     @echo_avatar_group.command("添加批注")
     async def add_admin_annotation(self, event: AstrMessageEvent, user_id: str, *, text: str):
         """为指定ID添加一条管理员批注。"""
-        db_path = get_user_db_path(user_id)
-        init_user_db(db_path)
+        self._start_background_tasks()
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO admin_annotations (text, added_by, timestamp) VALUES (?, ?, ?)",
-                           (text, event.get_sender_id(), int(datetime.now().timestamp())))
-            conn.commit()
-            conn.close()
+            await self.store.add_annotation(user_id, text, event.get_sender_id(), int(datetime.now().timestamp()))
             yield event.plain_result(f"已为用户 {user_id} 添加一条管理员批注。")
         except Exception as e:
             logger.error(f"[{PLUGIN_METADATA['name']}] 添加批注失败: {e}")
@@ -289,174 +279,511 @@ class EchoAvatarPlugin(Star):
     @echo_avatar_group.command("数据预览")
     async def preview_data(self, event: AstrMessageEvent, user_id: str):
         """以图片形式预览指定ID的所有数据。"""
-        db_path = get_user_db_path(user_id)
-        if not db_path.exists():
+        self._start_background_tasks()
+        # 先将缓冲区中尚未落库的消息写入，保证读到的是完整数据
+        await self.write_buffer.flush()
+        if not await self.store.user_exists(user_id):
             yield event.plain_result(f"未找到用户 {user_id} 的数据记录。")
             return
 
-        init_user_db(db_path)
-
         try:
-            conn = sqlite3.connect(db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-
-            # 获取资料
-            cursor.execute("SELECT value FROM profile WHERE key = 'nickname'")
-            nickname_row = cursor.fetchone()
-            nickname = nickname_row['value'] if nickname_row else "未设置"
-
-            # 获取批注
-            cursor.execute("SELECT text, added_by, timestamp FROM admin_annotations ORDER BY timestamp DESC")
-            annotations = [{"text": row['text'], "author": row['added_by'], "time": datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M')} for row in cursor.fetchall()]
-
-            # 获取记忆
-            cursor.execute("SELECT text, added_by, timestamp FROM third_party_memories ORDER BY timestamp DESC")
-            memories = [{"text": row['text'], "author": row['added_by'], "time": datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M')} for row in cursor.fetchall()]
-
-            # 获取聊天记录
-            cursor.execute("SELECT message FROM chat_history ORDER BY timestamp DESC LIMIT 10")
-            history = [{"message": row['message']} for row in cursor.fetchall()]
-            
-            # 新增统计功能
-            # 1. 统计插件本地总用户数
-            total_users = len([f for f in USER_DATA_DIR.glob("*.db") if f.is_file()])
-            
-            # 2. 统计当前用户的记录条数
-            cursor.execute("SELECT COUNT(*) AS count FROM chat_history")
-            chat_count = cursor.fetchone()['count']
-            
-            conn.close()
+            await self.store.catalog_ready()
+            stats = self.store.catalog.get(user_id)
+            cache_key = self._preview_key(stats)
+            cached = await self.render_cache.get(user_id, cache_key)
+            if self.render_cache.enabled:
+                self.metrics.incr("render.cache_hit" if cached is not None else "render.cache_miss")
+            if cached is not None:
+                yield event.image_result(cached)
+                return
+
+            data = await self.store.load_preview(user_id)
+
+            def _fmt(items):
+                return [{"text": item['text'], "author": item['added_by'], "time": datetime.fromtimestamp(item['timestamp']).strftime('%Y-%m-%d %H:%M')} for item in items]
 
             render_data = {
                 "user_id": user_id,
-                "nickname": nickname,
-                "admin_annotations": annotations,
-                "third_party_memories": memories,
-                "chat_history": history,
-                "total_users": total_users,
-                "chat_count": chat_count
+                "nickname": data["nickname"] or "未设置",
+                "admin_annotations": _fmt(data["annotations"]),
+                "third_party_memories": _fmt(data["memories"]),
+                "chat_history": [{"message": message} for message in data["history"]],
+                "total_users": self.store.catalog.user_count(),
+                "chat_count": stats.message_count if stats else 0
             }
 
-            image_url = await self.html_render(PREVIEW_HTML_TEMPLATE, render_data)
-            yield event.image_result(image_url)
+            if not self.render_cache.enabled:
+                with self.metrics.timer("render.html"):
+                    image_url = await self.html_render(PREVIEW_HTML_TEMPLATE, render_data)
+                yield event.image_result(image_url)
+                return
+            # 渲染为本地文件后放入缓存，相同数据的后续预览直接返回缓存图片
+            with self.metrics.timer("render.html"):
+                image_path = await self.html_render(PREVIEW_HTML_TEMPLATE, render_data, return_url=False)
+            yield event.image_result(await self.render_cache.put(user_id, cache_key, image_path))
 
         except Exception as e:
             logger.error(f"[{PLUGIN_METADATA['name']}] 数据预览失败: {e}")
             yield event.plain_result(f"数据预览失败: {e}")
 
+    def _preview_key(self, stats) -> str:
+        """预览图片的版本键：模板摘要、本地用户总数、该用户的计数与写入版本（任何写入都会改变它）"""
+        catalog = self.store.catalog
+        return compute_fingerprint(
+            template=PREVIEW_TEMPLATE_HASH,
+            epoch=catalog.epoch,
+            total_users=catalog.user_count(),
+            stats=(stats.message_count, stats.archived_count, stats.annotation_count,
+                   stats.memory_count, stats.last_ts, stats.write_version) if stats else None,
+        )[:32]
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @echo_avatar_group.command("统计")
+    async def list_stats(self, event: AstrMessageEvent):
+        """列出所有本地用户的数据统计"""
+        self._start_background_tasks()
+        await self.write_buffer.flush()
+        await self.store.catalog_ready()
+        await self.store.catalog.save()
+        all_stats = self.store.catalog.all()
+        if not all_stats:
+            yield event.plain_result(f"[{PLUGIN_METADATA['name']}]\n暂无任何用户数据。")
+            return
+
+        def _fmt_time(ts):
+            return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M') if ts else "无"
+
+        ranked = sorted(all_stats.items(), key=lambda item: item[1].message_count, reverse=True)
+        lines = [f"[{PLUGIN_METADATA['name']}]", f"本地共有 {len(ranked)} 个用户的数据："]
+        for user_id, stats in ranked[:STATS_LIST_LIMIT]:
+            lines.append(
+                f"- {user_id}: {stats.message_count} 条消息"
+                f"{f'（{stats.archived_count} 条已归档）' if stats.archived_count else ''}，"
+                f"{stats.annotation_count} 条批注，{stats.memory_count} 条记忆，"
+                f"{_fmt_size(stats.disk_bytes)}\n  {_fmt_time(stats.first_ts)} ~ {_fmt_time(stats.last_ts)}"
+            )
+        if len(ranked) > STATS_LIST_LIMIT:
+            lines.append(f"……仅显示消息数最多的 {STATS_LIST_LIMIT} 个用户。")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @echo_avatar_group.command("性能")
+    async def show_metrics(self, event: AstrMessageEvent):
+        """查看插件自加载以来的性能指标与各用户的数据库占用"""
+        self._start_background_tasks()
+        await self.store.catalog_ready()
+        await self.store.catalog.save()
+        metrics = self.metrics
+
+        def _hist(name: str, unit: str = "ms") -> str:
+            h = metrics.histogram(name)
+            if h is None:
+                return "无数据"
+            spec = ".2f" if unit == "ms" else ".0f"
+            return (f"{h['count']} 次，p50 {h['p50']:{spec}}{unit} / p99 {h['p99']:{spec}}{unit} / "
+                    f"最大 {h['max']:{spec}}{unit}")
+
+        snapshot = metrics.snapshot()
+        counters = snapshot["counters"]
+        lines = [
+            f"[{PLUGIN_METADATA['name']}]",
+            f"性能统计（自插件加载 {snapshot['uptime'] / 3600:.1f} 小时以来）：",
+            "【消息记录】",
+            f"- 记录 {counters.get('recorder.accepted', 0)} 条，过滤 {counters.get('recorder.rejected', 0)} 条，"
+            f"写缓冲积压 {self.write_buffer.pending} 条",
+            f"- 记录耗时: {_hist('recorder.accept')}",
+            f"- 过滤耗时: {_hist('recorder.reject')}",
+            f"- 批量落库: {_hist('recorder.insert')}，共写入 {counters.get('recorder.inserted', 0)} 条，"
+            f"失败 {counters.get('recorder.insert_failed', 0)} 条",
+            "【数据库】",
+            f"- 打开连接: {_hist('db.open')}",
+            f"- 通道排队: {_hist('db.queue_wait')}",
+        ]
+        # 按总耗时列出最重的数据库操作
+        operations = sorted(
+            ((name, h) for name, h in snapshot["histograms"].items()
+             if name.startswith("db.") and name not in ("db.open", "db.queue_wait")),
+            key=lambda item: item[1]["sum"], reverse=True,
+        )
+        for name, h in operations[:METRICS_TOP_OPERATIONS]:
+            lines.append(f"- {name[3:]}: {_hist(name)}")
+        lines += [
+            "【渲染与生成】",
+            f"- html_render: {_hist('render.html')}，预览缓存命中 {counters.get('render.cache_hit', 0)} 次 / "
+            f"未命中 {counters.get('render.cache_miss', 0)} 次",
+            f"- Prompt 长度: {_hist('prompt.chars', '字')}",
+            f"- 大模型请求: {_hist('llm.request')}，超时 {counters.get('llm.timeout', 0)} 次，失败 {counters.get('llm.error', 0)} 次",
+        ]
+
+        ranked = sorted(self.store.catalog.all().items(), key=lambda item: item[1].disk_bytes, reverse=True)
+        lines.append("【存储占用】")
+        if self.store.layout.disk_usage is None:
+            lines.append("（分片存储下按写入的文本量估算）")
+        lines.append(f"- 合计 {_fmt_size(sum(stats.disk_bytes for _, stats in ranked))}，{len(ranked)} 个用户")
+        for user_id, stats in ranked[:METRICS_TOP_USERS]:
+            lines.append(f"- {user_id}: {_fmt_size(stats.disk_bytes)}")
+        if self.metrics_dumper.interval:
+            lines.append(f"指标每 {self.metrics_dumper.interval:g} 秒写入 {self.metrics_dumper.path}")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @echo_avatar_group.command("维护")
+    async def run_maintenance(self, event: AstrMessageEvent):
+        """立即按保留策略归档旧聊天记录，并回收数据库空间"""
+        self._start_background_tasks()
+        await self.write_buffer.flush()
+        yield event.plain_result(f"[{PLUGIN_METADATA['name']}]\n正在执行数据维护，请稍候...")
+        try:
+            report = await self.maintenance.run_now()
+        except Exception as e:
+            logger.error(f"[{PLUGIN_METADATA['name']}] 数据维护失败: {e}")
+            yield event.plain_result(f"数据维护失败: {e}")
+            return
+        policy = self.maintenance.policy
+        lines = [f"[{PLUGIN_METADATA['name']}]", "数据维护完成："]
+        if policy.enabled:
+            lines.append(f"- 归档聊天记录 {report['archived']} 条，涉及 {report['users']} 个用户")
+        else:
+            lines.append("- 未配置保留策略（retention_max_messages / retention_max_days），跳过归档")
+        lines.append(f"- 回收磁盘空间 {_fmt_size(report['reclaimed'])}")
+        lines.append(f"- 耗时 {report['elapsed']:.1f} 秒")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @echo_avatar_group.command("导入")
+    async def import_history(self, event: AstrMessageEvent, path: str, *, options: str = ""):
+        """从服务器上的文件批量导入历史聊天记录。用法: /echo_avatar 导入 <文件路径> [--format jsonl|tsv] [--all-users] [--restart]"""
+        self._start_background_tasks()
+        flags = options.split()
+        source = Path(path)
+        if not source.is_file():
+            yield event.plain_result(f"找不到文件: {path}")
+            return
+        fmt = detect_format(source)
+        if "--format" in flags:
+            index = flags.index("--format")
+            fmt = flags[index + 1] if index + 1 < len(flags) else ""
+            if fmt not in IMPORT_FORMATS:
+                yield event.plain_result(f"不支持的格式，可选: {' / '.join(IMPORT_FORMATS)}")
+                return
+        # 与实时记录相同的过滤规则；--all-users 时不限于监控用户
+        command_filter = CommandFilter.from_config(self.config, any_user="--all-users" in flags)
+
+        yield event.plain_result(f"[{PLUGIN_METADATA['name']}]\n开始以 {fmt} 格式导入 {source.name}，请稍候...")
+        progress = None
+        reported = 0
+        try:
+            async for progress in import_file(self.store, DATA_ROOT, source, fmt, command_filter,
+                                              restart="--restart" in flags):
+                percent = progress["offset"] * 100 // progress["size"] if progress["size"] else 100
+                logger.info(f"[{PLUGIN_METADATA['name']}] 导入 {source.name}: {percent}%，已导入 {progress['imported']} 条")
+                # 每推进 25% 报告一次进度
+                if percent < 100 and percent // 25 > reported:
+                    reported = percent // 25
+                    yield event.plain_result(f"导入进度 {percent}%：已导入 {progress['imported']} 条消息。")
+        except Exception as e:
+            logger.error(f"[{PLUGIN_METADATA['name']}] 导入 {path} 失败: {e}")
+            yield event.plain_result(f"导入失败: {e}\n已完成的部分已保存，重新执行同一指令会从中断处继续。")
+            return
+
+        lines = [f"[{PLUGIN_METADATA['name']}]", f"导入完成：{source.name}"]
+        if progress["resumed"]:
+            lines.append("（从上次中断的位置继续）")
+        lines.append(f"- 导入消息 {progress['imported']} 条")
+        lines.append(f"- 按过滤规则跳过 {progress['filtered']} 条")
+        if progress["invalid"]:
+            lines.append(f"- 无法解析的行 {progress['invalid']} 行")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @echo_avatar_group.command("导出")
+    async def export_user_data(self, event: AstrMessageEvent, user_id: str):
+        """把指定ID的全部数据流式导出为 JSONL 文件"""
+        self._start_background_tasks()
+        await self.write_buffer.flush()
+        if not await self.store.user_exists(user_id):
+            yield event.plain_result(f"未找到用户 {user_id} 的数据记录。")
+            return
+
+        target = export_path(DATA_ROOT, user_id)
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            f = await asyncio.to_thread(open, target, "w", encoding="utf-8")
+            try:
+                count = await self.store.export_user(
+                    user_id, lambda records: asyncio.to_thread(write_records, f, records)
+                )
+            finally:
+                await asyncio.to_thread(f.close)
+        except Exception as e:
+            logger.error(f"[{PLUGIN_METADATA['name']}] 导出用户 {user_id} 的数据失败: {e}")
+            yield event.plain_result(f"导出失败: {e}")
+            return
+        yield event.plain_result(f"[{PLUGIN_METADATA['name']}]\n已导出用户 {user_id} 的 {count} 条记录到:\n{target.resolve()}")
+
     # --- 开放指令 ---
     @echo_avatar_group.command("添加记忆")
     async def add_third_party_memory(self, event: AstrMessageEvent, user_id: str, *, text: str):
         """为指定ID添加一条第三方记忆。"""
-        db_path = get_user_db_path(user_id)
-        init_user_db(db_path)
+        self._start_background_tasks()
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO third_party_memories (text, added_by, timestamp) VALUES (?, ?, ?)",
-                           (text, event.get_sender_id(), int(datetime.now().timestamp())))
-            conn.commit()
-            conn.close()
+            await self.store.add_memory(user_id, text, event.get_sender_id(), int(datetime.now().timestamp()))
             yield event.plain_result(f"感谢你！已为用户 {user_id} 添加一条新的记忆。")
         except Exception as e:
             logger.error(f"[{PLUGIN_METADATA['name']}] 添加记忆失败: {e}")
             yield event.plain_result(f"添加记忆失败: {e}")
 
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @echo_avatar_group.command("搜索")
+    async def search_user_data(self, event: AstrMessageEvent, user_id: str, *, keywords: str = ""):
+        """在指定ID的聊天记录、批注与记忆中搜索关键词。用法: /echo_avatar 搜索 <ID> <关键词...>"""
+        self._start_background_tasks()
+        if not keywords.strip():
+            yield event.plain_result("请提供要搜索的关键词。用法: /echo_avatar 搜索 <ID> <关键词>")
+            return
+        await self.write_buffer.flush()
+        if not await self.store.user_exists(user_id):
+            yield event.plain_result(f"未找到用户 {user_id} 的数据记录。")
+            return
+        try:
+            results = await self.store.search(user_id, keywords, SEARCH_RESULT_LIMIT)
+        except Exception as e:
+            logger.error(f"[{PLUGIN_METADATA['name']}] 搜索用户 {user_id} 的数据失败: {e}")
+            yield event.plain_result(f"搜索失败: {e}")
+            return
+
+        def _fmt(rows):
+            return [
+                f"- [{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')}] {text if len(text) <= 100 else text[:99] + '…'}"
+                for _, ts, text in rows
+            ]
+
+        lines = [f"[{PLUGIN_METADATA['name']}]", f"用户 {user_id} 中与“{keywords.strip()}”相关的内容："]
+        for table, title in (("admin_annotations", "管理员批注"), ("third_party_memories", "第三方记忆"), ("chat_history", "聊天记录")):
+            if results[table]:
+                lines.append(f"【{title}】")
+                lines.extend(_fmt(results[table]))
+        if len(lines) == 2:
+            lines.append("没有找到匹配的内容（已归档的聊天记录不参与搜索）。")
+        yield event.plain_result("\n".join(lines))
+
     # --- 核心生成指令 ---
     @filter.permission_type(filter.PermissionType.ADMIN)
     @echo_avatar_group.command("生成")
-    async def generate_full_prompt(self, event: AstrMessageEvent, user_id: str):
-        """使用所有维度的信息生成最终的Prompt"""
-        db_path = get_user_db_path(user_id)
-        if not db_path.exists():
+    async def generate_full_prompt(self, event: AstrMessageEvent, user_id: str, *, options: str = ""):
+        """使用所有维度的信息生成最终的Prompt。用法: /echo_avatar 生成 <ID> [话题] [--force] [--full]"""
+        self._start_background_tasks()
+        words = options.split()
+        flags = {word for word in words if word.startswith("--")}
+        topic = " ".join(word for word in words if not word.startswith("--"))
+
+        # 先将缓冲区中尚未落库的消息写入，保证读到的是完整数据
+        await self.write_buffer.flush()
+        if not await self.store.user_exists(user_id):
             yield event.plain_result(f"数据库中没有找到用户 {user_id} 的任何记录。")
             return
 
-        init_user_db(db_path)
-
-        yield event.plain_result(f"正在为用户 {user_id} 生成结构化人格Prompt，请稍候...")
         try:
-            conn = sqlite3.connect(db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-
-            # 1. 获取资料
-            cursor.execute("SELECT value FROM profile WHERE key = 'nickname'")
-            nickname_row = cursor.fetchone()
-            profile_desc = f"用户的昵称是\"{nickname_row['value']}\"" if nickname_row else "用户未设置昵称。"
-
-
-            # 2. 获取管理员批注
-            cursor.execute("SELECT text FROM admin_annotations ORDER BY timestamp")
-            annotations_str = "\n".join([f"- {r['text']}" for r in cursor.fetchall()]) or "无"
-
-            # 3. 获取第三方记忆
-            cursor.execute("SELECT text FROM third_party_memories ORDER BY timestamp")
-            memories_str = "\n".join([f"- {r['text']}" for r in cursor.fetchall()]) or "无"
-
-            # 4. 获取聊天记录
-            cursor.execute("SELECT message FROM chat_history ORDER BY timestamp DESC LIMIT 200")
-            history_str = "\n".join([f'"{r["message"]}"' for r in cursor.fetchall()]) or "无"
-            
-            conn.close()
-
-            prompt_template = (
-                "你是一个专业的AI人格档案工程师。你的任务是基于提供的多维度资料，为一个名为 '{user_id}' 的用户生成一个结构化的YAML格式的人格设定档案。\n"
-                "请严格按照以下格式输出，并根据提供的资料填充【】中的内容，如果某项没有足够信息支撑，请填写\"暂无\"或基于已有信息进行合理推断。\n\n"
-                "```yaml\n"
-                "## Profile\n"
-                "- author: {author}\n"
-                "- version: 1.0.0\n"
-                "- language: Chinese\n"
-                "- description: 【在这里根据用户的整体风格，用一句话简短描述其人格特征】\n\n"
-                "## Skills\n"
-                "【在这里分析用户的聊天记录和第三方记忆，总结出该用户的技能或特长。例如：擅长使用颜文字、会画画、了解特定游戏等。请使用- 列表格式。】\n\n"
-                "## Rules\n"
-                "【在这里分析管理员批注和聊天记录，总结出该用户在对话中会遵守的规则。例如：从不使用句号、喜欢在句末加\"~\"、会主动规避某些话题等。请使用- 列表格式。】\n\n"
-                "## Workflows\n"
-                "【在这里描述该用户典型的行为模式或对话流程。例如：当被问到不知道的问题时，会用\"大概?\"或卖萌的方式糊弄过去。当看到有趣图片时，会回复\"kusa\"。请使用- 列表格式。】\n\n"
-                "## Init\n"
-                "【在这里综合所有信息，生成一段符合该用户口吻的开场白或自我介绍，作为该人格的初始化语句。】\n"
-                "```\n\n"
-                "--- 以下是用于分析的原始资料 ---\n\n"
-                "### 1. 用户资料:\n"
-                "{profile_info}\n\n"
-                "### 2. 管理员批注 (最高权重):\n"
-                "{admin_annotations}\n\n"
-                "### 3. 聊天记录样本 (主要参考):\n"
-                "{chat_history}\n\n"
-                "### 4. 第三方记忆 (辅助参考):\n"
-                "{third_party_memories}\n\n"
-                "--- 请现在开始填充上面的模板，并只输出填充后的完整YAML格式文本（包含```yaml标记）。 ---"
-            )
-
-            final_prompt = prompt_template.format(
-                user_id=user_id,
-                author=PLUGIN_METADATA["author"],
-                profile_info=profile_desc,
-                admin_annotations=annotations_str,
-                chat_history=history_str,
-                third_party_memories=memories_str
-            )
-            
-            yield event.request_llm(prompt=final_prompt)
+            job = await self._prepare_job(user_id, force="--force" in flags, full="--full" in flags, topic=topic)
+            if job.mode == "cached":
+                yield event.plain_result(f"用户 {user_id} 的数据自上次生成以来没有变化，直接返回缓存结果（如需重新生成请加 --force）：\n{job.persona}")
+                return
+            if job.mode == "topic":
+                if job.topic_count:
+                    yield event.plain_result(f"正在以 {job.topic_count} 条与“{topic}”相关的消息为重点，为用户 {user_id} 生成人格Prompt，请稍候...")
+                else:
+                    yield event.plain_result(f"没有找到与“{topic}”相关的消息，将按常规抽样为用户 {user_id} 生成人格Prompt，请稍候...")
+            elif job.mode == "delta":
+                yield event.plain_result(f"正在基于上次的结果与 {job.new_count} 条新消息增量更新用户 {user_id} 的人格Prompt，请稍候...（如需完整重建请加 --full）")
+            else:
+                yield event.plain_result(f"正在为用户 {user_id} 生成结构化人格Prompt，请稍候...")
+
+            provider = self.context.get_using_provider()
+            if provider is None:
+                # 无法直接调用模型时交给框架处理，此时结果不会被缓存
+                yield event.request_llm(prompt=job.prompt)
+                return
+            yield event.plain_result(await self._complete_job(job, provider))
 
+        except asyncio.TimeoutError:
+            logger.error(f"[{PLUGIN_METADATA['name']}] 为用户 {user_id} 生成超时")
+            yield event.plain_result(f"生成失败: 模型在 {self.generation_timeout:g} 秒内没有返回结果。")
         except Exception as e:
             logger.error(f"[{PLUGIN_METADATA['name']}] 正式生成失败: {e}")
             yield event.plain_result(f"生成失败: {e}")
-            
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @echo_avatar_group.command("批量生成")
+    async def batch_generate(self, event: AstrMessageEvent, *, options: str = ""):
+        """为多个用户批量生成人格Prompt。用法: /echo_avatar 批量生成 [ID ...] [--force] [--full]，不指定ID时为全部监控用户"""
+        self._start_background_tasks()
+        words = options.split()
+        flags = {word for word in words if word.startswith("--")}
+        user_ids = [word for word in words if not word.startswith("--")]
+        if not user_ids or user_ids == ["all"]:
+            user_ids = [str(user_id) for user_id in self.config.get("target_users", [])]
+        if not user_ids:
+            yield event.plain_result("没有需要生成的用户：请指定用户ID，或先在配置中添加监控用户。")
+            return
+        if self.context.get_using_provider() is None:
+            yield event.plain_result("当前没有可用的大模型提供商，无法批量生成。")
+            return
+
+        user_ids = list(dict.fromkeys(user_ids))
+        yield event.plain_result(
+            f"[{PLUGIN_METADATA['name']}]\n正在为 {len(user_ids)} 个用户批量生成人格Prompt"
+            f"（最多同时 {self.batch_concurrency} 个请求），请稍候..."
+        )
+        started = time.perf_counter()
+        results = await self.generate_personas(user_ids, force="--force" in flags, full="--full" in flags)
+        elapsed = time.perf_counter() - started
+
+        counts = {}
+        for result in results:
+            counts[result.status] = counts.get(result.status, 0) + 1
+        latencies = sorted(result.elapsed for result in results if result.status == "generated")
+        lines = [
+            f"[{PLUGIN_METADATA['name']}]",
+            f"批量生成完成：共 {len(results)} 个用户，总耗时 {elapsed:.1f} 秒",
+            f"- 已生成 {counts.get('generated', 0)} 个，数据未变化 {counts.get('unchanged', 0)} 个，"
+            f"失败 {counts.get('failed', 0) + counts.get('timeout', 0)} 个，无数据 {counts.get('missing', 0)} 个",
+        ]
+        if latencies:
+            lines.append(f"- 单个用户耗时：中位数 {latencies[len(latencies) // 2]:.1f} 秒，最长 {latencies[-1]:.1f} 秒")
+        lines.append("详情：")
+        for result in results:
+            if result.status == "generated":
+                mode = {"delta": "增量更新", "full": "完整生成"}.get(result.mode, result.mode)
+                lines.append(f"- {result.user_id}: 已生成（{mode}），{result.elapsed:.1f} 秒")
+            elif result.status == "unchanged":
+                lines.append(f"- {result.user_id}: 数据未变化，沿用上次的结果")
+            elif result.status == "missing":
+                lines.append(f"- {result.user_id}: 没有该用户的数据")
+            elif result.status == "timeout":
+                lines.append(f"- {result.user_id}: 超时（{self.generation_timeout:g} 秒内模型没有返回结果）")
+            else:
+                lines.append(f"- {result.user_id}: 失败: {result.error}")
+        if counts.get("generated") or counts.get("unchanged"):
+            lines.append("生成结果已写入缓存，可用 /echo_avatar 生成 <ID> 直接查看。")
+        yield event.plain_result("\n".join(lines))
+
+    async def generate_personas(self, user_ids: list, force: bool = False, full: bool = False) -> list:
+        """
+        批量生成多个用户的人格（供其他插件或指令调用），返回与 user_ids 顺序一致的 GenerationResult 列表。
+        各用户的数据读取并行提交到存储线程；模型调用最多同时进行 batch_concurrency 个，每次受 generation_timeout 限制。
+        数据未变化的用户直接沿用缓存结果；单个用户失败不影响其他用户，生成结果同时写入缓存。
+        """
+        await self.write_buffer.flush()
+        provider = self.context.get_using_provider()
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def _generate(user_id: str) -> GenerationResult:
+            result = GenerationResult(user_id, "failed")
+            # 耗时只计读取数据与模型调用，不含等待并发名额的时间
+            started = time.perf_counter()
+            try:
+                if not await self.store.user_exists(user_id):
+                    result.status = "missing"
+                    return result
+                job = await self._prepare_job(user_id, force=force, full=full)
+                result.mode = job.mode
+                if job.mode == "cached":
+                    result.status, result.persona = "unchanged", job.persona
+                    return result
+                if provider is None:
+                    raise RuntimeError("没有可用的大模型提供商")
+                result.elapsed = time.perf_counter() - started
+                async with semaphore:
+                    started = time.perf_counter()
+                    result.persona = await self._complete_job(job, provider)
+                result.status = "generated"
+            except asyncio.TimeoutError:
+                result.status = "timeout"
+                logger.error(f"[{PLUGIN_METADATA['name']}] 批量生成: 用户 {user_id} 超时")
+            except Exception as e:
+                result.error = str(e) or type(e).__name__
+                logger.error(f"[{PLUGIN_METADATA['name']}] 批量生成: 用户 {user_id} 失败: {result.error}")
+            finally:
+                result.elapsed += time.perf_counter() - started
+            return result
+
+        return list(await asyncio.gather(*(_generate(str(user_id)) for user_id in user_ids)))
+
+    async def _prepare_job(self, user_id: str, force: bool = False, full: bool = False, topic: str = "") -> PersonaJob:
+        """
+        读取用户数据并构造生成任务。未指定 force / full 且数据自上次生成以来没有变化时返回缓存结果；
+        有上次的结果时只把检查点之后的新消息交给模型修订；full、首次生成或关闭增量更新时完整重建。
+        聚焦话题的生成是一次性的，不读写缓存，也不影响增量更新的检查点。
+        """
+        if topic:
+            data = await self.store.load_persona_topic(user_id, self.prompt_budget, topic)
+            return PersonaJob(user_id, "topic", build_full_prompt(user_id, PLUGIN_METADATA["author"], data),
+                              topic_count=data["topic_count"])
+
+        fingerprint = await self._persona_fingerprint(user_id)
+        if not force and not full:
+            cached = await self.persona_cache.get(user_id, fingerprint)
+            if cached is not None:
+                return PersonaJob(user_id, "cached", fingerprint=fingerprint, persona=cached)
+
+        state = None if full or not self.incremental_generation else await self.persona_cache.get_state(user_id)
+        if state is not None:
+            previous_persona, checkpoint = state
+            data = await self.store.load_persona_delta(user_id, checkpoint, self.prompt_budget, self.incremental_max_messages)
+            return PersonaJob(user_id, "delta", build_delta_prompt(user_id, PLUGIN_METADATA["author"], previous_persona, data),
+                              fingerprint, data["last_chat_id"], new_count=data["new_count"])
+
+        data = await self.store.load_persona_inputs(user_id, self.prompt_budget)
+        return PersonaJob(user_id, "full", build_full_prompt(user_id, PLUGIN_METADATA["author"], data),
+                          fingerprint, data["last_chat_id"])
+
+    async def _complete_job(self, job: PersonaJob, provider) -> str:
+        """调用模型完成生成任务（超过 generation_timeout 秒抛出 asyncio.TimeoutError），写入缓存并返回结果"""
+        self.metrics.observe("prompt.chars", len(job.prompt))
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(provider.text_chat(prompt=job.prompt), timeout=self.generation_timeout or None)
+        except asyncio.TimeoutError:
+            self.metrics.incr("llm.timeout")
+            raise
+        except Exception:
+            self.metrics.incr("llm.error")
+            raise
+        self.metrics.observe("llm.request", (time.perf_counter() - started) * 1000)
+        persona = (response.completion_text or "").strip()
+        if not persona:
+            raise ValueError("模型没有返回内容。")
+        if job.fingerprint is not None:
+            await self.persona_cache.put(job.user_id, job.fingerprint, persona, job.last_chat_id)
+        return persona
+
+    async def _persona_fingerprint(self, user_id: str) -> str:
+        """用户生成输入的指纹：各表最大 id 与行数、昵称，以及 Prompt 模板摘要与抽样预算"""
+        version = await self.store.load_data_version(user_id)
+        await self.store.catalog_ready()
+        stats = self.store.catalog.get(user_id)
+        return compute_fingerprint(
+            template=PERSONA_TEMPLATE_HASH,
+            budget=self.prompt_budget,
+            counts=(stats.message_count, stats.annotation_count, stats.memory_count) if stats else None,
+            **version,
+        )
+
     @filter.permission_type(filter.PermissionType.ADMIN)
     @echo_avatar_group.command("清理数据")
     async def clear_user_data(self, event: AstrMessageEvent, user_id: str):
         """一键清理选定用户的所有数据"""
-        db_path = get_user_db_path(user_id)
-        if not db_path.exists():
-            yield event.plain_result(f"未找到用户 {user_id} 的数据记录，无需清理。")
-            return
+        self._start_background_tasks()
+        # 先将缓冲区中尚未落库的消息写入，避免清理后又被写回
+        await self.write_buffer.flush()
         try:
-            db_path.unlink()
-            logger.info(f"[{PLUGIN_METADATA['name']}] 已成功删除用户 {user_id} 的数据文件: {db_path}")
+            deleted = await self.store.delete_user(user_id)
+            await self.persona_cache.delete(user_id)
+            await self.render_cache.invalidate(user_id)
+            if not deleted:
+                yield event.plain_result(f"未找到用户 {user_id} 的数据记录，无需清理。")
+                return
+            logger.info(f"[{PLUGIN_METADATA['name']}] 已成功删除用户 {user_id} 的数据: {self.store.db_path(user_id)}")
             yield event.plain_result(f"[{PLUGIN_METADATA['name']}]\n已成功清理用户 {user_id} 的所有数据。")
         except Exception as e:
             logger.error(f"[{PLUGIN_METADATA['name']}] 清理用户 {user_id} 数据失败: {e}")
@@ -464,4 +791,10 @@ class EchoAvatarPlugin(Star):
 
     async def terminate(self):
         """插件卸载/停用时调用"""
+        await self.write_buffer.close()
+        await self.maintenance.close()
+        await self.metrics_dumper.close()
+        await self.store.close()
+        await self.persona_cache.close()
+        await self.render_cache.close()
         logger.info(f"[{PLUGIN_METADATA['name']}] 插件已卸载。")
\ No newline at end of file
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+插件运行时的性能指标。
+
+- 计数器 (incr): 例如接收/过滤的消息数、超时次数；
+- 直方图 (observe / timer): 耗时（毫秒）或大小（字符数）的分布，按 1-2-5 序列的固定区间计数，
+  同时记录总数、总和与最值，分位数由区间插值估算，内存占用与样本数无关。
+
+记录操作只在锁内做几次加法，可以在事件循环与数据库线程中直接调用。
+指标由“性能”指令展示，也可以由 storage.MetricsDumper 定期写入 JSON 文件。
+本模块只包含纯计算逻辑，不依赖插件的其他部分。
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# 直方图区间上界：0.1 ~ 5e7 的 1-2-5 序列，最后一个区间收纳更大的值
+BUCKET_BOUNDS = tuple(m * 10 ** e for e in range(-1, 8) for m in (1, 2, 5))
+
+
+class Histogram:
+    __slots__ = ("buckets", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value: float):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+
+    def quantile(self, q: float) -> float:
+        """按区间线性插值估算分位数，结果限制在实际最值之间"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                low = BUCKET_BOUNDS[index - 1] if index else 0.0
+                high = BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max
+                value = low + (high - low) * (rank - seen) / n
+                return min(max(value, self.min), self.max)
+            seen += n
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "min": round(self.min, 3) if self.count else None,
+            "max": round(self.max, 3) if self.count else None,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 3),
+            "p90": round(self.quantile(0.9), 3),
+            "p99": round(self.quantile(0.99), 3),
+            # 只输出非空区间，键为区间上界
+            "buckets": {
+                (str(BUCKET_BOUNDS[i]) if i < len(BUCKET_BOUNDS) else "+Inf"): n
+                for i, n in enumerate(self.buckets) if n
+            },
+        }
+
+
+class Metrics:
+    """线程安全的计数器与直方图集合，按名称自动创建"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started_at = time.time()
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """把代码块的耗时（毫秒）记录到直方图 name，代码块抛出异常时同样记录"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def counter(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def histogram(self, name: str) -> dict:
+        """直方图的快照，未记录过时为 None"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            return histogram.snapshot() if histogram else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "started_at": int(self.started_at),
+                "uptime": round(time.time() - self.started_at, 1),
+                "counters": dict(sorted(self._counters.items())),
+                "histograms": {name: h.snapshot() for name, h in sorted(self._histograms.items())},
+            }
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+仿言分身的人格 Prompt 组装与生成结果缓存。
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from .storage import configure_connection, migrate
+from .style import format_summary
+
+# --- Prompt 模板 ---
+PROMPT_TEMPLATE = (
+    "你是一个专业的AI人格档案工程师。你的任务是基于提供的多维度资料，为一个名为 '{user_id}' 的用户生成一个结构化的YAML格式的人格设定档案。\n"
+    "请严格按照以下格式输出，并根据提供的资料填充【】中的内容，如果某项没有足够信息支撑，请填写\"暂无\"或基于已有信息进行合理推断。\n\n"
+    "```yaml\n"
+    "## Profile\n"
+    "- author: {author}\n"
+    "- version: 1.0.0\n"
+    "- language: Chinese\n"
+    "- description: 【在这里根据用户的整体风格，用一句话简短描述其人格特征】\n\n"
+    "## Skills\n"
+    "【在这里分析用户的聊天记录和第三方记忆，总结出该用户的技能或特长。例如：擅长使用颜文字、会画画、了解特定游戏等。请使用- 列表格式。】\n\n"
+    "## Rules\n"
+    "【在这里分析管理员批注和聊天记录，总结出该用户在对话中会遵守的规则。例如：从不使用句号、喜欢在句末加\"~\"、会主动规避某些话题等。请使用- 列表格式。】\n\n"
+    "## Workflows\n"
+    "【在这里描述该用户典型的行为模式或对话流程。例如：当被问到不知道的问题时，会用\"大概?\"或卖萌的方式糊弄过去。当看到有趣图片时，会回复\"kusa\"。请使用- 列表格式。】\n\n"
+    "## Init\n"
+    "【在这里综合所有信息，生成一段符合该用户口吻的开场白或自我介绍，作为该人格的初始化语句。】\n"
+    "```\n\n"
+    "--- 以下是用于分析的原始资料 ---\n\n"
+    "### 1. 用户资料:\n"
+    "{profile_info}\n\n"
+    "### 2. 管理员批注 (最高权重):\n"
+    "{admin_annotations}\n\n"
+    "### 3. 聊天记录样本 (主要参考{topic_note}):\n"
+    "{chat_history}\n\n"
+    "### 4. 第三方记忆 (辅助参考):\n"
+    "{third_party_memories}\n\n"
+    "### 5. 风格统计 (基于该用户的全部聊天记录，用于校准聊天记录样本中体现的用语习惯):\n"
+    "{style_summary}\n\n"
+    "--- 请现在开始填充上面的模板，并只输出填充后的完整YAML格式文本（包含```yaml标记）。 ---"
+)
+
+# 增量更新模板：只提供上次的档案与检查点之后的新消息，由模型在原档案基础上修订
+DELTA_PROMPT_TEMPLATE = (
+    "你是一个专业的AI人格档案工程师。下面是你之前为用户 '{user_id}' 生成的YAML格式人格设定档案，以及该用户自那以后新增的聊天记录。\n"
+    "请基于新资料对档案进行增量修订：保留仍然成立的内容，补充新体现出的技能、规则和行为模式，修正与新资料矛盾的描述。\n"
+    "管理员批注拥有最高权重，档案中与之冲突的内容必须按批注修正；第三方记忆仅作辅助参考。\n"
+    "保持原有的结构与格式不变，author 保持为 {author}。\n\n"
+    "--- 上次生成的档案 ---\n\n"
+    "{previous_persona}\n\n"
+    "--- 以下是用于修订的资料 ---\n\n"
+    "### 1. 用户资料:\n"
+    "{profile_info}\n\n"
+    "### 2. 管理员批注 (最高权重):\n"
+    "{admin_annotations}\n\n"
+    "### 3. 新增聊天记录 (共 {new_count} 条，以下为去重后抽样的 {sample_count} 条):\n"
+    "{chat_history}\n\n"
+    "### 4. 第三方记忆 (辅助参考):\n"
+    "{third_party_memories}\n\n"
+    "### 5. 风格统计 (基于该用户的全部聊天记录):\n"
+    "{style_summary}\n\n"
+    "--- 请现在输出修订后的完整YAML格式文本（包含```yaml标记）。 ---"
+)
+
+
+def template_hash(*templates: str) -> str:
+    """模板内容的摘要，模板改动后旧的缓存结果自动失效"""
+    return hashlib.sha256("\x00".join(templates).encode("utf-8")).hexdigest()[:16]
+
+
+def _format_sections(data: dict) -> dict:
+    """把资料、批注、记忆、聊天记录和风格统计格式化为模板中对应的段落"""
+    return {
+        # 1. 资料
+        "profile_info": f"用户的昵称是\"{data['nickname']}\"" if data["nickname"] else "用户未设置昵称。",
+        # 2. 管理员批注
+        "admin_annotations": "\n".join([f"- {text}" for text in data["annotations"]]) or "无",
+        # 3. 第三方记忆
+        "third_party_memories": "\n".join([f"- {text}" for text in data["memories"]]) or "无",
+        # 4. 聊天记录
+        "chat_history": "\n".join([f'"{message}"' for message in data["history"]]) or "无",
+        # 5. 风格统计
+        "style_summary": format_summary(data.get("style", {})),
+        # 聚焦话题时说明样本的构成（见 EchoStore.load_persona_topic）
+        "topic_note": (
+            f"；其中前 {data['topic_count']} 条是与话题“{data['topic']}”最相关的消息，请在档案中着重体现该用户在这一话题上的观点与表达方式"
+            if data.get("topic_count") else ""
+        ),
+    }
+
+
+def build_full_prompt(user_id: str, author: str, data: dict) -> str:
+    """用资料、批注、记忆和聊天记录样本填充完整生成模板"""
+    return PROMPT_TEMPLATE.format(user_id=user_id, author=author, **_format_sections(data))
+
+
+def build_delta_prompt(user_id: str, author: str, previous_persona: str, data: dict) -> str:
+    """用上次的档案和检查点之后的新数据（见 EchoStore.load_persona_delta）填充增量更新模板"""
+    return DELTA_PROMPT_TEMPLATE.format(
+        user_id=user_id,
+        author=author,
+        previous_persona=previous_persona,
+        new_count=data["new_count"],
+        sample_count=len(data["history"]),
+        **_format_sections(data),
+    )
+
+
+def compute_fingerprint(**parts) -> str:
+    """
+    生成输入数据的指纹。parts 应能唯一刻画生成所用的全部输入，
+    例如各表的最大 id 与行数、昵称、模板摘要；任一项变化都会得到不同的指纹。
+    """
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# --- 生成任务 ---
+@dataclass
+class PersonaJob:
+    """
+    一个用户的生成任务，由插件在读取数据后构造。
+    mode 为 "cached"（数据未变化，persona 即缓存结果）、"delta"（增量更新）、"full"（完整生成）或 "topic"（聚焦话题）；
+    fingerprint 为 None 时生成结果不写入缓存。
+    """
+
+    user_id: str
+    mode: str
+    prompt: str = ""
+    fingerprint: str = None
+    last_chat_id: int = None
+    persona: str = None
+    new_count: int = 0
+    topic_count: int = 0
+
+
+@dataclass
+class GenerationResult:
+    """
+    批量生成中单个用户的结果。status 为 "generated"、"unchanged"（数据未变化，沿用缓存）、
+    "missing"（没有该用户的数据）、"timeout" 或 "failed"；elapsed 为该用户从读取数据到得到结果的秒数。
+    """
+
+    user_id: str
+    status: str
+    mode: str = ""
+    persona: str = ""
+    error: str = ""
+    elapsed: float = 0.0
+
+
+# --- 生成结果缓存 ---
+def _cache_v1(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS persona_cache (
+            user_id TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            persona TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            -- 增量更新的检查点：生成该结果时已处理到的最大聊天记录 id
+            last_chat_id INTEGER
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_persona_cache_created_at ON persona_cache (created_at)")
+
+
+PERSONA_CACHE_MIGRATIONS = [
+    (1, _cache_v1),
+]
+
+
+class PersonaCache:
+    """
+    人格生成结果缓存，保存在 persona_cache.db 中，每个用户只保留最近一次的结果及其聊天记录检查点。
+    命中条件是输入指纹完全一致；指纹不一致时，结果与检查点仍可作为增量更新的起点（见 get_state）。
+    超过 ttl_days 天或超出 max_entries 条的旧结果会在写入时淘汰。
+    所有数据库操作都在专用线程中执行。
+    """
+
+    def __init__(self, db_path: Path, ttl_days: float = 30, max_entries: int = 500):
+        self.db_path = db_path
+        self.ttl_seconds = max(float(ttl_days), 0) * 86400
+        self.max_entries = max(int(max_entries), 1)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="echo_avatar_persona")
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path)
+            configure_connection(self._conn)
+            migrate(self._conn, PERSONA_CACHE_MIGRATIONS)
+        return self._conn
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _get_sync(self, user_id: str, fingerprint: str):
+        row = self._db().execute(
+            "SELECT persona, created_at FROM persona_cache WHERE user_id = ? AND fingerprint = ?",
+            (user_id, fingerprint),
+        ).fetchone()
+        if row is None or (self.ttl_seconds and row[1] < time.time() - self.ttl_seconds):
+            return None
+        return row[0]
+
+    def _get_state_sync(self, user_id: str):
+        row = self._db().execute(
+            "SELECT persona, last_chat_id, created_at FROM persona_cache WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+        if row is None or row[1] is None or (self.ttl_seconds and row[2] < time.time() - self.ttl_seconds):
+            return None
+        return row[0], row[1]
+
+    def _put_sync(self, user_id: str, fingerprint: str, persona: str, last_chat_id):
+        conn = self._db()
+        now = int(time.time())
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO persona_cache (user_id, fingerprint, persona, created_at, last_chat_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, fingerprint, persona, now, last_chat_id),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: int):
+        if self.ttl_seconds:
+            conn.execute("DELETE FROM persona_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        conn.execute(
+            "DELETE FROM persona_cache WHERE user_id NOT IN "
+            "(SELECT user_id FROM persona_cache ORDER BY created_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def _delete_sync(self, user_id: str):
+        with self._db() as conn:
+            conn.execute("DELETE FROM persona_cache WHERE user_id = ?", (user_id,))
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def get(self, user_id: str, fingerprint: str):
+        """返回指纹匹配且未过期的缓存结果，没有则返回 None"""
+        return await self._run(self._get_sync, user_id, fingerprint)
+
+    async def get_state(self, user_id: str):
+        """返回该用户上次的生成结果与检查点 (persona, last_chat_id)，不校验指纹；没有可用结果时返回 None"""
+        return await self._run(self._get_state_sync, user_id)
+
+    async def put(self, user_id: str, fingerprint: str, persona: str, last_chat_id: int = None):
+        """保存生成结果与检查点（覆盖该用户之前的结果），并淘汰过期条目"""
+        await self._run(self._put_sync, user_id, fingerprint, persona, last_chat_id)
+
+    async def delete(self, user_id: str):
+        await self._run(self._delete_sync, user_id)
+
+    async def close(self):
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+数据预览图片的磁盘缓存。
+
+每个用户只保留最近一次渲染的图片，文件名由用户 ID 的摘要与数据版本键组成；
+用户数据发生任何写入后版本键随之改变，旧图片不会再被返回，并在下次渲染时被替换。
+缓存目录的总大小超过上限时，按最近使用时间淘汰最久未使用的图片。
+"""
+
+import asyncio
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .storage import LOG_TAG, logger
+
+
+def _user_prefix(user_id: str) -> str:
+    # 用户 ID 可能包含不能用于文件名的字符
+    return hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:16]
+
+
+class RenderCache:
+    """
+    预览图片的 LRU 磁盘缓存，文件保存在 cache_dir 下，总大小不超过 max_bytes（为 0 时不缓存）。
+    索引在首次使用时按文件修改时间从目录重建；所有文件操作都在专用线程中执行。
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max(int(max_bytes), 0)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="echo_avatar_render")
+        # 文件名 -> 字节数，按最近使用时间从旧到新排列
+        self._entries = None
+        self._total = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _index(self) -> OrderedDict:
+        if self._entries is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            files = sorted((f for f in self.cache_dir.iterdir() if f.is_file()), key=lambda f: f.stat().st_mtime)
+            self._entries = OrderedDict((f.name, f.stat().st_size) for f in files)
+            self._total = sum(self._entries.values())
+        return self._entries
+
+    def _remove(self, name: str):
+        self._total -= self._entries.pop(name, 0)
+        (self.cache_dir / name).unlink(missing_ok=True)
+
+    def _get_sync(self, user_id: str, key: str):
+        entries = self._index()
+        prefix = f"{_user_prefix(user_id)}_{key}"
+        for name in entries:
+            if name.startswith(prefix):
+                path = self.cache_dir / name
+                if not path.exists():
+                    self._remove(name)
+                    return None
+                entries.move_to_end(name)
+                os.utime(path)
+                return str(path.resolve())
+        return None
+
+    def _put_sync(self, user_id: str, key: str, source: str) -> str:
+        entries = self._index()
+        user_prefix = f"{_user_prefix(user_id)}_"
+        for name in [name for name in entries if name.startswith(user_prefix)]:
+            self._remove(name)
+
+        name = f"{user_prefix}{key}{Path(source).suffix or '.png'}"
+        path = self.cache_dir / name
+        shutil.copyfile(source, path)
+        size = path.stat().st_size
+        entries[name] = size
+        self._total += size
+        while self._total > self.max_bytes and len(entries) > 1:
+            self._remove(next(iter(entries)))
+        return str(path.resolve())
+
+    def _invalidate_sync(self, user_id: str):
+        user_prefix = f"{_user_prefix(user_id)}_"
+        for name in [name for name in self._index() if name.startswith(user_prefix)]:
+            self._remove(name)
+
+    async def get(self, user_id: str, key: str):
+        """返回与版本键匹配的缓存图片路径，没有则返回 None"""
+        if not self.enabled:
+            return None
+        try:
+            return await self._run(self._get_sync, user_id, key)
+        except OSError as e:
+            logger.warning(f"{LOG_TAG} 读取预览图片缓存失败: {e}")
+            return None
+
+    async def put(self, user_id: str, key: str, source: str) -> str:
+        """把渲染得到的图片复制进缓存（替换该用户的旧图片），返回缓存中的路径；失败时返回原路径"""
+        if not self.enabled:
+            return source
+        try:
+            return await self._run(self._put_sync, user_id, key, source)
+        except OSError as e:
+            logger.warning(f"{LOG_TAG} 写入预览图片缓存失败: {e}")
+            return source
+
+    async def invalidate(self, user_id: str):
+        """删除该用户的缓存图片"""
+        if self.enabled:
+            await self._run(self._invalidate_sync, user_id)
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
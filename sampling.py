@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+组装人格 Prompt 时的资料抽样。
+
+聊天记录、批注与记忆在进入 Prompt 之前都要经过这里：
+去除完全重复与近似重复（字符 shingle + MinHash）的条目，截断过长的单条内容，
+再在给定的字符/token 预算内挑选条目。聊天记录会在整个历史范围内均匀取样，
+无论数据库有多大，Prompt 的体积都有上限。
+
+本模块只包含纯计算逻辑，由存储线程在读取数据后直接调用，不占用事件循环。
+"""
+
+import re
+import zlib
+from dataclasses import dataclass
+
+# MinHash 参数：16 个哈希函数分成 4 段，每段 4 个；签名有一段完全相同即视为候选，再按估计的相似度确认
+MINHASH_PERMUTATIONS = 16
+MINHASH_BANDS = 4
+SHINGLE_SIZE = 3
+_MERSENNE_PRIME = (1 << 61) - 1
+_MINHASH_SEEDS = [
+    ((i * 0x9E3779B97F4A7C15 + 0x632BE59BD9B4E019) % _MERSENNE_PRIME | 1,
+     (i * 0xC2B2AE3D27D4EB4F + 0x165667B19E3779F9) % _MERSENNE_PRIME)
+    for i in range(1, MINHASH_PERMUTATIONS + 1)
+]
+
+_WHITESPACE = re.compile(r"\s+")
+_REPEATED_CHAR = re.compile(r"(.)\1{2,}")
+_CJK_CHAR = re.compile(r"[぀-ヿ㐀-鿿가-힯豈-﫿]")
+TRUNCATION_MARK = "…"
+
+
+@dataclass(frozen=True)
+class PromptBudget:
+    """
+    Prompt 资料预算。
+    - history: 聊天记录段的总预算；notes: 批注段与记忆段各自的预算；
+    - unit: 预算单位，"chars" 按字符数，"tokens" 按估算的 token 数；
+    - max_item_chars: 单条内容的最大字符数，超出部分截断；
+    - pool / buckets: 从数据库读取的聊天记录候选条数，以及按 id 均分成的区间数；
+    - similarity: 两条消息的估计 Jaccard 相似度达到该值即视为近似重复。
+    """
+
+    history: int = 6000
+    notes: int = 2000
+    unit: str = "chars"
+    max_item_chars: int = 300
+    pool: int = 1000
+    buckets: int = 20
+    similarity: float = 0.8
+
+    @classmethod
+    def from_config(cls, config) -> "PromptBudget":
+        return cls(
+            history=max(int(config.get("prompt_history_budget", cls.history)), 1),
+            notes=max(int(config.get("prompt_notes_budget", cls.notes)), 1),
+            unit="tokens" if config.get("prompt_budget_unit", cls.unit) == "tokens" else "chars",
+            max_item_chars=max(int(config.get("prompt_max_item_chars", cls.max_item_chars)), 10),
+            pool=max(int(config.get("prompt_sample_pool", cls.pool)), 1),
+        )
+
+    def cost(self, text: str) -> int:
+        return estimate_tokens(text) if self.unit == "tokens" else len(text)
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符每字约 1 个 token，其余字符约 4 个字符 1 个 token"""
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def normalize(text: str) -> str:
+    """用于比较重复的规范形式：小写、合并空白、把连续重复的字符压缩为两个（"哈哈哈哈" 与 "哈哈哈" 视为相同）"""
+    text = _WHITESPACE.sub(" ", text.strip().lower())
+    return _REPEATED_CHAR.sub(r"\1\1", text)
+
+
+def truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars - len(TRUNCATION_MARK)] + TRUNCATION_MARK
+
+
+def minhash_signature(text: str) -> tuple:
+    """按字符 shingle 计算 MinHash 签名；中文消息没有空格分词，因此使用字符级 shingle"""
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _MINHASH_SEEDS
+    )
+
+
+def dedupe(items: list, max_chars: int, similarity: float = 0.8) -> list:
+    """
+    去除完全重复与近似重复的条目，保留每组中最先出现的一条。
+    items 为 [(key, text), ...]，按 max_chars 截断后的文本参与比较；返回保留下来的 [(key, text), ...]。
+    """
+    rows_per_band = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    seen = set()
+    bands = [{} for _ in range(MINHASH_BANDS)]
+    kept = []
+    for key, text in items:
+        text = truncate(text, max_chars)
+        norm = normalize(text)
+        if not norm or norm in seen:
+            continue
+        seen.add(norm)
+
+        signature = minhash_signature(norm)
+        duplicate = False
+        for band, index in zip(range(0, MINHASH_PERMUTATIONS, rows_per_band), bands):
+            for other in index.get(signature[band:band + rows_per_band], ()):
+                agree = sum(1 for x, y in zip(signature, other) if x == y)
+                if agree / MINHASH_PERMUTATIONS >= similarity:
+                    duplicate = True
+                    break
+            if duplicate:
+                break
+        if duplicate:
+            continue
+
+        for band, index in zip(range(0, MINHASH_PERMUTATIONS, rows_per_band), bands):
+            index.setdefault(signature[band:band + rows_per_band], []).append(signature)
+        kept.append((key, text))
+    return kept
+
+
+def select_spread(items: list, budget: PromptBudget, buckets: int = None) -> list:
+    """
+    在聊天记录预算内均匀挑选条目。items 为按 id 升序的 [(id, text), ...]（已去重、截断）。
+    条目按顺序均分为若干区间，从最新的区间开始轮流从每个区间取一条，直到预算用完；返回按 id 升序的文本列表。
+    """
+    total = sum(budget.cost(text) for _, text in items)
+    if total <= budget.history:
+        return [text for _, text in items]
+
+    # 预算只够放下少量条目时相应减少区间数，保证最早的区间也能分到名额
+    fit = int(budget.history * len(items) / total)
+    buckets = max(1, min(buckets or budget.buckets, fit, len(items)))
+    size = -(-len(items) // buckets)
+    groups = [items[i:i + size] for i in range(0, len(items), size)]
+    # 区间内从最新的消息开始取
+    queues = [list(reversed(group)) for group in reversed(groups)]
+
+    remaining = budget.history
+    chosen = []
+    while queues and remaining > 0:
+        next_round = []
+        for queue in queues:
+            key, text = queue.pop(0)
+            cost = budget.cost(text)
+            if cost <= remaining:
+                chosen.append((key, text))
+                remaining -= cost
+            if queue:
+                next_round.append(queue)
+        queues = next_round
+    chosen.sort(key=lambda item: item[0])
+    return [text for _, text in chosen]
+
+
+def select_ranked(rows: list, budget: PromptBudget) -> list:
+    """按相关度挑选聊天记录：rows 为按相关度降序的 [(id, message), ...]，去重、截断后依次取到预算用完，返回按 id 升序的 [(id, text), ...]"""
+    remaining = budget.history
+    chosen = []
+    for key, text in dedupe(rows, budget.max_item_chars, budget.similarity):
+        cost = budget.cost(text)
+        if cost <= remaining:
+            chosen.append((key, text))
+            remaining -= cost
+    chosen.sort(key=lambda item: item[0])
+    return chosen
+
+
+def select_notes(texts: list, budget: PromptBudget) -> list:
+    """批注与记忆的预算：去重、截断后从最新的一条往前取，直到预算用完；返回按原顺序排列的文本"""
+    kept = dedupe(list(enumerate(texts)), budget.max_item_chars, budget.similarity)
+    remaining = budget.notes
+    chosen = []
+    for key, text in reversed(kept):
+        cost = budget.cost(text)
+        if cost <= remaining:
+            chosen.append(text)
+            remaining -= cost
+    chosen.reverse()
+    return chosen
+
+
+def sample_history(rows: list, budget: PromptBudget) -> list:
+    """聊天记录抽样：rows 为按 id 升序的 [(id, message), ...] 候选，返回在预算内的文本列表"""
+    return select_spread(dedupe(rows, budget.max_item_chars, budget.similarity), budget)
@@ -0,0 +1,1591 @@
+# -*- coding: utf-8 -*-
+"""
+仿言分身的存储层。
+
+所有 SQLite 读写都在专用的数据库线程中执行，事件循环只 await 结果。
+数据库线程划分为若干条“通道”(lane)：同一个数据库文件的所有操作总是落在同一条单线程通道上，
+从而在并行处理不同用户的同时，保证单个用户的写入顺序。
+
+支持两种存储布局：
+- per_user（默认）：每个用户一个数据库文件 user_data/<用户ID>.db；
+- sharded：按用户 ID 的哈希值把用户分配到固定数量的分片数据库 shards/shard_XXX.db，
+  各表额外带 user_id 列。两种布局之间可以用 cli.py 离线互相转换。
+"""
+
+import asyncio
+import functools
+import json
+import lzma
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+from .metrics import Metrics
+from .sampling import PromptBudget, sample_history, select_notes, select_ranked
+from .style import SUMMARY_TOP, features_for_rows
+
+try:
+    from astrbot.api import logger
+except ImportError:  # 离线工具 (cli.py) 在没有 AstrBot 的环境中运行
+    import logging
+    logger = logging.getLogger("echo_avatar")
+
+LOG_TAG = "[仿言分身 (Echo Avatar)]"
+
+# 保存用户数据的全部表
+USER_TABLES = ("profile", "chat_history", "admin_annotations", "third_party_memories", "style_features", "chat_archive")
+
+
+# --- 数据库结构与迁移 ---
+# 数据库的结构版本记录在 PRAGMA user_version 中，打开时依次执行尚未应用的迁移步骤。
+# 每个步骤都接收 scoped 参数：分片数据库 (scoped=True) 中的各表额外带 user_id 列。
+def _user_db_v1(conn: sqlite3.Connection, scoped: bool):
+    """v1: 插件最初的四张表。使用 IF NOT EXISTS，对旧版本创建的数据库是空操作。"""
+    user_col = "user_id TEXT NOT NULL," if scoped else ""
+
+    # 聊天记录表
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        )""")
+
+    # 用户资料表
+    if scoped:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS profile (
+                user_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                PRIMARY KEY (user_id, key)
+            )""")
+    else:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS profile (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )""")
+
+    # 管理员批注表
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS admin_annotations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {user_col}
+            text TEXT NOT NULL,
+            added_by TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        )""")
+
+    # 第三方记忆表
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS third_party_memories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {user_col}
+            text TEXT NOT NULL,
+            added_by TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        )""")
+
+
+def _user_db_v2(conn: sqlite3.Connection, scoped: bool):
+    """
+    v2: 去掉 chat_history 中冗余的 user_id 列（文件本身已按用户区分），并为各表的时间戳建立索引。
+    分片数据库保留 user_id 列，索引以 (user_id, timestamp) 建立，并额外以 (user_id, id) 建立索引。
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(chat_history)")]
+    if not scoped and "user_id" in columns:
+        # 通过重建表来删除列，兼容不支持 DROP COLUMN 的旧版 SQLite；保留原有 id
+        conn.execute("""
+            CREATE TABLE chat_history_v2 (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message TEXT NOT NULL,
+                timestamp INTEGER NOT NULL
+            )""")
+        conn.execute("INSERT INTO chat_history_v2 (id, message, timestamp) SELECT id, message, timestamp FROM chat_history")
+        conn.execute("DROP TABLE chat_history")
+        conn.execute("ALTER TABLE chat_history_v2 RENAME TO chat_history")
+
+    key = "user_id, timestamp" if scoped else "timestamp"
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history ({key})")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_admin_annotations_timestamp ON admin_annotations ({key})")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_third_party_memories_timestamp ON third_party_memories ({key})")
+    if scoped:
+        # 分片中按 id 游标读取单个用户的数据（抽样、增量、导出、归档），需要 (user_id, id) 索引才能按主键范围扫描
+        for table in ("chat_history", "admin_annotations", "third_party_memories"):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table} (user_id, id)")
+
+
+def _user_db_v3(conn: sqlite3.Connection, scoped: bool):
+    """v3: 新增聊天风格特征表 style_features（见 style.py），并由已有的聊天记录回填"""
+    key = "user_id, kind, feature" if scoped else "kind, feature"
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS style_features (
+            {"user_id TEXT NOT NULL," if scoped else ""}
+            kind TEXT NOT NULL,
+            feature TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ({key})
+        ) WITHOUT ROWID""")
+
+    columns = "user_id, message, timestamp" if scoped else "'', message, timestamp"
+    cursor = conn.execute(f"SELECT {columns} FROM chat_history ORDER BY {'user_id, ' if scoped else ''}id")
+    while True:
+        batch = cursor.fetchmany(5000)
+        if not batch:
+            break
+        by_user = {}
+        for user_id, message, timestamp in batch:
+            by_user.setdefault(user_id, []).append((message, timestamp))
+        for user_id, rows in by_user.items():
+            _add_style_counts(conn, UserScope(user_id, scoped), features_for_rows(rows))
+
+
+def _add_style_counts(conn: sqlite3.Connection, scope: "UserScope", counts):
+    """把 {(kind, feature): count} 累加到 style_features 表"""
+    conflict = "user_id, kind, feature" if scope.scoped else "kind, feature"
+    conn.executemany(
+        f"INSERT INTO style_features ({scope.columns('kind, feature, count')}) VALUES ({scope.marks(3)}) "
+        f"ON CONFLICT ({conflict}) DO UPDATE SET count = count + excluded.count",
+        [scope.row(kind, feature, count) for (kind, feature), count in counts.items()],
+    )
+
+
+def _user_db_v4(conn: sqlite3.Connection, scoped: bool):
+    """v4: 新增聊天记录归档表 chat_archive，每行是一段按 id 排序、经过压缩的旧聊天记录"""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS chat_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {"user_id TEXT NOT NULL," if scoped else ""}
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            payload BLOB NOT NULL
+        )""")
+    key = "user_id, last_id" if scoped else "last_id"
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_chat_archive_last_id ON chat_archive ({key})")
+
+
+# 建立全文索引的表及其文本列
+FTS_COLUMNS = {"chat_history": "message", "admin_annotations": "text", "third_party_memories": "text"}
+# 连续的中日韩文字；unicode61 分词器会把整段当作一个词，因此先切成相邻的二元组 (bigram)
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+
+
+def fts_grams(text: str) -> str:
+    """
+    全文索引实际收录的文本：每段中日韩文字展开为以空格分隔的相邻二元组（单字保持不变），其余部分原样保留。
+    例如 "今天抽卡ok" -> "今天 天抽 抽卡 ok"，两个字的词即可通过索引匹配。
+    """
+    parts = []
+    pos = 0
+    for match in _CJK_RUN.finditer(text):
+        run = match.group()
+        parts.append(text[pos:match.start()])
+        parts.append(" ".join(run[i:i + 2] for i in range(max(len(run) - 1, 1))))
+        pos = match.end()
+    parts.append(text[pos:])
+    return " ".join(part for part in parts if part)
+
+
+def _fts_supported(conn: sqlite3.Connection) -> bool:
+    """SQLite 是否编译了 FTS5"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp._fts_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _user_db_v5(conn: sqlite3.Connection, scoped: bool):
+    """
+    v5: 为聊天记录、批注与记忆建立 FTS5 全文索引（<表名>_fts），并由已有数据回填。
+    unicode61 分词器会把一整段中文当作一个词，因此各表新增 search_text 列，由写入方保存 fts_grams() 展开的文本，
+    索引以原表为外部内容 (content=) 收录该列，由触发器与原表保持同步。
+    触发器只使用 SQLite 内置函数，其他工具（sqlite3 命令行、数据库浏览器等）也能正常写入这些表；
+    它们写入的行 search_text 为空，索引改为收录原文，英文仍可检索，中文词需整段匹配。
+    SQLite 不支持 FTS5 时只添加列，搜索退回 LIKE 扫描。
+    """
+    for table, column in FTS_COLUMNS.items():
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN search_text TEXT")
+        cursor = conn.execute(f"SELECT id, {column} FROM {table}")
+        while True:
+            batch = cursor.fetchmany(5000)
+            if not batch:
+                break
+            conn.executemany(f"UPDATE {table} SET search_text = ? WHERE id = ?", [(fts_grams(text), row_id) for row_id, text in batch])
+    if not _fts_supported(conn):
+        logger.warning(f"{LOG_TAG} 当前 SQLite 不支持 FTS5，搜索将使用较慢的全表扫描。")
+        return
+    for table, column in FTS_COLUMNS.items():
+        fts = f"{table}_fts"
+        conn.execute(
+            f"CREATE VIRTUAL TABLE {fts} USING fts5("
+            f"search_text, content = '{table}', content_rowid = 'id', tokenize = 'unicode61')"
+        )
+        conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+        old = f"COALESCE(old.search_text, old.{column})"
+        new = f"COALESCE(new.search_text, new.{column})"
+        delete = f"INSERT INTO {fts} ({fts}, rowid, search_text) VALUES ('delete', old.id, {old});"
+        insert = f"INSERT INTO {fts} (rowid, search_text) VALUES (new.id, {new});"
+        conn.execute(f"CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert} END")
+        conn.execute(f"CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete} END")
+        conn.execute(
+            f"CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {column}, search_text ON {table} BEGIN {delete} {insert} END"
+        )
+
+
+USER_DB_MIGRATIONS = [
+    (1, _user_db_v1),
+    (2, _user_db_v2),
+    (3, _user_db_v3),
+    (4, _user_db_v4),
+    (5, _user_db_v5),
+]
+
+
+def migrate(conn: sqlite3.Connection, migrations: list, *args) -> int:
+    """
+    将数据库升级到最新结构版本，返回升级后的版本号。args 会原样传给每个迁移步骤。
+    每个迁移步骤与版本号更新在同一个事务中提交，中途失败会整体回滚，下次打开时重试。
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, step in migrations:
+        if version >= target:
+            continue
+        conn.execute("BEGIN")
+        try:
+            step(conn, *args)
+            conn.execute(f"PRAGMA user_version = {int(target)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = target
+    return version
+
+
+def configure_connection(conn: sqlite3.Connection):
+    """为新打开的连接设置 WAL 日志与同步级别"""
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = 5000")
+
+
+def init_user_db(conn: sqlite3.Connection, scoped: bool):
+    """初始化新打开的用户/分片数据库连接：新建的数据库启用增量 auto_vacuum，设置连接参数并迁移到最新结构"""
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+        # auto_vacuum 只能在建表和切换 WAL 之前设置；旧数据库由维护任务在第一次 VACUUM 时切换
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    configure_connection(conn)
+    migrate(conn, USER_DB_MIGRATIONS, scoped)
+
+
+def open_user_db(db_path: Path, scoped: bool) -> sqlite3.Connection:
+    """打开（必要时创建并迁移）一个用户/分片数据库，供离线工具使用"""
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    init_user_db(conn, scoped)
+    return conn
+
+
+def remove_db_file(db_path: Path) -> bool:
+    """删除数据库文件及 WAL 模式下可能残留的日志文件，文件不存在时返回 False"""
+    if not db_path.exists():
+        return False
+    db_path.unlink()
+    for suffix in ("-wal", "-shm"):
+        Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+    return True
+
+
+# --- 存储布局 ---
+class UserScope:
+    """
+    一次数据访问所针对的用户。
+    分片布局中各表都带 user_id 列，SQL 需要附加过滤条件和列；按用户分文件的布局则不需要。
+    """
+
+    __slots__ = ("user_id", "scoped")
+
+    def __init__(self, user_id: str, scoped: bool):
+        self.user_id = user_id
+        self.scoped = scoped
+
+    def where(self, *conditions: str) -> str:
+        """生成 WHERE 子句，自动附加 user_id 过滤"""
+        conds = (["user_id = ?"] if self.scoped else []) + [c for c in conditions if c]
+        return f"WHERE {' AND '.join(conds)}" if conds else ""
+
+    def params(self, *values) -> tuple:
+        """与 where() 对应的参数"""
+        return ((self.user_id,) if self.scoped else ()) + values
+
+    def columns(self, columns: str) -> str:
+        """INSERT 的列清单"""
+        return f"user_id, {columns}" if self.scoped else columns
+
+    def marks(self, count: int) -> str:
+        """INSERT 的占位符，与 columns() 对应"""
+        return ", ".join("?" * (count + (1 if self.scoped else 0)))
+
+    def row(self, *values) -> tuple:
+        """INSERT 的一行参数，与 columns() 对应"""
+        return ((self.user_id,) if self.scoped else ()) + values
+
+
+class PerUserLayout:
+    """每个用户一个数据库文件"""
+
+    name = "per_user"
+    scoped = False
+
+    def __init__(self, user_data_dir: Path):
+        self.user_data_dir = user_data_dir
+        self.user_data_dir.mkdir(parents=True, exist_ok=True)
+
+    def db_path(self, user_id: str) -> Path:
+        """获取指定用户的数据库文件路径"""
+        return self.user_data_dir / f"{user_id}.db"
+
+    def all_paths(self) -> list:
+        return sorted(f for f in self.user_data_dir.glob("*.db") if f.is_file())
+
+    def disk_usage(self, user_id: str) -> int:
+        """用户数据库文件（含 WAL 日志）占用的字节数"""
+        db_path = self.db_path(user_id)
+        return sum(p.stat().st_size for p in (db_path, Path(f"{db_path}-wal")) if p.exists())
+
+
+class ShardedLayout:
+    """按 user_id 哈希把用户分配到固定数量的分片数据库"""
+
+    name = "sharded"
+    scoped = True
+    META_FILE = "layout.json"
+    # 分片文件由多个用户共享，无法按用户统计文件大小
+    disk_usage = None
+
+    def __init__(self, shard_dir: Path, shard_count: int = None):
+        """shard_count 为 None 时沿用分片目录中记录的分片数"""
+        self.shard_dir = shard_dir
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        # 分片数一旦确定就不能再改，否则用户会被映射到错误的分片；以目录中记录的值为准
+        meta_path = self.shard_dir / self.META_FILE
+        if meta_path.exists():
+            stored = int(json.loads(meta_path.read_text(encoding="utf-8"))["shard_count"])
+            if shard_count is not None and stored != int(shard_count):
+                logger.warning(f"{LOG_TAG} 分片目录已按 {stored} 个分片创建，忽略配置中的分片数 {shard_count}。")
+            shard_count = stored
+        else:
+            shard_count = max(int(shard_count or 16), 1)
+            meta_path.write_text(json.dumps({"shard_count": shard_count}), encoding="utf-8")
+        self.shard_count = shard_count
+
+    def shard_index(self, user_id: str) -> int:
+        return zlib.crc32(user_id.encode("utf-8")) % self.shard_count
+
+    def db_path(self, user_id: str) -> Path:
+        return self.shard_dir / f"shard_{self.shard_index(user_id):03d}.db"
+
+    def all_paths(self) -> list:
+        return [self.shard_dir / f"shard_{i:03d}.db" for i in range(self.shard_count)]
+
+
+def make_layout(data_root: Path, backend: str = "per_user", shard_count: int = 16):
+    """根据配置创建存储布局"""
+    if backend == ShardedLayout.name:
+        layout = ShardedLayout(data_root / "shards", shard_count)
+        legacy = data_root / "user_data"
+        if legacy.exists() and any(legacy.glob("*.db")):
+            logger.warning(f"{LOG_TAG} 当前使用分片存储，但 {legacy} 中仍有按用户存储的数据，可使用 cli.py shard 离线迁移。")
+        return layout
+    if backend != PerUserLayout.name:
+        logger.warning(f"{LOG_TAG} 未知的存储布局 {backend}，使用 per_user。")
+    return PerUserLayout(data_root / "user_data")
+
+
+class ConnectionPool:
+    """
+    单条数据库通道内的连接缓存。
+    按 LRU 顺序保留已打开的数据库连接，超过 max_open 时关闭最久未使用的连接，
+    空闲超过 idle_timeout 秒的连接由定期清扫关闭。
+    已完成结构迁移的数据库路径记录在 initialized 中（各通道共享），热路径上不再执行任何 DDL。
+    连接只会在所属通道的线程中创建、使用和关闭。
+    """
+
+    def __init__(self, max_open: int, idle_timeout: float, initialized: set, scoped: bool = False, metrics: Metrics = None):
+        self.max_open = max(int(max_open), 1)
+        self.idle_timeout = float(idle_timeout)
+        self.initialized = initialized
+        self.scoped = scoped
+        self.metrics = metrics or Metrics()
+        self._conns = OrderedDict()
+
+    def get(self, db_path: Path) -> sqlite3.Connection:
+        key = str(db_path)
+        entry = self._conns.get(key)
+        if entry is not None:
+            self._conns.move_to_end(key)
+            entry[1] = time.monotonic()
+            return entry[0]
+
+        started = time.perf_counter()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            if key not in self.initialized:
+                init_user_db(conn, self.scoped)
+                self.initialized.add(key)
+            else:
+                configure_connection(conn)
+        except Exception as e:
+            conn.close()
+            logger.error(f"{LOG_TAG} 初始化/迁移数据库 {db_path} 失败: {e}")
+            raise
+        self.metrics.observe("db.open", (time.perf_counter() - started) * 1000)
+
+        self._conns[key] = [conn, time.monotonic()]
+        while len(self._conns) > self.max_open:
+            _, (old_conn, _) = self._conns.popitem(last=False)
+            old_conn.close()
+        return conn
+
+    def close(self, db_path: Path):
+        """关闭指定数据库的连接（如果已打开）"""
+        entry = self._conns.pop(str(db_path), None)
+        if entry is not None:
+            entry[0].close()
+
+    def sweep_idle(self) -> int:
+        """关闭空闲超时的连接，返回关闭的数量"""
+        if self.idle_timeout <= 0:
+            return 0
+        deadline = time.monotonic() - self.idle_timeout
+        expired = [key for key, (_, last_used) in self._conns.items() if last_used < deadline]
+        for key in expired:
+            self._conns.pop(key)[0].close()
+        return len(expired)
+
+    def close_all(self):
+        while self._conns:
+            _, (conn, _) = self._conns.popitem(last=False)
+            conn.close()
+
+
+# --- 同步数据访问（仅在数据库线程中调用，conn 由 ConnectionPool 提供） ---
+def _insert_chats(conn: sqlite3.Connection, scope: UserScope, rows: list):
+    # 风格特征在数据库线程中计算，与聊天记录在同一事务中写入
+    counts = features_for_rows(rows)
+    with conn:
+        conn.executemany(
+            f"INSERT INTO chat_history ({scope.columns('message, timestamp, search_text')}) VALUES ({scope.marks(3)})",
+            [scope.row(message, timestamp, fts_grams(message)) for message, timestamp in rows],
+        )
+        _add_style_counts(conn, scope, counts)
+
+
+def _set_profile(conn: sqlite3.Connection, scope: UserScope, key: str, value: str):
+    with conn:
+        conn.execute(
+            f"INSERT OR REPLACE INTO profile ({scope.columns('key, value')}) VALUES ({scope.marks(2)})",
+            scope.row(key, value),
+        )
+
+
+def _insert_note(conn: sqlite3.Connection, scope: UserScope, table: str, text: str, added_by: str, timestamp: int):
+    with conn:
+        conn.execute(
+            f"INSERT INTO {table} ({scope.columns('text, added_by, timestamp, search_text')}) VALUES ({scope.marks(4)})",
+            scope.row(text, added_by, timestamp, fts_grams(text)),
+        )
+
+
+def _get_nickname(cursor: sqlite3.Cursor, scope: UserScope):
+    cursor.execute(f"SELECT value FROM profile {scope.where('key = ?')}", scope.params('nickname'))
+    row = cursor.fetchone()
+    return row["value"] if row else None
+
+
+def _load_preview(conn: sqlite3.Connection, scope: UserScope) -> dict:
+    cursor = conn.cursor()
+    nickname = _get_nickname(cursor, scope)
+
+    cursor.execute(f"SELECT text, added_by, timestamp FROM admin_annotations {scope.where()} ORDER BY timestamp DESC", scope.params())
+    annotations = [dict(row) for row in cursor.fetchall()]
+
+    cursor.execute(f"SELECT text, added_by, timestamp FROM third_party_memories {scope.where()} ORDER BY timestamp DESC", scope.params())
+    memories = [dict(row) for row in cursor.fetchall()]
+
+    cursor.execute(f"SELECT message FROM chat_history {scope.where()} ORDER BY timestamp DESC LIMIT 10", scope.params())
+    history = [row["message"] for row in cursor.fetchall()]
+
+    return {
+        "nickname": nickname,
+        "annotations": annotations,
+        "memories": memories,
+        "history": history,
+    }
+
+
+def _load_notes(cursor: sqlite3.Cursor, scope: UserScope, budget: PromptBudget) -> dict:
+    cursor.execute(f"SELECT text FROM admin_annotations {scope.where()} ORDER BY timestamp", scope.params())
+    annotations = [row["text"] for row in cursor.fetchall()]
+
+    cursor.execute(f"SELECT text FROM third_party_memories {scope.where()} ORDER BY timestamp", scope.params())
+    memories = [row["text"] for row in cursor.fetchall()]
+
+    return {
+        "annotations": select_notes(annotations, budget),
+        "memories": select_notes(memories, budget),
+    }
+
+
+def _load_style(cursor: sqlite3.Cursor, scope: UserScope) -> dict:
+    """读取风格特征摘要所需的数据：各类特征中计数最高的若干项，{kind: [(feature, count), ...]}"""
+    style = {}
+    for kind in (*SUMMARY_TOP, "meta", "length", "hour"):
+        cursor.execute(
+            f"SELECT feature, count FROM style_features {scope.where('kind = ?')} ORDER BY count DESC LIMIT ?",
+            scope.params(kind, SUMMARY_TOP.get(kind, -1)),
+        )
+        style[kind] = [tuple(row) for row in cursor.fetchall()]
+    return style
+
+
+def _history_candidates(cursor: sqlite3.Cursor, scope: UserScope, budget: PromptBudget,
+                        after_id: int = 0, pool: int = None):
+    """
+    读取聊天记录抽样的候选，返回 ([(id, message), ...]（按 id 升序）, 范围内的最大 id)。
+    候选范围包括已归档的聊天记录。id 范围不超过候选数时全部读取；否则把 id 范围均分为若干区间，
+    每个区间按主键顺序读取开头的若干条，候选因此覆盖整个历史，且每次查询都只是一段有界的主键范围扫描。
+    """
+    pool = pool or budget.pool
+    low, high = _chat_id_range(cursor, scope, after_id)
+    if low is None:
+        return [], None
+    archive = _ArchiveReader(cursor.connection, scope)
+    if high - low + 1 <= pool:
+        return _read_chats(cursor, scope, archive, after_id + 1, pool), high
+
+    buckets = min(budget.buckets, pool)
+    per_bucket = -(-pool // buckets)
+    step = (high - low + 1) / buckets
+    candidates = {}
+    for bucket in range(buckets):
+        candidates.update(_read_chats(cursor, scope, archive, low + int(bucket * step), per_bucket))
+    return sorted(candidates.items()), high
+
+
+def _chat_id_range(cursor: sqlite3.Cursor, scope: UserScope, after_id: int):
+    """id 大于 after_id 的聊天记录（含归档）的 id 范围 (low, high)，没有时为 (None, None)"""
+    cursor.execute(f"SELECT MIN(id), MAX(id) FROM chat_history {scope.where('id > ?')}", scope.params(after_id))
+    bounds = [tuple(cursor.fetchone())]
+    cursor.execute(
+        f"SELECT MIN(first_id), MAX(last_id) FROM chat_archive {scope.where('last_id > ?')}",
+        scope.params(after_id),
+    )
+    archived_low, archived_high = cursor.fetchone()
+    if archived_low is not None:
+        bounds.append((max(archived_low, after_id + 1), archived_high))
+    bounds = [bound for bound in bounds if bound[0] is not None]
+    if not bounds:
+        return None, None
+    return min(low for low, _ in bounds), max(high for _, high in bounds)
+
+
+def _read_chats(cursor: sqlite3.Cursor, scope: UserScope, archive: "_ArchiveReader", start_id: int, limit: int) -> list:
+    """从 start_id 开始按 id 顺序读取最多 limit 条聊天记录 [(id, message), ...]，先读归档再读未归档的部分"""
+    rows = archive.read(start_id, limit)
+    cursor.execute(
+        f"SELECT id, message FROM chat_history {scope.where('id >= ?')} ORDER BY id LIMIT ?",
+        scope.params(start_id, limit),
+    )
+    rows.extend(tuple(row) for row in cursor.fetchall())
+    rows.sort()
+    return rows[:limit]
+
+
+def _load_persona_inputs(conn: sqlite3.Connection, scope: UserScope, budget: PromptBudget) -> dict:
+    """读取完整生成所需的数据：资料、批注、记忆、风格特征，以及在预算内从整个历史中抽样的聊天记录"""
+    cursor = conn.cursor()
+    data = {"nickname": _get_nickname(cursor, scope), **_load_notes(cursor, scope, budget)}
+
+    candidates, data["last_chat_id"] = _history_candidates(cursor, scope, budget)
+    data["history"] = sample_history(candidates, budget)
+    data["style"] = _load_style(cursor, scope)
+    return data
+
+
+def _load_persona_delta(conn: sqlite3.Connection, scope: UserScope, after_id: int,
+                        budget: PromptBudget, pool: int) -> dict:
+    """
+    读取增量更新所需的数据：资料、批注、记忆、风格特征，以及 id 大于 after_id 的聊天记录。
+    新消息同样经过去重与预算抽样，最多从 pool 条候选中挑选；new_count 为实际新增的总条数。
+    """
+    cursor = conn.cursor()
+    data = {"nickname": _get_nickname(cursor, scope), **_load_notes(cursor, scope, budget)}
+
+    # 按主键范围扫描，只触及检查点之后的行；检查点之后被归档的消息按归档块的条数计入
+    cursor.execute(f"SELECT COUNT(*) FROM chat_history {scope.where('id > ?')}", scope.params(after_id))
+    data["new_count"] = cursor.fetchone()[0]
+    cursor.execute(f"SELECT COALESCE(SUM(count), 0) FROM chat_archive {scope.where('first_id > ?')}", scope.params(after_id))
+    data["new_count"] += cursor.fetchone()[0]
+
+    candidates, last_chat_id = _history_candidates(cursor, scope, budget, after_id=after_id, pool=pool)
+    data["history"] = sample_history(candidates, budget)
+    data["last_chat_id"] = last_chat_id if last_chat_id is not None else after_id
+    data["style"] = _load_style(cursor, scope)
+    return data
+
+
+def _like_pattern(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _is_token_char(char: str) -> bool:
+    """unicode61 分词器默认视为词的一部分的字符（Unicode 类别 L*、N*、Co），其余字符都是分隔符"""
+    category = unicodedata.category(char)
+    return category[0] in "LN" or category == "Co"
+
+
+def _fts_phrase(term: str):
+    """
+    把一个搜索词转换为 FTS5 短语，与 fts_grams() 对文本的展开方式一致。
+    中日韩文字按二元组精确匹配；其他文字按词匹配，最后一个词按前缀匹配（“pyth”能匹配 python，“l”或“ython”不能）。
+    含单个中日韩文字的片段（索引中只有二元组）或不含任何词字符（如“_”、纯标点）时返回 None，由 LIKE 条件过滤。
+    """
+    if not any(map(_is_token_char, term)) or any(len(run) < 2 for run in _CJK_RUN.findall(term)):
+        return None
+    phrase = '"' + fts_grams(term).replace('"', '""') + '"'
+    return phrase + "*" if _is_token_char(term[-1]) and not _CJK_RUN.match(term[-1]) else phrase
+
+
+def _search_table(cursor: sqlite3.Cursor, scope: UserScope, table: str, terms: list, limit: int) -> list:
+    """
+    检索 table 中同时包含全部 terms 的行，返回 [(id, timestamp, text), ...]。
+    有全文索引且存在可索引的词时先以索引缩小范围并按 bm25 相关度排序；否则退回 LIKE 扫描，按 id 从新到旧。
+    两种方式都以 LIKE 条件确认每个词是文本的子串，不会返回不相关的行；但索引按词前缀匹配非中日韩文字
+    （见 _fts_phrase），出现在词中间的英文片段只有 LIKE 扫描能找到，因此有索引时的结果可能少于 LIKE 扫描。
+    """
+    column = FTS_COLUMNS[table]
+    fts = f"{table}_fts"
+    likes = [f"t.{column} LIKE ? ESCAPE '\\'" for _ in terms]
+    like_params = [_like_pattern(t) for t in terms]
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,))
+    phrases = [p for p in map(_fts_phrase, terms) if p] if cursor.fetchone() else []
+
+    if phrases:
+        # 短语之间为 AND
+        cursor.execute(
+            f"SELECT t.id, t.timestamp, t.{column} FROM {fts} JOIN {table} t ON t.id = {fts}.rowid "
+            f"{scope.where(f'{fts} MATCH ?', *likes)} ORDER BY {fts}.rank LIMIT ?",
+            scope.params(" ".join(phrases), *like_params, limit),
+        )
+    else:
+        cursor.execute(
+            f"SELECT t.id, t.timestamp, t.{column} FROM {table} t {scope.where(*likes)} ORDER BY t.id DESC LIMIT ?",
+            scope.params(*like_params, limit),
+        )
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def split_terms(query: str) -> list:
+    """把搜索关键词按空白拆分并去重"""
+    return list(dict.fromkeys(query.split()))
+
+
+def _search_user(conn: sqlite3.Connection, scope: UserScope, query: str, limit: int) -> dict:
+    """在聊天记录（不含已归档部分）、批注与记忆中检索关键词，每类最多返回 limit 条"""
+    cursor = conn.cursor()
+    terms = split_terms(query)
+    return {table: _search_table(cursor, scope, table, terms, limit) for table in FTS_COLUMNS}
+
+
+def _load_persona_topic(conn: sqlite3.Connection, scope: UserScope, budget: PromptBudget, topic: str) -> dict:
+    """
+    读取聚焦话题的完整生成所需的数据。聊天记录预算优先分配给与话题最相关的消息（topic_history，
+    按相关度挑选，预算内最多 budget.pool 条候选），剩余预算再从整个历史中均匀抽样。
+    """
+    cursor = conn.cursor()
+    data = {"nickname": _get_nickname(cursor, scope), **_load_notes(cursor, scope, budget)}
+
+    matches = _search_table(cursor, scope, "chat_history", split_terms(topic), budget.pool)
+    relevant = select_ranked([(chat_id, message) for chat_id, _, message in matches], budget)
+    remaining = budget.history - sum(budget.cost(text) for _, text in relevant)
+
+    candidates, data["last_chat_id"] = _history_candidates(cursor, scope, budget)
+    chosen = {chat_id for chat_id, _ in relevant}
+    data["topic"] = topic
+    data["topic_count"] = len(relevant)
+    data["history"] = [text for _, text in relevant]
+    if remaining > 0:
+        rest = [(chat_id, message) for chat_id, message in candidates if chat_id not in chosen]
+        data["history"] += sample_history(rest, replace(budget, history=remaining))
+    data["style"] = _load_style(cursor, scope)
+    return data
+
+
+def _load_data_version(conn: sqlite3.Connection, scope: UserScope) -> dict:
+    """
+    各表的最大 id 与昵称。表只追加写入，因此这些值与统计目录中的行数一起即可刻画数据是否变化。
+    聊天记录的最大 id 包含已归档的部分：归档只是搬移记录，不应改变指纹。
+    """
+    version = {"nickname": _get_nickname(conn.cursor(), scope)}
+    for table in ("chat_history", "admin_annotations", "third_party_memories"):
+        version[f"{table}_max_id"] = conn.execute(f"SELECT MAX(id) FROM {table} {scope.where()}", scope.params()).fetchone()[0]
+    archived = conn.execute(f"SELECT MAX(last_id) FROM chat_archive {scope.where()}", scope.params()).fetchone()[0]
+    if archived is not None:
+        version["chat_history_max_id"] = max(version["chat_history_max_id"] or 0, archived)
+    return version
+
+
+# 导出的分段及顺序；已归档的聊天记录先于未归档的部分导出，整体按 id 有序
+EXPORT_SECTIONS = ("profile", "chat_archive", "chat_history", "admin_annotations", "third_party_memories")
+_EXPORT_TYPES = {"admin_annotations": "annotation", "third_party_memories": "memory"}
+
+
+def _export_page(conn: sqlite3.Connection, scope: UserScope, section: str, after: int, limit: int):
+    """
+    读取导出数据的一页，返回 (记录列表, 下一页的游标)；游标为 None 表示该分段已读完。
+    聊天记录与批注/记忆按 id 游标分页，归档每页解压一个块，因此导出的内存占用与数据量无关。
+    """
+    user = {"user_id": scope.user_id}
+    if section == "profile":
+        rows = conn.execute(f"SELECT key, value FROM profile {scope.where()}", scope.params()).fetchall()
+        return [{"type": "profile", **user, "key": key, "value": value} for key, value in rows], None
+
+    if section == "chat_archive":
+        row = conn.execute(
+            f"SELECT id, codec, payload FROM chat_archive {scope.where('id > ?')} ORDER BY id LIMIT 1",
+            scope.params(after),
+        ).fetchone()
+        if row is None:
+            return [], None
+        return [
+            {"type": "chat", **user, "timestamp": timestamp, "message": message}
+            for _, timestamp, message in _decode_chunk(row["codec"], row["payload"])
+        ], row["id"]
+
+    if section == "chat_history":
+        rows = conn.execute(
+            f"SELECT id, timestamp, message FROM chat_history {scope.where('id > ?')} ORDER BY id LIMIT ?",
+            scope.params(after, limit),
+        ).fetchall()
+        records = [{"type": "chat", **user, "timestamp": row["timestamp"], "message": row["message"]} for row in rows]
+    else:
+        rows = conn.execute(
+            f"SELECT id, text, added_by, timestamp FROM {section} {scope.where('id > ?')} ORDER BY id LIMIT ?",
+            scope.params(after, limit),
+        ).fetchall()
+        records = [
+            {"type": _EXPORT_TYPES[section], **user, "timestamp": row["timestamp"], "text": row["text"], "added_by": row["added_by"]}
+            for row in rows
+        ]
+    return records, (rows[-1]["id"] if len(rows) == limit else None)
+
+
+def iter_export_pages(conn: sqlite3.Connection, scope: UserScope, page_size: int = 5000):
+    """按分段顺序逐页产出一个用户的全部导出记录（离线工具使用）"""
+    for section in EXPORT_SECTIONS:
+        after = 0
+        while after is not None:
+            records, after = _export_page(conn, scope, section, after, page_size)
+            if records:
+                yield records
+
+
+def _has_rows(conn: sqlite3.Connection, scope: UserScope) -> bool:
+    for table in USER_TABLES:
+        if conn.execute(f"SELECT 1 FROM {table} {scope.where()} LIMIT 1", scope.params()).fetchone():
+            return True
+    return False
+
+
+def _delete_rows(conn: sqlite3.Connection, scope: UserScope) -> bool:
+    existed = _has_rows(conn, scope)
+    with conn:
+        for table in USER_TABLES:
+            conn.execute(f"DELETE FROM {table} {scope.where()}", scope.params())
+    return existed
+
+
+def _scan_user_stats(conn: sqlite3.Connection, scope: UserScope) -> dict:
+    """完整统计一个用户的数据（用于重建统计目录）"""
+    count, first_ts, last_ts, payload = conn.execute(
+        f"SELECT COUNT(*), MIN(timestamp), MAX(timestamp), COALESCE(SUM(LENGTH(CAST(message AS BLOB))), 0) "
+        f"FROM chat_history {scope.where()}", scope.params()
+    ).fetchone()
+    archived, archived_first_ts, archived_last_ts, archived_payload = conn.execute(
+        f"SELECT COALESCE(SUM(count), 0), MIN(first_ts), MAX(last_ts), COALESCE(SUM(LENGTH(payload)), 0) "
+        f"FROM chat_archive {scope.where()}", scope.params()
+    ).fetchone()
+    if archived:
+        first_ts = archived_first_ts if first_ts is None else min(first_ts, archived_first_ts)
+        last_ts = archived_last_ts if last_ts is None else max(last_ts, archived_last_ts)
+    return {
+        "message_count": count + archived,
+        "archived_count": archived,
+        "first_ts": first_ts,
+        "last_ts": last_ts,
+        "annotation_count": conn.execute(f"SELECT COUNT(*) FROM admin_annotations {scope.where()}", scope.params()).fetchone()[0],
+        "memory_count": conn.execute(f"SELECT COUNT(*) FROM third_party_memories {scope.where()}", scope.params()).fetchone()[0],
+        "disk_bytes": payload + archived_payload,
+    }
+
+
+def _scan_shard_stats(conn: sqlite3.Connection) -> dict:
+    """完整统计一个分片中全部用户的数据（用于重建统计目录）"""
+    return {user_id: _scan_user_stats(conn, UserScope(user_id, True)) for user_id in _shard_user_ids(conn)}
+
+
+def _shard_user_ids(conn: sqlite3.Connection) -> list:
+    union = " UNION ".join(f"SELECT user_id FROM {table}" for table in USER_TABLES)
+    return [row[0] for row in conn.execute(union)]
+
+
+# --- 归档与空间回收 ---
+# 超出保留策略的旧聊天记录按 id 顺序分块，压缩后写入 chat_archive 并从 chat_history 删除。
+# 归档块仍可按 id 流式读回（见 _ArchiveReader），完整重建人格时与未归档的记录一起参与抽样。
+ARCHIVE_CODECS = {
+    "zlib": (functools.partial(zlib.compress, level=6), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """
+    聊天记录保留策略：超出最近 max_messages 条、或早于 max_days 天的记录会被归档（均为 0 时不归档）。
+    归档块最多包含 chunk_size 条记录，以 codec 压缩。
+    """
+
+    max_messages: int = 0
+    max_days: float = 0
+    codec: str = "zlib"
+    chunk_size: int = 1000
+
+    @classmethod
+    def from_config(cls, config) -> "RetentionPolicy":
+        codec = config.get("archive_codec", cls.codec)
+        return cls(
+            max_messages=max(int(config.get("retention_max_messages", 0)), 0),
+            max_days=max(float(config.get("retention_max_days", 0)), 0),
+            codec=codec if codec in ARCHIVE_CODECS else cls.codec,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_messages or self.max_days)
+
+
+def _encode_chunk(rows: list, codec: str) -> bytes:
+    """rows 为 [(id, timestamp, message), ...]"""
+    compress, _ = ARCHIVE_CODECS[codec]
+    return compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def _decode_chunk(codec: str, payload: bytes) -> list:
+    _, decompress = ARCHIVE_CODECS[codec]
+    return json.loads(decompress(payload).decode("utf-8"))
+
+
+class _ArchiveReader:
+    """按 id 顺序读取归档的聊天记录；一次读取中解压过的块会被缓存，相邻区间不会重复解压"""
+
+    def __init__(self, conn: sqlite3.Connection, scope: UserScope):
+        self.conn = conn
+        self.scope = scope
+        self._chunks = {}
+
+    def read(self, start_id: int, limit: int) -> list:
+        # 归档按消息时间选取，不同批次归档的块在 id 上可能交错；按 first_id 顺序读取，
+        # 直到后面的块不可能再含有更小的 id 为止
+        rows = []
+        cursor = self.conn.execute(
+            f"SELECT id, first_id, codec, payload FROM chat_archive {self.scope.where('last_id >= ?')} ORDER BY first_id",
+            self.scope.params(start_id),
+        )
+        for chunk_id, first_id, codec, payload in cursor:
+            if len(rows) >= limit and first_id > rows[limit - 1][0]:
+                break
+            entries = self._chunks.get(chunk_id)
+            if entries is None:
+                entries = self._chunks[chunk_id] = _decode_chunk(codec, payload)
+            rows.extend((chat_id, message) for chat_id, _, message in entries if chat_id >= start_id)
+            rows.sort()
+        cursor.close()
+        return rows[:limit]
+
+    def iter_rows(self):
+        """逐块产出全部归档记录 (id, timestamp, message)，块内按 id 排序"""
+        cursor = self.conn.execute(
+            f"SELECT codec, payload FROM chat_archive {self.scope.where()} ORDER BY first_id",
+            self.scope.params(),
+        )
+        for codec, payload in cursor:
+            yield from (tuple(entry) for entry in _decode_chunk(codec, payload))
+
+
+def _archive_user(conn: sqlite3.Connection, scope: UserScope, policy: RetentionPolicy, now: float):
+    """
+    按保留策略归档一个用户的旧聊天记录，返回 (归档条数, 原始文本字节数, 压缩后字节数)。
+    每个归档块在独立的事务中写入并删除对应的原始记录，中途中断不会丢失数据。
+    """
+    conditions, params = [], []
+    if policy.max_messages:
+        # “最近”按消息时间而不是 id 判断：导入的旧消息 id 较大，但同样应当优先归档
+        row = conn.execute(
+            f"SELECT timestamp, id FROM chat_history {scope.where()} ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?",
+            scope.params(policy.max_messages),
+        ).fetchone()
+        if row is not None:
+            conditions.append("(timestamp, id) <= (?, ?)")
+            params.extend(row)
+    if policy.max_days:
+        conditions.append("timestamp < ?")
+        params.append(int(now - policy.max_days * 86400))
+    if not conditions:
+        return 0, 0, 0
+
+    condition = f"({' OR '.join(conditions)})"
+    archived = raw_bytes = stored_bytes = 0
+    while True:
+        rows = [tuple(row) for row in conn.execute(
+            f"SELECT id, timestamp, message FROM chat_history {scope.where(condition)} ORDER BY id LIMIT ?",
+            scope.params(*params, policy.chunk_size),
+        )]
+        if not rows:
+            break
+        payload = _encode_chunk(rows, policy.codec)
+        timestamps = [timestamp for _, timestamp, _ in rows]
+        with conn:
+            conn.execute(
+                f"INSERT INTO chat_archive ({scope.columns('first_id, last_id, first_ts, last_ts, count, codec, payload')}) "
+                f"VALUES ({scope.marks(7)})",
+                scope.row(rows[0][0], rows[-1][0], min(timestamps), max(timestamps), len(rows), policy.codec, payload),
+            )
+            conn.executemany("DELETE FROM chat_history WHERE id = ?", [(chat_id,) for chat_id, _, _ in rows])
+        archived += len(rows)
+        raw_bytes += sum(len(message.encode("utf-8")) for _, _, message in rows)
+        stored_bytes += len(payload)
+        if len(rows) < policy.chunk_size:
+            break
+    return archived, raw_bytes, stored_bytes
+
+
+def _compact_db(conn: sqlite3.Connection, db_path: Path) -> int:
+    """
+    回收数据库中的空闲页，返回数据库文件减少的字节数。
+    已启用增量 auto_vacuum 的数据库只执行 incremental_vacuum；旧数据库在有空闲页时执行一次完整 VACUUM 并同时切换模式。
+    先把 WAL 写回主文件再测量，前后都只统计主文件，WAL 截断不计入回收量。
+    """
+    if not conn.execute("PRAGMA freelist_count").fetchone()[0]:
+        return 0
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    before = db_path.stat().st_size
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        # 经 execute 单步执行只会释放一页，executescript 会一直执行到空闲页全部回收。
+        conn.executescript("PRAGMA incremental_vacuum;")
+    else:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return max(before - db_path.stat().st_size, 0)
+
+
+# --- 异步存储接口 ---
+class _Lane:
+    """一条数据库通道：单线程执行器 + 该线程独占的连接缓存"""
+
+    def __init__(self, index: int, pool: ConnectionPool):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"echo_avatar_db_{index}")
+        self.pool = pool
+
+    def run(self, db_path: Path, fn, args: tuple):
+        conn = self.pool.get(db_path)
+        # 按操作名称记录执行耗时，例如 db.insert_chats、db.load_persona_inputs
+        with self.pool.metrics.timer(f"db.{fn.__name__.lstrip('_')}"):
+            return fn(conn, *args)
+
+    def delete_file(self, db_path: Path) -> bool:
+        # 删除文件前必须先关闭连接，否则 unlink 后旧连接仍会写入已删除的文件
+        self.pool.close(db_path)
+        self.pool.initialized.discard(str(db_path))
+        return remove_db_file(db_path)
+
+
+class EchoStore:
+    """
+    异步存储接口。
+    每条通道是一个单线程执行器，数据库文件通过稳定哈希映射到通道，因此同一用户的读写严格按提交顺序执行，
+    分片数据库的连接也只会被一个线程使用。
+    """
+
+    def __init__(self, layout, workers: int = 2, max_open: int = 64, idle_timeout: float = 300, catalog=None,
+                 metrics: Metrics = None):
+        self.layout = layout
+        # 性能指标 (metrics.Metrics)，记录各数据库操作的排队与执行耗时
+        self.metrics = metrics or Metrics()
+        # 统计目录 (catalog.StatsCatalog)，所有写入和删除都会同步更新它
+        self.catalog = catalog
+        self._catalog_lock = asyncio.Lock()
+        workers = max(int(workers), 1)
+        initialized = set()
+        # 连接上限在各通道间平分
+        per_lane = max(int(max_open) // workers, 1)
+        self._lanes = [
+            _Lane(i, ConnectionPool(per_lane, idle_timeout, initialized, layout.scoped, self.metrics))
+            for i in range(workers)
+        ]
+        self.idle_timeout = float(idle_timeout)
+        self._sweeper = None
+        # 最近一次提交前台数据库操作的时间，后台维护据此判断是否空闲
+        self.last_activity = time.monotonic()
+
+    def db_path(self, user_id: str) -> Path:
+        """获取存放指定用户数据的数据库文件路径"""
+        return self.layout.db_path(user_id)
+
+    def _lane_for(self, db_path: Path) -> _Lane:
+        return self._lanes[zlib.crc32(str(db_path).encode("utf-8")) % len(self._lanes)]
+
+    async def _submit(self, lane: _Lane, fn, *args, background: bool = False):
+        """background 为 True 的操作（连接清扫、后台维护自身的读写）不计入 last_activity"""
+        if self._sweeper is None and self.idle_timeout > 0:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+        if not background:
+            self.last_activity = time.monotonic()
+        submitted = time.perf_counter()
+
+        def _run():
+            # 在通道中排队等待的时间
+            self.metrics.observe("db.queue_wait", (time.perf_counter() - submitted) * 1000)
+            return fn(*args)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(lane.executor, _run)
+
+    async def _call(self, user_id: str, fn, *args, background: bool = False):
+        """在用户数据库所属的通道上，以缓存连接执行 fn(conn, scope, *args)"""
+        db_path = self.db_path(user_id)
+        lane = self._lane_for(db_path)
+        return await self._submit(lane, lane.run, db_path, fn, (UserScope(user_id, self.layout.scoped), *args),
+                                  background=background)
+
+    async def _call_db(self, db_path: Path, fn, *args, background: bool = False):
+        """在指定数据库所属的通道上执行 fn(conn, *args)，用于不针对单个用户的操作"""
+        lane = self._lane_for(db_path)
+        return await self._submit(lane, lane.run, db_path, fn, args, background=background)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 1))
+            for lane in self._lanes:
+                try:
+                    await self._submit(lane, lane.pool.sweep_idle, background=True)
+                except Exception as e:
+                    logger.error(f"{LOG_TAG} 清理空闲数据库连接失败: {e}")
+
+    async def catalog_ready(self):
+        """确保统计目录已载入；目录不存在或与当前存储布局不符时，扫描全部数据重建"""
+        if self.catalog is None or self.catalog.loaded:
+            return
+        async with self._catalog_lock:
+            if self.catalog.loaded:
+                return
+            if await self.catalog.load():
+                return
+            logger.info(f"{LOG_TAG} 正在扫描已有数据以重建统计目录...")
+            await self.catalog.replace_all(await self.scan_stats())
+            logger.info(f"{LOG_TAG} 统计目录重建完成，共 {self.catalog.user_count()} 个用户。")
+
+    async def scan_stats(self) -> dict:
+        """扫描全部数据库，返回 {user_id: 统计字段字典}"""
+        if not self.layout.scoped:
+            paths = await self._submit(self._lanes[0], self.layout.all_paths)
+            user_ids = [path.stem for path in paths]
+            results = await asyncio.gather(*(self._call(user_id, _scan_user_stats) for user_id in user_ids))
+            stats = dict(zip(user_ids, results))
+            for user_id, values in stats.items():
+                values["disk_bytes"] = await self._submit(self._lanes[0], self.layout.disk_usage, user_id)
+            return stats
+        stats = {}
+        for shard_stats in await asyncio.gather(*(self._call_db(path, _scan_shard_stats) for path in self.layout.all_paths())):
+            stats.update(shard_stats)
+        return stats
+
+    async def insert_chat(self, user_id: str, message: str, timestamp: int):
+        await self.insert_chats({user_id: [(message, timestamp)]})
+
+    async def insert_chats(self, batch: dict):
+        """
+        批量写入聊天记录，batch 的结构为 {user_id: [(message, timestamp), ...]}。
+        每个用户一次事务；不同通道上的用户并行写入。单个用户写入失败只记录日志，不影响其他用户。
+        返回写入失败的用户及对应的异常 {user_id: exception}。
+        """
+        await self.catalog_ready()
+        users = list(batch)
+        with self.metrics.timer("recorder.insert"):
+            results = await asyncio.gather(
+                *(self._call(user_id, _insert_chats, batch[user_id]) for user_id in users),
+                return_exceptions=True,
+            )
+        failed = {}
+        for user_id, result in zip(users, results):
+            if isinstance(result, Exception):
+                logger.error(f"{LOG_TAG} 批量写入用户 {user_id} 的 {len(batch[user_id])} 条消息到 {self.db_path(user_id)} 失败: {result}")
+                failed[user_id] = result
+                self.metrics.incr("recorder.insert_failed", len(batch[user_id]))
+            else:
+                self.metrics.incr("recorder.inserted", len(batch[user_id]))
+                if self.catalog is not None:
+                    self.catalog.record_chats(user_id, batch[user_id])
+        return failed
+
+    async def set_profile(self, user_id: str, key: str, value: str):
+        await self.catalog_ready()
+        await self._call(user_id, _set_profile, key, value)
+        if self.catalog is not None:
+            self.catalog.touch(user_id)
+
+    async def add_annotation(self, user_id: str, text: str, added_by: str, timestamp: int):
+        await self.catalog_ready()
+        await self._call(user_id, _insert_note, "admin_annotations", text, added_by, timestamp)
+        if self.catalog is not None:
+            self.catalog.record_annotation(user_id)
+
+    async def add_memory(self, user_id: str, text: str, added_by: str, timestamp: int):
+        await self.catalog_ready()
+        await self._call(user_id, _insert_note, "third_party_memories", text, added_by, timestamp)
+        if self.catalog is not None:
+            self.catalog.record_memory(user_id)
+
+    async def user_exists(self, user_id: str) -> bool:
+        if not self.layout.scoped:
+            db_path = self.db_path(user_id)
+            return await self._submit(self._lane_for(db_path), db_path.exists)
+        return await self._call(user_id, _has_rows)
+
+    async def load_preview(self, user_id: str) -> dict:
+        """读取数据预览所需的资料、批注、记忆和最新 10 条聊天记录"""
+        return await self._call(user_id, _load_preview)
+
+    async def load_persona_inputs(self, user_id: str, budget: PromptBudget) -> dict:
+        """读取生成人格 Prompt 所需的资料、批注、记忆和抽样后的聊天记录，总量受 budget 约束"""
+        return await self._call(user_id, _load_persona_inputs, budget)
+
+    async def load_persona_delta(self, user_id: str, after_id: int, budget: PromptBudget, pool: int = 200) -> dict:
+        """读取检查点 after_id 之后的新聊天记录（最多从 pool 条候选中抽样），以及资料、批注和记忆"""
+        return await self._call(user_id, _load_persona_delta, after_id, budget, pool)
+
+    async def load_persona_topic(self, user_id: str, budget: PromptBudget, topic: str) -> dict:
+        return await self._call(user_id, _load_persona_topic, budget, topic)
+
+    async def search(self, user_id: str, query: str, limit: int = 10) -> dict:
+        """
+        全文检索用户的聊天记录、批注与记忆，返回 {表名: [(id, timestamp, text), ...]}。
+        关键词以空白分隔，结果须包含全部关键词；已归档的聊天记录不参与检索。
+        """
+        return await self._call(user_id, _search_user, query, limit)
+
+    async def load_data_version(self, user_id: str) -> dict:
+        """读取各表的最大 id 与昵称，用于判断用户数据自上次以来是否变化"""
+        return await self._call(user_id, _load_data_version)
+
+    async def export_user(self, user_id: str, write, page_size: int = 5000) -> int:
+        """
+        流式导出一个用户的全部数据（资料、聊天记录含归档、批注、记忆），返回导出的记录数。
+        每读取一页就调用 await write(records)；页与页之间会让出数据库通道，不会长时间阻塞其他用户的写入。
+        """
+        exported = 0
+        for section in EXPORT_SECTIONS:
+            after = 0
+            while after is not None:
+                records, after = await self._call(user_id, _export_page, section, after, page_size)
+                if records:
+                    await write(records)
+                    exported += len(records)
+        return exported
+
+    async def delete_user(self, user_id: str) -> bool:
+        """删除用户的全部数据，用户不存在时返回 False"""
+        await self.catalog_ready()
+        if self.layout.scoped:
+            existed = await self._call(user_id, _delete_rows)
+        else:
+            db_path = self.db_path(user_id)
+            lane = self._lane_for(db_path)
+            existed = await self._submit(lane, lane.delete_file, db_path)
+        if self.catalog is not None:
+            self.catalog.remove(user_id)
+        return existed
+
+    async def archive_user(self, user_id: str, policy: RetentionPolicy) -> int:
+        """按保留策略归档一个用户的旧聊天记录，返回归档的条数"""
+        archived, raw_bytes, stored_bytes = await self._call(user_id, _archive_user, policy, time.time(), background=True)
+        if archived and self.catalog is not None:
+            self.catalog.record_archived(user_id, archived, stored_bytes - raw_bytes)
+        return archived
+
+    async def compact(self) -> int:
+        """回收全部数据库文件中的空闲页，返回释放的字节数"""
+        paths = await self._submit(self._lanes[0], lambda: [p for p in self.layout.all_paths() if p.exists()], background=True)
+        results = await asyncio.gather(
+            *(self._call_db(path, _compact_db, path, background=True) for path in paths),
+            return_exceptions=True,
+        )
+        reclaimed = 0
+        resized = []
+        for path, result in zip(paths, results):
+            if isinstance(result, Exception):
+                logger.error(f"{LOG_TAG} 回收数据库 {path} 的空间失败: {result}")
+            elif result:
+                reclaimed += result
+                resized.append(path)
+        if resized and self.catalog is not None and not self.layout.scoped:
+            # 只有文件变小的用户需要重新测量占用，其余用户的统计不受影响
+            owners = {self.db_path(user_id): user_id for user_id in self.catalog.all()}
+            for path in resized:
+                if path in owners:
+                    self.catalog.record_resized(owners[path])
+        return reclaimed
+
+    async def run_maintenance(self, policy: RetentionPolicy) -> dict:
+        """执行一次维护：按保留策略归档全部用户的旧聊天记录，然后回收空间"""
+        await self.catalog_ready()
+        archived = users = 0
+        if policy.enabled:
+            for user_id in list(self.catalog.all()):
+                try:
+                    count = await self.archive_user(user_id, policy)
+                except Exception as e:
+                    logger.error(f"{LOG_TAG} 归档用户 {user_id} 的聊天记录失败: {e}")
+                    continue
+                if count:
+                    archived += count
+                    users += 1
+        reclaimed = await self.compact()
+        return {"archived": archived, "users": users, "reclaimed": reclaimed}
+
+    async def close(self):
+        """等待所有通道上的任务执行完毕，关闭全部连接、数据库线程和统计目录"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(loop.run_in_executor(lane.executor, lane.pool.close_all) for lane in self._lanes),
+            return_exceptions=True,
+        )
+
+        def _shutdown():
+            for lane in self._lanes:
+                lane.executor.shutdown(wait=True)
+        await asyncio.to_thread(_shutdown)
+        if self.catalog is not None:
+            await self.catalog.close()
+
+
+# --- 聊天记录写缓冲 ---
+class ChatWriteBuffer:
+    """
+    聊天记录的写缓冲队列 (write-behind)。
+    消息处理器只负责把 (sender_id, message, timestamp) 放入内存队列，
+    由后台任务在积攒到 batch_size 条或距上次落库超过 flush_interval 秒时，按用户分组批量写入。
+    """
+
+    def __init__(self, store: EchoStore, max_size: int, flush_interval: float, batch_size: int):
+        self.store = store
+        self.flush_interval = max(float(flush_interval), 0.1)
+        self.batch_size = max(int(batch_size), 1)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(int(max_size), 1))
+        self._flush_now = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+    @property
+    def pending(self) -> int:
+        """尚未落库的消息数"""
+        return self._queue.qsize()
+
+    def start(self):
+        """启动后台落库任务（幂等）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, sender_id: str, message: str, timestamp: int):
+        """消息入队。队列已满时会等待后台任务腾出空间，以此形成背压。关闭后不再入队，改为直接落库。"""
+        if self._closing:
+            await self.store.insert_chats({sender_id: [(message, timestamp)]})
+            return
+        self.start()
+        if self._queue.qsize() + 1 >= self.batch_size:
+            self._flush_now.set()
+        await self._queue.put((sender_id, message, timestamp))
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"{LOG_TAG} 后台落库任务异常: {e}")
+
+    async def flush(self):
+        """取出当前队列中的全部消息，按用户分组后批量写入数据库"""
+        async with self._flush_lock:
+            batch = {}
+            count = 0
+            while not self._queue.empty():
+                sender_id, message, timestamp = self._queue.get_nowait()
+                batch.setdefault(sender_id, []).append((message, timestamp))
+                count += 1
+            if not batch:
+                return
+            await self.store.insert_chats(batch)
+            logger.debug(f"{LOG_TAG} 已批量落库 {count} 条消息，涉及 {len(batch)} 个用户。")
+
+    async def close(self):
+        """停止后台任务并将队列中剩余的消息全部落库"""
+        # 不能取消后台任务：它可能正在写入一批已经出队的消息。改为通知它在本轮落库后退出，并等待其结束
+        self._closing = True
+        if self._task is not None:
+            self._flush_now.set()
+            await self._task
+            self._task = None
+        while not self._queue.empty():
+            await self.flush()
+
+
+# --- 后台维护 ---
+class MaintenanceScheduler:
+    """
+    后台维护任务：每隔 interval 秒执行一次 EchoStore.run_maintenance（归档旧聊天记录并回收空间）。
+    只在数据库已连续 idle_seconds 秒没有前台数据库操作（消息落库、指令读写）时才开始，避免与聊天高峰争抢磁盘。
+    """
+
+    IDLE_CHECK_INTERVAL = 30
+
+    def __init__(self, store: EchoStore, policy: RetentionPolicy, interval: float, idle_seconds: float):
+        self.store = store
+        self.policy = policy
+        self.interval = max(float(interval), 0)
+        self.idle_seconds = max(float(idle_seconds), 0)
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        """启动后台维护任务（幂等）；interval 为 0 时不启动"""
+        if self.interval and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            while time.monotonic() - self.store.last_activity < self.idle_seconds:
+                await asyncio.sleep(min(self.IDLE_CHECK_INTERVAL, self.idle_seconds))
+            try:
+                await self.run_now()
+            except Exception as e:
+                logger.error(f"{LOG_TAG} 后台维护任务异常: {e}")
+
+    async def run_now(self) -> dict:
+        """立即执行一次维护并返回报告；与后台任务互斥"""
+        async with self._lock:
+            started = time.monotonic()
+            report = await self.store.run_maintenance(self.policy)
+            report["elapsed"] = time.monotonic() - started
+        logger.info(
+            f"{LOG_TAG} 维护完成：归档 {report['archived']} 条聊天记录（{report['users']} 个用户），"
+            f"回收 {report['reclaimed']} 字节，耗时 {report['elapsed']:.1f} 秒。"
+        )
+        return report
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class MetricsDumper:
+    """定期把指标快照写入 JSON 文件；interval 为 0 时不启用。关闭时写出最后一次快照"""
+
+    def __init__(self, metrics: Metrics, path: Path, interval: float):
+        self.metrics = metrics
+        self.path = path
+        self.interval = max(float(interval), 0)
+        self._task = None
+
+    def start(self):
+        """启动后台任务（需在事件循环中调用，重复调用无副作用）"""
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    def _dump_sync(self, snapshot: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(snapshot, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    async def dump(self):
+        snapshot = {**self.metrics.snapshot(), "dumped_at": int(time.time())}
+        await asyncio.to_thread(self._dump_sync, snapshot)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.dump()
+            except Exception as e:
+                logger.error(f"{LOG_TAG} 写出性能指标失败: {e}")
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await self.dump()
+        except Exception as e:
+            logger.error(f"{LOG_TAG} 写出性能指标失败: {e}")
+
+
+# --- 离线布局转换 ---
+# 以下函数不经过事件循环，供 cli.py 在插件停用时调用。数据以游标分批流式复制，内存占用与数据量无关。
+_COPY_COLUMNS = {
+    "profile": "key, value",
+    "chat_history": "message, timestamp, search_text",
+    "admin_annotations": "text, added_by, timestamp, search_text",
+    "third_party_memories": "text, added_by, timestamp, search_text",
+    "style_features": "kind, feature, count",
+}
+
+
+def _copy_user(src: sqlite3.Connection, src_scope: UserScope, dst: sqlite3.Connection, dst_scope: UserScope,
+               batch_size: int) -> int:
+    """
+    在一个事务内把一个用户的全部数据从 src 复制到 dst，返回复制的行数。
+    目标中该用户已有的数据会先被清除，因此重复执行是安全的。
+    自增 id 不保留（分片中不同用户的 id 会冲突），但按原 id 顺序写入。
+    """
+    copied = 0
+    dst.execute("BEGIN")
+    try:
+        for table in USER_TABLES:
+            dst.execute(f"DELETE FROM {table} {dst_scope.where()}", dst_scope.params())
+        for table, columns in _COPY_COLUMNS.items():
+            if table == "chat_history":
+                # 归档块中记录的是源库的 id，无法原样搬到目标库；先把归档记录按原顺序还原为普通聊天记录，
+                # 之后由目标库的维护任务重新归档
+                insert_sql = f"INSERT INTO chat_history ({dst_scope.columns(columns)}) VALUES ({dst_scope.marks(3)})"
+                batch = []
+                for _, timestamp, message in _ArchiveReader(src, src_scope).iter_rows():
+                    batch.append(dst_scope.row(message, timestamp, fts_grams(message)))
+                    if len(batch) >= batch_size:
+                        dst.executemany(insert_sql, batch)
+                        copied += len(batch)
+                        batch = []
+                if batch:
+                    dst.executemany(insert_sql, batch)
+                    copied += len(batch)
+            count = len(columns.split(","))
+            order = "" if table in ("profile", "style_features") else "ORDER BY id"
+            cursor = src.execute(f"SELECT {columns} FROM {table} {src_scope.where()} {order}", src_scope.params())
+            insert_sql = f"INSERT INTO {table} ({dst_scope.columns(columns)}) VALUES ({dst_scope.marks(count)})"
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                dst.executemany(insert_sql, [dst_scope.row(*row) for row in rows])
+                copied += len(rows)
+        dst.commit()
+    except Exception:
+        dst.rollback()
+        raise
+    return copied
+
+
+def convert_to_sharded(data_root: Path, shard_count: int = 16, batch_size: int = 5000,
+                       remove_source: bool = False, progress=print) -> int:
+    """把 user_data/ 下按用户存储的数据库流式写入分片数据库，返回迁移的用户数"""
+    source = PerUserLayout(data_root / "user_data")
+    target = ShardedLayout(data_root / "shards", shard_count)
+    shard_conns = {}
+    migrated = 0
+    try:
+        for src_path in source.all_paths():
+            user_id = src_path.stem
+            dst_path = target.db_path(user_id)
+            if dst_path not in shard_conns:
+                shard_conns[dst_path] = open_user_db(dst_path, scoped=True)
+            src = open_user_db(src_path, scoped=False)
+            try:
+                rows = _copy_user(src, UserScope(user_id, False), shard_conns[dst_path], UserScope(user_id, True), batch_size)
+            finally:
+                src.close()
+            migrated += 1
+            progress(f"[{migrated}] 用户 {user_id}: {rows} 行 -> {dst_path.name}")
+            if remove_source:
+                remove_db_file(src_path)
+    finally:
+        for conn in shard_conns.values():
+            conn.close()
+    return migrated
+
+
+def convert_to_per_user(data_root: Path, batch_size: int = 5000, remove_source: bool = False, progress=print) -> int:
+    """把分片数据库中的用户流式拆分回 user_data/<用户ID>.db，返回迁移的用户数"""
+    shard_dir = data_root / "shards"
+    if not (shard_dir / ShardedLayout.META_FILE).exists():
+        raise FileNotFoundError(f"{shard_dir} 中没有分片数据")
+    source = ShardedLayout(shard_dir)
+    target = PerUserLayout(data_root / "user_data")
+    migrated = 0
+    for shard_path in source.all_paths():
+        if not shard_path.exists():
+            continue
+        src = open_user_db(shard_path, scoped=True)
+        try:
+            for user_id in _shard_user_ids(src):
+                dst = open_user_db(target.db_path(user_id), scoped=False)
+                try:
+                    rows = _copy_user(src, UserScope(user_id, True), dst, UserScope(user_id, False), batch_size)
+                finally:
+                    dst.close()
+                migrated += 1
+                progress(f"[{migrated}] 用户 {user_id}: {rows} 行 <- {shard_path.name}")
+        finally:
+            src.close()
+        if remove_source:
+            remove_db_file(shard_path)
+    if remove_source:
+        (shard_dir / ShardedLayout.META_FILE).unlink(missing_ok=True)
+    return migrated
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+聊天风格的统计特征。
+
+每条聊天记录在写入数据库时被拆解为若干 (kind, feature) 计数，累加到用户的 style_features 表中：
+- ngram: 由文字或数字组成的字符二元组（去除空白与链接后，只取消息开头的 NGRAM_MAX_CHARS 个字符）
+- punct: 标点与 "~" 等符号
+- ending: 句末字符（无标点的结尾记为“无标点”）
+- emoji / kaomoji: emoji 字符与颜文字、qwq 之类的文字表情
+- length: 消息长度分段
+- hour: 发送时间所在的小时
+- meta: messages 为参与统计的消息总数
+
+生成人格时只读取各类特征中计数最高的若干项，格式化为固定长度的摘要，与聊天记录总量无关。
+"""
+
+import re
+import time
+import unicodedata
+from collections import Counter
+
+NGRAM_MAX_CHARS = 200
+
+# 摘要中各类特征列出的条数
+SUMMARY_TOP = {
+    "ngram": 15,
+    "punct": 8,
+    "ending": 6,
+    "emoji": 8,
+    "kaomoji": 6,
+}
+
+LENGTH_BINS = ((5, "1-5字"), (10, "6-10字"), (20, "11-20字"), (50, "21-50字"), (100, "51-100字"))
+LENGTH_OVERFLOW = "100字以上"
+NO_ENDING_PUNCT = "无标点"
+
+_URL = re.compile(r"https?://\S+", re.IGNORECASE)
+_EMOJI = re.compile("[\U0001F000-\U0001FAFF☀-➿⬀-⯿]")
+_KAOMOJI = re.compile(
+    r"[(（][^()（）\s]{0,10}[ω▽∀´`ﾟ･・°□﹏‿ᴗ>＜<＞;；_＿^￣皿ノд][^()（）\s]{0,10}[)）]"
+    r"|(?<![a-z0-9])(?:qwq|qaq|owo|awa|orz|otz|xd|tat|t_t|233+|6{3,})(?![a-z0-9])"
+    r"|[:;][-']?[)(dpo](?![a-z0-9])",
+    re.IGNORECASE,
+)
+
+
+def _is_punct(char: str) -> bool:
+    return unicodedata.category(char)[0] == "P" or char in "~～^"
+
+
+def _length_bin(length: int) -> str:
+    for limit, label in LENGTH_BINS:
+        if length <= limit:
+            return label
+    return LENGTH_OVERFLOW
+
+
+def extract_features(message: str, timestamp: int, counts: Counter = None) -> Counter:
+    """把一条消息的特征累加到 counts（键为 (kind, feature)）中并返回"""
+    counts = Counter() if counts is None else counts
+    counts["meta", "messages"] += 1
+    counts["length", _length_bin(len(message))] += 1
+    counts["hour", f"{time.localtime(timestamp).tm_hour:02d}"] += 1
+
+    for match in _KAOMOJI.finditer(message):
+        counts["kaomoji", match.group(0).lower()] += 1
+
+    compact = "".join(_URL.sub("", message).split())
+    for char in compact:
+        if _is_punct(char):
+            counts["punct", char] += 1
+        elif _EMOJI.match(char):
+            counts["emoji", char] += 1
+
+    last = compact[-1:] if compact else ""
+    if last and (_is_punct(last) or _EMOJI.match(last)):
+        counts["ending", last] += 1
+    else:
+        counts["ending", NO_ENDING_PUNCT] += 1
+
+    head = compact[:NGRAM_MAX_CHARS]
+    for i in range(len(head) - 1):
+        gram = head[i:i + 2]
+        if gram.isalnum() and not gram.isdigit():
+            counts["ngram", gram] += 1
+    return counts
+
+
+def features_for_rows(rows) -> Counter:
+    """统计一批 [(message, timestamp), ...] 的特征"""
+    counts = Counter()
+    for message, timestamp in rows:
+        extract_features(message, timestamp, counts)
+    return counts
+
+
+def _percent(count: int, total: int) -> str:
+    return f"{count * 100 / total:.0f}%"
+
+
+def format_summary(style: dict) -> str:
+    """
+    把 style（{kind: [(feature, count), ...]}，每类按计数降序）格式化为固定长度的摘要。
+    百分比都以参与统计的消息总数为分母。
+    """
+    total = dict(style.get("meta", ())).get("messages", 0)
+    if not total:
+        return "无"
+
+    def top(kind: str) -> str:
+        items = style.get(kind, [])[:SUMMARY_TOP[kind]]
+        return "、".join(f"{feature!r} {count}" for feature, count in items) or "无"
+
+    def share(kind: str) -> str:
+        items = style.get(kind, [])[:SUMMARY_TOP[kind]]
+        return "、".join(f"{feature!r} {_percent(count, total)}" for feature, count in items) or "无"
+
+    lengths = dict(style.get("length", ()))
+    length_str = "、".join(
+        f"{label} {_percent(lengths[label], total)}"
+        for label in [label for _, label in LENGTH_BINS] + [LENGTH_OVERFLOW] if lengths.get(label)
+    )
+    hours = sorted(style.get("hour", []), key=lambda item: item[1], reverse=True)[:3]
+    hour_str = "、".join(f"{hour}时 {_percent(count, total)}" for hour, count in hours) or "无"
+
+    return "\n".join([
+        f"- 统计消息数: {total}",
+        f"- 句末字符占比: {share('ending')}",
+        f"- 常用标点（次数）: {top('punct')}",
+        f"- 常用 emoji（次数）: {top('emoji')}",
+        f"- 常用颜文字/文字表情（次数）: {top('kaomoji')}",
+        f"- 高频字符组合（次数）: {top('ngram')}",
+        f"- 消息长度分布: {length_str or '无'}",
+        f"- 最活跃时段: {hour_str}",
+    ])
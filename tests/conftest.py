@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共设置：astrbot.api 由 benchmarks/stubs.py 中的最小替身代替，插件目录以 echo_avatar 包名加载。
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks import stubs  # noqa: E402
+
+stubs.install()
+stubs.register_package()
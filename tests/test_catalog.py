@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""统计目录：正常关闭后直接载入；异常退出导致写回缺失时，下次启动扫描数据库重建"""
+
+import asyncio
+
+from echo_avatar import storage
+from echo_avatar.catalog import StatsCatalog
+
+
+def open_store(data_root):
+    layout = storage.PerUserLayout(data_root / "user_data")
+    catalog = StatsCatalog(data_root / "catalog.db", layout.name, size_of=layout.disk_usage)
+    return storage.EchoStore(layout, workers=1, idle_timeout=0, catalog=catalog)
+
+
+async def record(store, count: int, start: int = 0):
+    await store.insert_chats({"10001": [(f"消息 {i}", 1700000000 + i) for i in range(start, start + count)]})
+
+
+def test_clean_shutdown_keeps_catalog(tmp_path):
+    async def first_run():
+        store = open_store(tmp_path)
+        await record(store, 5)
+        epoch = store.catalog.epoch
+        # 延迟写回尚未执行时关闭，关闭必须等待它完成
+        await store.close()
+        return epoch
+
+    async def second_run():
+        store = open_store(tmp_path)
+        await store.catalog_ready()
+        try:
+            return store.catalog.epoch, store.catalog.get("10001").message_count
+        finally:
+            await store.close()
+
+    epoch = asyncio.run(first_run())
+    assert asyncio.run(second_run()) == (epoch, 5)
+
+
+def test_unclean_shutdown_rebuilds_catalog(tmp_path):
+    async def clean_run():
+        store = open_store(tmp_path)
+        await record(store, 5)
+        await store.close()
+
+    async def crashed_run():
+        store = open_store(tmp_path)
+        await record(store, 7, start=5)
+        assert store.catalog.get("10001").message_count == 12
+        # 模拟进程在延迟写回之前退出：数据库已写入，统计目录没有写回也没有关闭
+        catalog, store.catalog = store.catalog, None
+        await store.close()
+        catalog._save_task.cancel()
+        catalog._executor.shutdown(wait=True)
+
+    async def restarted():
+        store = open_store(tmp_path)
+        await store.catalog_ready()
+        try:
+            return store.catalog.get("10001").message_count
+        finally:
+            await store.close()
+
+    asyncio.run(clean_run())
+    asyncio.run(crashed_run())
+    assert asyncio.run(restarted()) == 12
+
+
+def test_compaction_remeasures_only_shrunk_users(tmp_path):
+    async def scenario():
+        store = open_store(tmp_path)
+        try:
+            await store.insert_chats({
+                "10001": [("好长的一条消息" * 50, 1700000000 + i) for i in range(2000)],
+                "10002": [("短消息", 1700000000)],
+            })
+            await store.archive_user("10001", storage.RetentionPolicy(max_messages=10))
+            await store.catalog.save()
+            before = store.catalog.get("10001").disk_bytes
+            version = store.catalog.get("10001").write_version
+            # 回收空间使文件变小，但不经过目录的增量更新；只有被回收的用户会被重新测量
+            assert await store.compact() > 0
+            assert store.catalog._dirty == {"10001"}
+            await store.catalog.save()
+            stats = store.catalog.get("10001")
+            assert stats.write_version == version
+            return before, stats.disk_bytes, store.layout.disk_usage("10001")
+        finally:
+            await store.close()
+
+    before, refreshed, actual = asyncio.run(scenario())
+    assert refreshed == actual < before
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""存储布局的离线转换：per_user -> sharded -> per_user 往返后，每个用户的数据保持不变"""
+
+from echo_avatar import storage
+
+USERS = {
+    "10001": [(f"第 {i} 条消息 好耶~", 1700000000 + i) for i in range(30)],
+    "20002": [(f"原神 抽卡 {i} 😂", 1700100000 + i) for i in range(12)],
+}
+
+
+def seed(data_root):
+    layout = storage.PerUserLayout(data_root / "user_data")
+    for user_id, rows in USERS.items():
+        conn = storage.open_user_db(layout.db_path(user_id), scoped=False)
+        scope = storage.UserScope(user_id, False)
+        try:
+            storage._insert_chats(conn, scope, rows)
+            storage._set_profile(conn, scope, "nickname", f"用户{user_id}")
+            storage._insert_note(conn, scope, "admin_annotations", "批注", "admin", 1700200000)
+            storage._insert_note(conn, scope, "third_party_memories", "记忆", "friend", 1700200001)
+            # 归档一部分聊天记录，转换时需要还原
+            archived, _, _ = storage._archive_user(conn, scope, storage.RetentionPolicy(max_messages=5, chunk_size=4), 1800000000)
+            assert archived == len(rows) - 5
+        finally:
+            conn.close()
+
+
+def snapshot(conn, scope) -> dict:
+    """一个用户的全部数据；聊天记录按原顺序排列，已归档的部分与未归档的部分合并"""
+    messages = [(message, timestamp) for _, timestamp, message in storage._ArchiveReader(conn, scope).iter_rows()]
+    messages += [tuple(row) for row in conn.execute(
+        f"SELECT message, timestamp FROM chat_history {scope.where()} ORDER BY id", scope.params())]
+    notes = {
+        table: [tuple(row) for row in conn.execute(
+            f"SELECT text, added_by, timestamp FROM {table} {scope.where()} ORDER BY id", scope.params())]
+        for table in ("admin_annotations", "third_party_memories")
+    }
+    return {
+        "messages": messages,
+        "notes": notes,
+        "profile": dict(tuple(row) for row in conn.execute(f"SELECT key, value FROM profile {scope.where()}", scope.params())),
+        "style": sorted(tuple(row) for row in conn.execute(
+            f"SELECT kind, feature, count FROM style_features {scope.where()}", scope.params())),
+    }
+
+
+def read_user(layout, user_id: str) -> dict:
+    conn = storage.open_user_db(layout.db_path(user_id), layout.scoped)
+    try:
+        return snapshot(conn, storage.UserScope(user_id, layout.scoped))
+    finally:
+        conn.close()
+
+
+def test_shard_round_trip(tmp_path):
+    seed(tmp_path)
+    per_user = storage.PerUserLayout(tmp_path / "user_data")
+    before = {user_id: read_user(per_user, user_id) for user_id in USERS}
+    assert [len(data["messages"]) for data in before.values()] == [len(rows) for rows in USERS.values()]
+
+    assert storage.convert_to_sharded(tmp_path, shard_count=4, remove_source=True, progress=lambda _: None) == len(USERS)
+    assert not list((tmp_path / "user_data").glob("*.db"))
+    sharded = storage.ShardedLayout(tmp_path / "shards")
+    assert {user_id: read_user(sharded, user_id) for user_id in USERS} == before
+
+    # 重复转换是安全的：目标中已有的数据会先被清除
+    assert storage.convert_to_per_user(tmp_path, progress=lambda _: None) == len(USERS)
+    assert storage.convert_to_per_user(tmp_path, remove_source=True, progress=lambda _: None) == len(USERS)
+    assert not (tmp_path / "shards" / storage.ShardedLayout.META_FILE).exists()
+    assert {user_id: read_user(per_user, user_id) for user_id in USERS} == before
+
+
+def test_shard_id_cursor_uses_index(tmp_path):
+    conn = storage.open_user_db(tmp_path / "shard_000.db", scoped=True)
+    try:
+        for table in ("chat_history", "admin_annotations", "third_party_memories"):
+            plan = " ".join(row[-1] for row in conn.execute(
+                f"EXPLAIN QUERY PLAN SELECT id FROM {table} WHERE user_id = ? AND id > ? ORDER BY id LIMIT 10", ("10001", 0)))
+            assert f"idx_{table}_user_id" in plan and "TEMP B-TREE" not in plan
+    finally:
+        conn.close()
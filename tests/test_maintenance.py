@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""后台维护：空闲连接清扫与维护自身的数据库操作不能让数据库一直显得“忙碌”"""
+
+import asyncio
+import functools
+
+from echo_avatar import storage
+
+
+def count_runs(store) -> list:
+    """记录 store.run_maintenance 的每次调用"""
+    runs = []
+    run_maintenance = store.run_maintenance
+
+    async def counting(policy):
+        runs.append(policy)
+        return await run_maintenance(policy)
+
+    store.run_maintenance = counting
+    return runs
+
+
+def test_maintenance_runs_with_idle_sweeper(tmp_path):
+    async def scenario():
+        # 连接清扫每秒执行一次，维护要求连续 1.5 秒没有前台操作
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=1, idle_timeout=2)
+        scheduler = storage.MaintenanceScheduler(store, storage.RetentionPolicy(), interval=0.2, idle_seconds=1.5)
+        runs = count_runs(store)
+        await store.insert_chat("10001", "你好", 1700000000)
+        assert store._sweeper is not None
+        scheduler.start()
+        await asyncio.sleep(4)
+        await scheduler.close()
+        await store.close()
+        return len(runs)
+
+    assert asyncio.run(scenario()) >= 1
+
+
+def test_foreground_activity_defers_maintenance(tmp_path):
+    async def scenario():
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=1, idle_timeout=0)
+        scheduler = storage.MaintenanceScheduler(store, storage.RetentionPolicy(), interval=0.1, idle_seconds=1)
+        runs = count_runs(store)
+        scheduler.start()
+        for i in range(15):
+            await store.insert_chat("10001", f"消息 {i}", 1700000000 + i)
+            await asyncio.sleep(0.1)
+        await scheduler.close()
+        await store.close()
+        return len(runs)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_compact_reports_freed_pages_only(tmp_path):
+    db_path = tmp_path / "10001.db"
+    conn = storage.open_user_db(db_path, scoped=False)
+    scope = storage.UserScope("10001", False)
+    try:
+        storage._insert_chats(conn, scope, [("很长的一条消息" * 40, 1700000000 + i) for i in range(3000)])
+        storage._archive_user(conn, scope, storage.RetentionPolicy(max_messages=10), 1800000000)
+        # 此时 WAL 中还有大量未写回的页，它们的截断不应计入回收量
+        assert (tmp_path / "10001.db-wal").stat().st_size > 0
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        free_bytes = conn.execute("PRAGMA freelist_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+        assert free_bytes > 0
+        before = db_path.stat().st_size
+        freed = storage._compact_db(conn, db_path)
+        assert freed == before - db_path.stat().st_size
+        assert freed >= free_bytes
+        assert not (tmp_path / "10001.db-wal").stat().st_size
+    finally:
+        conn.close()
+
+
+def test_archive_keeps_newest_by_timestamp(tmp_path):
+    conn = storage.open_user_db(tmp_path / "10001.db", scoped=False)
+    scope = storage.UserScope("10001", False)
+    policy = functools.partial(storage.RetentionPolicy, chunk_size=2)
+    try:
+        storage._insert_chats(conn, scope, [("旧消息", 1600000000)] + [(f"实时 {i}", 1700000000 + i) for i in range(8)])
+        # 之后导入的旧消息 id 最大，但时间更早，应当与 id 最小的旧消息一起先被归档
+        storage._insert_chats(conn, scope, [("导入", 1600000001)])
+        assert storage._archive_user(conn, scope, policy(max_messages=8), 1800000000)[0] == 2
+        kept = [row[0] for row in conn.execute("SELECT message FROM chat_history ORDER BY id")]
+        assert kept == [f"实时 {i}" for i in range(8)]
+
+        # 第二次归档的块 (id 2~3) 落在第一个块 (id 1~10) 的范围内，按 id 读回时仍然有序且不遗漏
+        assert storage._archive_user(conn, scope, policy(max_messages=6), 1800000000)[0] == 2
+        rows = storage._ArchiveReader(conn, scope).read(0, 2)
+        assert [message for _, message in rows] == ["旧消息", "实时 0"]
+    finally:
+        conn.close()
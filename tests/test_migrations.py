@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""用户数据库结构迁移：插件最初版本创建的数据库升级到最新结构后，数据保持不变且新功能可用"""
+
+import sqlite3
+
+from echo_avatar import storage
+from echo_avatar.style import features_for_rows
+
+MESSAGES = [
+    ("今天抽卡又歪了", 1700000000),
+    ("原神启动！", 1700000060),
+    ("这条会被删除", 1700000120),
+    ("晚安 😂", 1700000180),
+    ("明天再说吧~", 1700000240),
+]
+
+
+def make_baseline_db(path):
+    """按插件最初版本的结构建库：chat_history 带冗余的 user_id 列，user_version 为 0"""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        );
+        CREATE TABLE profile (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE admin_annotations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            added_by TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        );
+        CREATE TABLE third_party_memories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            added_by TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        );
+    """)
+    conn.executemany(
+        "INSERT INTO chat_history (user_id, message, timestamp) VALUES ('10001', ?, ?)", MESSAGES
+    )
+    # 删除一行，留下 id 空洞，用于确认迁移保留了原有 id
+    conn.execute("DELETE FROM chat_history WHERE id = 3")
+    conn.execute("INSERT INTO profile (key, value) VALUES ('nickname', '旅行者')")
+    conn.execute("INSERT INTO admin_annotations (text, added_by, timestamp) VALUES ('喜欢抽卡游戏', 'admin', 1700000300)")
+    conn.execute("INSERT INTO third_party_memories (text, added_by, timestamp) VALUES ('周末常去图书馆', 'friend', 1700000400)")
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_db_migrates_to_latest(tmp_path):
+    db_path = tmp_path / "10001.db"
+    make_baseline_db(db_path)
+
+    conn = storage.open_user_db(db_path, scoped=False)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == storage.USER_DB_MIGRATIONS[-1][0]
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(chat_history)")]
+        assert columns == ["id", "message", "timestamp", "search_text"]
+
+        kept = [row for i, row in enumerate(MESSAGES, start=1) if i != 3]
+        rows = conn.execute("SELECT id, message, timestamp FROM chat_history ORDER BY id").fetchall()
+        assert [tuple(row) for row in rows] == [(i, m, t) for i, (m, t) in enumerate(MESSAGES, start=1) if i != 3]
+        assert conn.execute("SELECT value FROM profile WHERE key = 'nickname'").fetchone()[0] == "旅行者"
+
+        # 风格特征由已有的聊天记录回填
+        style = {(kind, feature): count for kind, feature, count in conn.execute("SELECT kind, feature, count FROM style_features")}
+        assert style == dict(features_for_rows(kept))
+
+        # 全文索引由已有数据回填，迁移后的写入由触发器同步
+        scope = storage.UserScope("10001", False)
+        found = storage._search_user(conn, scope, "今天抽卡", 10)
+        assert [row[0] for row in found["chat_history"]] == [1]
+        assert [row[2] for row in found["admin_annotations"]] == []
+        assert [row[2] for row in storage._search_user(conn, scope, "图书馆", 10)["third_party_memories"]] == ["周末常去图书馆"]
+        assert [row[2] for row in storage._search_user(conn, scope, "抽卡", 10)["admin_annotations"]] == ["喜欢抽卡游戏"]
+
+        storage._insert_chats(conn, scope, [("今天抽卡出金了", 1700000500)])
+        found = storage._search_user(conn, scope, "今天抽卡", 10)
+        assert sorted(row[0] for row in found["chat_history"]) == [1, 6]
+    finally:
+        conn.close()
+
+
+def test_migration_is_idempotent(tmp_path):
+    db_path = tmp_path / "10001.db"
+    make_baseline_db(db_path)
+    storage.open_user_db(db_path, scoped=False).close()
+
+    conn = storage.open_user_db(db_path, scoped=False)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0] == len(MESSAGES) - 1
+        style_total = conn.execute("SELECT SUM(count) FROM style_features").fetchone()[0]
+        assert style_total == sum(features_for_rows([m for i, m in enumerate(MESSAGES, start=1) if i != 3]).values())
+    finally:
+        conn.close()
+
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""插件处理器：后台任务不依赖监控用户的消息即可启动；归档不改变人格缓存的指纹"""
+
+import asyncio
+
+from benchmarks import stubs
+
+
+async def drain(results) -> list:
+    return [result async for result in results]
+
+
+def test_admin_command_starts_background_tasks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main = stubs.load_plugin()
+
+    async def scenario():
+        plugin = stubs.make_plugin(main, target_users=[], maintenance_interval=3600, metrics_dump_interval=60)
+        try:
+            assert plugin.maintenance._task is None and plugin.metrics_dumper._task is None
+            await drain(plugin.get_status(stubs.Event("admin", "/echo_avatar 状态")))
+            return plugin.maintenance._task is not None and plugin.metrics_dumper._task is not None
+        finally:
+            await plugin.terminate()
+
+    assert asyncio.run(scenario())
+
+
+def test_archiving_keeps_persona_fingerprint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main = stubs.load_plugin()
+
+    async def scenario():
+        plugin = stubs.make_plugin(main, target_users=[], maintenance_interval=0)
+        try:
+            await plugin.store.insert_chats({"10001": [(f"消息 {i}", 1600000000 + i) for i in range(20)]})
+            before = await plugin._persona_fingerprint("10001")
+            # 全部记录都早于保留期限，归档后 chat_history 为空
+            assert await plugin.store.archive_user("10001", main.RetentionPolicy(max_days=1)) == 20
+            return before, await plugin._persona_fingerprint("10001")
+        finally:
+            await plugin.terminate()
+
+    before, after = asyncio.run(scenario())
+    assert before == after
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""全文检索：两个字的中文词通过索引匹配并按相关度排序，结果与 LIKE 子串匹配一致"""
+
+import sqlite3
+
+from echo_avatar import storage
+from echo_avatar.sampling import PromptBudget
+
+MESSAGES = [
+    "今天抽卡又歪了",
+    "晚饭吃什么",
+    "抽卡抽卡抽卡，抽卡就完事了",
+    "python 写了个抽卡模拟器",
+    "卡抽不出来",
+    "原神 启动",
+    "猫猫好可爱",
+]
+
+
+def open_db(tmp_path):
+    conn = storage.open_user_db(tmp_path / "10001.db", scoped=False)
+    scope = storage.UserScope("10001", False)
+    storage._insert_chats(conn, scope, [(message, 1700000000 + i) for i, message in enumerate(MESSAGES)])
+    return conn, scope
+
+
+def search(conn, scope, query: str) -> list:
+    return [text for _, _, text in storage._search_user(conn, scope, query, 10)["chat_history"]]
+
+
+def test_fts_grams():
+    assert storage.fts_grams("今天抽卡ok，原神!猫") == "今天 天抽 抽卡 ok， 原神 ! 猫"
+    assert storage._fts_phrase("抽卡") == '"抽卡"'
+    assert storage._fts_phrase("pyth") == '"pyth"*'
+    # 单字与纯符号无法通过索引匹配
+    assert storage._fts_phrase("猫") is None
+    assert storage._fts_phrase("!!") is None
+    assert storage._fts_phrase("_") is None
+    assert storage._fts_phrase("l_") == '"l_"'
+
+
+def test_two_char_terms_use_index_and_rank(tmp_path):
+    conn, scope = open_db(tmp_path)
+    try:
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT rowid FROM chat_history_fts WHERE chat_history_fts MATCH ?", ('"抽卡"',)))
+        assert "VIRTUAL TABLE" in plan
+
+        found = search(conn, scope, "抽卡")
+        # 出现次数最多的排在最前；“卡抽”不是“抽卡”的子串
+        assert found[0] == "抽卡抽卡抽卡，抽卡就完事了"
+        assert sorted(found) == sorted(m for m in MESSAGES if "抽卡" in m)
+        assert search(conn, scope, "抽卡 python") == ["python 写了个抽卡模拟器"]
+        assert search(conn, scope, "pyth") == ["python 写了个抽卡模拟器"]
+        # 单字退回 LIKE 扫描
+        assert search(conn, scope, "猫") == ["猫猫好可爱"]
+        # 不产生任何词的关键词退回 LIKE 扫描
+        assert search(conn, scope, "_") == []
+        assert search(conn, scope, "，") == ["抽卡抽卡抽卡，抽卡就完事了"]
+        # 二元组跨越标点时由 LIKE 条件排除
+        assert search(conn, scope, "神启") == []
+    finally:
+        conn.close()
+
+
+def test_index_follows_deletes(tmp_path):
+    conn, scope = open_db(tmp_path)
+    try:
+        storage._archive_user(conn, scope, storage.RetentionPolicy(max_messages=4), 1800000000)
+        assert search(conn, scope, "抽卡") == ["python 写了个抽卡模拟器"]
+        assert conn.execute("SELECT COUNT(*) FROM chat_history_fts WHERE chat_history_fts MATCH '\"今天\"'").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+def test_topic_prefers_relevant_messages(tmp_path):
+    conn, scope = open_db(tmp_path)
+    try:
+        data = storage._load_persona_topic(conn, scope, PromptBudget(), "抽卡")
+        assert data["topic_count"] == len([m for m in MESSAGES if "抽卡" in m])
+        # 预算只够一条时，选中的是相关度最高的一条
+        best = "抽卡抽卡抽卡，抽卡就完事了"
+        budget = PromptBudget(history=PromptBudget().cost(best))
+        data = storage._load_persona_topic(conn, scope, budget, "抽卡")
+        assert (data["topic_count"], data["history"]) == (1, [best])
+    finally:
+        conn.close()
+
+
+def test_plain_connection_can_write(tmp_path):
+    """触发器不依赖插件注册的函数，其他工具打开数据库也能写入和删除"""
+    conn, scope = open_db(tmp_path)
+    conn.close()
+    plain = sqlite3.connect(tmp_path / "10001.db")
+    try:
+        with plain:
+            plain.execute("INSERT INTO chat_history (message, timestamp) VALUES ('hello 外部工具写入', 1800000000)")
+            plain.execute("INSERT INTO admin_annotations (text, added_by, timestamp) VALUES ('外部批注', 'cli', 1800000000)")
+            plain.execute("DELETE FROM chat_history WHERE message = '晚饭吃什么'")
+    finally:
+        plain.close()
+
+    conn = storage.open_user_db(tmp_path / "10001.db", scoped=False)
+    try:
+        assert search(conn, scope, "hello") == ["hello 外部工具写入"]
+        assert search(conn, scope, "晚饭") == []
+        # 索引内部一致（损坏时抛出异常）
+        conn.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('integrity-check')")
+    finally:
+        conn.close()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""聊天记录导入：中断后再次导入同一文件，从上次的位置继续且不重复写入"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from echo_avatar import storage, transfer
+from echo_avatar.filters import CommandFilter
+
+LINES = 50
+
+
+class Interrupted(Exception):
+    pass
+
+
+def write_source(path):
+    records = [{"user_id": f"1000{i % 3}", "message": f"第 {i} 条消息", "timestamp": 1700000000 + i} for i in range(LINES)]
+    # 一条无效行与一条会被指令过滤规则拦下的消息
+    lines = [json.dumps(record, ensure_ascii=False) for record in records]
+    lines.insert(10, "{not json")
+    lines.insert(20, json.dumps({"user_id": "10000", "message": "/help", "timestamp": 1700000000}))
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def imported_messages(data_root) -> list:
+    messages = []
+    for db_path in sorted((data_root / "user_data").glob("*.db")):
+        conn = sqlite3.connect(db_path)
+        try:
+            messages += [row[0] for row in conn.execute("SELECT message FROM chat_history")]
+        finally:
+            conn.close()
+    return sorted(messages)
+
+
+def expected_messages() -> list:
+    return sorted(f"第 {i} 条消息" for i in range(LINES))
+
+
+def test_offline_import_resumes(tmp_path):
+    source = tmp_path / "history.jsonl"
+    write_source(source)
+    command_filter = CommandFilter.from_config({}, any_user=True)
+    printed = []
+
+    def interrupt(message):
+        printed.append(message)
+        raise Interrupted
+
+    with pytest.raises(Interrupted):
+        transfer.import_offline(tmp_path, "per_user", source, "jsonl", command_filter, batch_size=15, progress=interrupt)
+    assert len(imported_messages(tmp_path)) == 15
+
+    result = transfer.import_offline(tmp_path, "per_user", source, "jsonl", command_filter, batch_size=15, progress=printed.append)
+    assert any("继续导入" in line for line in printed)
+    assert result["offset"] == result["size"]
+    assert (result["imported"], result["filtered"], result["invalid"]) == (LINES, 1, 1)
+    assert imported_messages(tmp_path) == expected_messages()
+
+
+def test_import_file_resumes(tmp_path):
+    source = tmp_path / "history.jsonl"
+    write_source(source)
+    command_filter = CommandFilter.from_config({}, any_user=True)
+
+    async def scenario():
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=2, idle_timeout=0)
+        try:
+            progress = transfer.import_file(store, tmp_path, source, "jsonl", command_filter, batch_size=15)
+            first = await progress.__anext__()
+            await progress.aclose()
+            assert not first["resumed"] and first["imported"] == 15
+
+            reports = [report async for report in transfer.import_file(store, tmp_path, source, "jsonl", command_filter, batch_size=15)]
+            assert all(report["resumed"] for report in reports)
+            return reports[-1]
+        finally:
+            await store.close()
+
+    final = asyncio.run(scenario())
+    assert (final["imported"], final["filtered"], final["invalid"]) == (LINES, 1, 1)
+    assert imported_messages(tmp_path) == expected_messages()
+
+    # --restart 忽略进度，整个文件重新导入
+    async def restart():
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=1, idle_timeout=0)
+        try:
+            return [report async for report in transfer.import_file(store, tmp_path, source, "jsonl", command_filter,
+                                                                    batch_size=15, restart=True)][-1]
+        finally:
+            await store.close()
+
+    assert asyncio.run(restart())["imported"] == LINES
+    assert len(imported_messages(tmp_path)) == 2 * LINES
+
+
+class BlockingFilter:
+    """第一次匹配时阻塞读取线程，直到测试放行"""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def match(self, user_id, message):
+        self.calls += 1
+        if self.calls == 1:
+            self.entered.set()
+            self.release.wait(5)
+        return message
+
+
+def test_import_file_cancelled_while_reading(tmp_path):
+    source = tmp_path / "history.jsonl"
+    write_source(source)
+    command_filter = BlockingFilter()
+
+    async def scenario():
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=1, idle_timeout=0)
+        try:
+            async def consume():
+                async for _ in transfer.import_file(store, tmp_path, source, "jsonl", command_filter, batch_size=1000):
+                    pass
+
+            task = asyncio.create_task(consume())
+            await asyncio.to_thread(command_filter.entered.wait, 5)
+            task.cancel()
+            # 读取线程仍在生成器内部：取消必须干净结束，而不是在 close 时抛出 ValueError
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            calls = command_filter.calls
+            command_filter.release.set()
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if command_filter.calls > calls:
+                    break
+            await asyncio.sleep(0.05)
+        finally:
+            await store.close()
+
+    asyncio.run(scenario())
+    # 被取消的这次读取没有写入任何数据，也没有记录进度
+    assert imported_messages(tmp_path) == []
+    assert transfer.ImportState(tmp_path).load(source) is None
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""聊天记录写缓冲：关闭时必须把已接收的消息全部落库"""
+
+import asyncio
+import sqlite3
+import threading
+
+from echo_avatar import storage
+
+
+def count_rows(db_path) -> int:
+    if not db_path.exists():
+        return 0
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_close_waits_for_in_progress_flush(tmp_path):
+    async def scenario():
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=1, idle_timeout=0)
+        buffer = storage.ChatWriteBuffer(store, max_size=100, flush_interval=60, batch_size=1)
+        release = threading.Event()
+        # 占住唯一的数据库通道，使后台落库任务停在写入中途
+        lane = store._lanes[0]
+        blocker = asyncio.get_running_loop().run_in_executor(lane.executor, release.wait)
+
+        for i in range(3):
+            await buffer.put("10001", f"消息 {i}", 1700000000 + i)
+        for _ in range(100):
+            if buffer.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        # 消息已经出队，正在等待通道空闲
+        assert buffer.pending == 0
+
+        asyncio.get_running_loop().call_later(0.1, release.set)
+        await buffer.close()
+        await blocker
+        await store.close()
+        return store.db_path("10001")
+
+    db_path = asyncio.run(scenario())
+    assert count_rows(db_path) == 3
+
+
+def test_close_drains_queue_without_background_task(tmp_path):
+    async def scenario():
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=1, idle_timeout=0)
+        buffer = storage.ChatWriteBuffer(store, max_size=100, flush_interval=60, batch_size=1000)
+        for i in range(5):
+            await buffer.put("10001", f"消息 {i}", 1700000000 + i)
+        await buffer.close()
+        await store.close()
+        return store.db_path("10001")
+
+    assert count_rows(asyncio.run(scenario())) == 5
+
+
+def test_put_after_close_writes_directly(tmp_path):
+    async def scenario():
+        store = storage.EchoStore(storage.PerUserLayout(tmp_path / "user_data"), workers=1, idle_timeout=0)
+        buffer = storage.ChatWriteBuffer(store, max_size=100, flush_interval=60, batch_size=1000)
+        await buffer.put("10001", "关闭前", 1700000000)
+        await buffer.close()
+        await buffer.put("10001", "关闭后", 1700000001)
+        # 关闭后不应重新拉起后台任务，也不应留在队列里
+        assert buffer._task is None
+        assert buffer.pending == 0
+        await store.close()
+        return store.db_path("10001")
+
+    assert count_rows(asyncio.run(scenario())) == 2
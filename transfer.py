@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+聊天记录的批量导入与用户数据导出。
+
+导入支持两种文件格式，均逐行流式读取：
+- jsonl: 每行一个 JSON 对象，用户字段为 user_id / user / sender，消息字段为 message / text / content，
+  时间字段为 timestamp / time（秒或毫秒级时间戳，或 ISO 8601 字符串）；带 "type" 字段时只导入 "chat" 类型，
+  因此导出文件可以直接重新导入聊天记录；
+- tsv: 每行 "时间戳<TAB>用户ID<TAB>消息"，消息中可以包含制表符。
+导入的消息经过与实时记录相同的过滤规则 (CommandFilter)，按批交给调用方写入。
+每批写入后把已处理的字节偏移记录到状态文件，中断后再次导入同一文件会从上次的位置继续
+（中断发生在写入与记录状态之间时，最后一批可能被重复写入）。
+
+导出把一个用户的全部数据写成 JSONL，每行带 "type" 字段（profile / chat / annotation / memory）。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from .storage import UserScope, _insert_chats, iter_export_pages, make_layout, open_user_db
+
+IMPORT_FORMATS = ("jsonl", "tsv")
+DEFAULT_BATCH_SIZE = 5000
+IMPORT_STATE_FILE = "import_state.json"
+# 用于识别“同一个文件”的文件头长度
+_HEAD_BYTES = 4096
+
+_USER_KEYS = ("user_id", "user", "sender")
+_MESSAGE_KEYS = ("message", "text", "content")
+_TIME_KEYS = ("timestamp", "time")
+
+
+def detect_format(path: Path) -> str:
+    return "jsonl" if path.suffix.lower() in (".jsonl", ".json", ".ndjson") else "tsv"
+
+
+def parse_timestamp(value):
+    """把秒/毫秒级时间戳或 ISO 8601 字符串转换为秒级整数时间戳，无法识别时返回 None"""
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            value = float(value)
+        except ValueError:
+            try:
+                return int(datetime.fromisoformat(value).timestamp())
+            except ValueError:
+                return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # 13 位的是毫秒级时间戳
+        return int(value / 1000) if value > 1e11 else int(value)
+    return None
+
+
+def _first(record: dict, keys: tuple):
+    for key in keys:
+        if record.get(key) is not None:
+            return record[key]
+    return None
+
+
+def parse_line(line: str, fmt: str):
+    """
+    解析一行，返回 (user_id, message, timestamp)；
+    非聊天记录的行（如导出文件中的资料、批注）返回 None，格式错误时抛出 ValueError。
+    """
+    if fmt == "jsonl":
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError("不是 JSON 对象")
+        if record.get("type", "chat") != "chat":
+            return None
+        user_id, message, timestamp = _first(record, _USER_KEYS), _first(record, _MESSAGE_KEYS), _first(record, _TIME_KEYS)
+    else:
+        parts = line.split("\t", 2)
+        if len(parts) != 3:
+            raise ValueError("字段数不足")
+        timestamp, user_id, message = parts
+    timestamp = parse_timestamp(timestamp)
+    if user_id is None or not isinstance(message, str) or timestamp is None:
+        raise ValueError("缺少用户、消息或时间")
+    user_id = str(user_id).strip()
+    # 用户 ID 会成为数据库文件名
+    if not user_id or any(c in user_id for c in "/\\\0") or user_id in (".", ".."):
+        raise ValueError("无效的用户 ID")
+    return user_id, message, timestamp
+
+
+def _file_head(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(_HEAD_BYTES)).hexdigest()
+
+
+class ImportState:
+    """导入进度，保存在数据目录下的 import_state.json 中，以文件绝对路径区分"""
+
+    def __init__(self, data_root: Path):
+        self.path = data_root / IMPORT_STATE_FILE
+
+    def _load_all(self) -> dict:
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, source: Path) -> dict:
+        """返回该文件上次的进度；文件头已变化（不是同一个文件）时视为没有进度"""
+        state = self._load_all().get(str(source.resolve()))
+        if state is None or state.get("head") != _file_head(source):
+            return None
+        return state
+
+    def save(self, source: Path, state: dict):
+        states = self._load_all()
+        states[str(source.resolve())] = {**state, "head": _file_head(source)}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(states, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+def iter_import_batches(source: Path, fmt: str, command_filter, batch_size: int = DEFAULT_BATCH_SIZE, start_offset: int = 0):
+    """
+    从 start_offset 开始流式读取导入文件，产出 (batch, progress)。
+    batch 为 {user_id: [(message, timestamp), ...]}，每批最多 batch_size 条；
+    progress 为本批结束时的累计进度：offset（已处理的字节数）、size、imported、filtered、invalid。
+    """
+    size = source.stat().st_size
+    progress = {"offset": start_offset, "size": size, "imported": 0, "filtered": 0, "invalid": 0}
+    batch, count = {}, 0
+    with open(source, "rb") as f:
+        f.seek(start_offset)
+        offset = start_offset
+        while True:
+            raw = f.readline()
+            if not raw:
+                break
+            offset += len(raw)
+            line = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+            if line.strip():
+                try:
+                    parsed = parse_line(line, fmt)
+                except ValueError:
+                    progress["invalid"] += 1
+                    parsed = None
+                if parsed is not None:
+                    user_id, message, timestamp = parsed
+                    text = command_filter.match(user_id, message)
+                    if text is None:
+                        progress["filtered"] += 1
+                    else:
+                        batch.setdefault(user_id, []).append((text, timestamp))
+                        count += 1
+            if count >= batch_size:
+                progress.update(offset=offset, imported=progress["imported"] + count)
+                yield batch, dict(progress)
+                batch, count = {}, 0
+        progress.update(offset=offset, imported=progress["imported"] + count)
+        yield batch, dict(progress)
+
+
+async def import_file(store, data_root: Path, source: Path, fmt: str, command_filter,
+                      batch_size: int = DEFAULT_BATCH_SIZE, restart: bool = False):
+    """
+    在插件运行时把导入文件写入 store（storage.EchoStore）。异步生成器，每写入一批产出一次累计进度，
+    进度中的 resumed 表示是否从上次中断的位置继续。
+    文件读取与解析在线程中执行，每批通过 EchoStore.insert_chats 写入，统计目录同步更新。
+    """
+    state = ImportState(data_root)
+    previous = None if restart else await asyncio.to_thread(state.load, source)
+    start = previous["offset"] if previous else 0
+    totals = {key: previous.get(key, 0) for key in ("imported", "filtered", "invalid")} if previous else {}
+    batches = iter_import_batches(source, fmt, command_filter, batch_size, start)
+    reading = None
+    try:
+        while True:
+            # shield: 被取消时线程里的 next 仍在执行，不能随之丢掉这个任务
+            reading = asyncio.ensure_future(asyncio.to_thread(next, batches, None))
+            item = await asyncio.shield(reading)
+            if item is None:
+                break
+            batch, progress = item
+            if batch:
+                failed = await store.insert_chats(batch)
+                if failed:
+                    user_id, error = next(iter(failed.items()))
+                    raise RuntimeError(f"写入用户 {user_id} 的消息失败: {error}")
+            for key, value in totals.items():
+                progress[key] += value
+            await asyncio.to_thread(state.save, source, progress)
+            progress["resumed"] = previous is not None
+            yield progress
+    finally:
+        if reading is not None and not reading.done():
+            # 生成器正在线程中执行，此时 close 会抛 ValueError；等这次读取结束后再关闭文件
+            reading.add_done_callback(lambda task: _close_after_read(task, batches))
+        else:
+            batches.close()
+
+
+def _close_after_read(task: asyncio.Future, batches):
+    if not task.cancelled():
+        task.exception()
+    batches.close()
+
+
+def export_path(data_root: Path, user_id: str) -> Path:
+    safe_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in user_id)
+    return data_root / "exports" / f"{safe_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+
+
+def write_records(f, records: list):
+    f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+
+
+# --- 离线导入导出（cli.py 使用，需在插件停用时运行） ---
+def import_offline(data_root: Path, backend: str, source: Path, fmt: str, command_filter,
+                   batch_size: int = DEFAULT_BATCH_SIZE, restart: bool = False, progress=print) -> dict:
+    """把导入文件直接写入数据库，返回最终进度"""
+    layout = make_layout(data_root, backend=backend, shard_count=None)
+    state = ImportState(data_root)
+    previous = None if restart else state.load(source)
+    start = previous["offset"] if previous else 0
+    if previous:
+        progress(f"从上次中断的位置继续导入（已处理 {start} 字节）")
+    totals = {key: previous.get(key, 0) for key in ("imported", "filtered", "invalid")} if previous else {}
+    conns = {}
+    result = None
+    try:
+        for batch, result in iter_import_batches(source, fmt, command_filter, batch_size, start):
+            for user_id, rows in batch.items():
+                db_path = layout.db_path(user_id)
+                conn = conns.get(db_path)
+                if conn is None:
+                    conn = conns[db_path] = open_user_db(db_path, layout.scoped)
+                _insert_chats(conn, UserScope(user_id, layout.scoped), rows)
+            for key, value in totals.items():
+                result[key] += value
+            state.save(source, result)
+            percent = result["offset"] * 100 / result["size"] if result["size"] else 100
+            progress(f"{percent:5.1f}%  已导入 {result['imported']} 条，过滤 {result['filtered']} 条，无效 {result['invalid']} 行")
+    finally:
+        for conn in conns.values():
+            conn.close()
+    return result
+
+
+def export_offline(data_root: Path, backend: str, user_id: str, target: Path, page_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """把一个用户的全部数据导出到 target，返回导出的记录数"""
+    layout = make_layout(data_root, backend=backend, shard_count=None)
+    db_path = layout.db_path(user_id)
+    if not db_path.exists():
+        return 0
+    conn = open_user_db(db_path, layout.scoped)
+    exported = 0
+    try:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(target, "w", encoding="utf-8") as f:
+            for records in iter_export_pages(conn, UserScope(user_id, layout.scoped), page_size):
+                write_records(f, records)
+                exported += len(records)
+    finally:
+        conn.close()
+    return exported